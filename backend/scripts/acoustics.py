@@ -10,388 +10,291 @@ Usage:
 Options:
     -d DET_ID       Detector ID.
     -o PLOT_DIR     The directory to save the plot [default: /plots].
+    -w WORKERS      Number of concurrent DB queries if the TOAs cannot be
+                    retrieved for the whole detector at once [default: 8].
+    -n PROCESSES    Number of processes analysing the DUs [default: 4].
+    -r TOA_DIR      Serve recorded runs.csv and toashort.csv tables from a
+                    directory instead of the DB (for testing).
+    -s DATA_DIR     The directory of the local TOA store [default: /data].
+    -k KEEP_HOURS   Hours of TOAs kept in the local store [default: 24].
+    -t UNIX_TIME    Analyse the time window ending at the given time using
+                    only the local TOA store and exit (offline).
     -h --help       Show this screen.
 
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from multiprocessing import Pool
 import os
 import time
-import http
-import ssl
+import http.client
 
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from matplotlib import colors
 import numpy as np
+import pandas as pd
 import km3db
 import km3pipe as kp
 from docopt import docopt
 
+from ping_selection import select_pings
+from toa_store import TOAStore
 
-def diff(first, second):
-    second = set(second)
-    return [item for item in first if item not in second]
 
+DB_ERRORS = (http.client.HTTPException, OSError)
 
-def duplicates(lst, item):
-    return [i for i, x in enumerate(lst) if x == item]
 
+class RecordedStreamDS:
+    """Stand-in for the StreamDS serving recorded ``runs`` and ``toashort``
+    tables (CSV files written with ``DataFrame.to_csv``) from a directory"""
+    def __init__(self, directory):
+        self._runs = pd.read_csv(os.path.join(directory, "runs.csv"))
+        self._toashort = pd.read_csv(os.path.join(directory, "toashort.csv"))
 
-args = docopt(__doc__)
+    def runs(self, detid):
+        return self._runs
 
-sds = km3db.StreamDS(container="pd")
-                    
-try:
-    detid = int(args['-d'])
-except ValueError:
-    detid = (args['-d'])
-if type(detid)==int:
-    detid = km3db.tools.todetoid(detid)
+    def toashort(self, detid, minrun, maxrun, domid=None, emitterid=None):
+        toas = self._toashort
+        if "RUN" in toas:
+            toas = toas[(toas["RUN"] >= minrun) & (toas["RUN"] <= maxrun)]
+        if domid is not None:
+            toas = toas[toas["DOMID"] == domid]
+        if emitterid is not None:
+            toas = toas[toas["EMITTERID"] == emitterid]
+        if len(toas) == 0:
+            return None
+        return toas.reset_index(drop=True)
 
-directory = args['-o']
 
-ACOUSTIC_BEACONS = [0, 0, 0]
+def fetch_toas(sds, detid, minrun, maxrun, dom_ids, n_workers=8):
+    """Retrieve the TOAs of the given DOMs, split by DOM ID.
 
-N_DOMS = 18
-N_ABS = 3
-DOMS = range(N_DOMS + 1)
-DUS = kp.hardware.Detector(det_id=detid).dus
-DUS_cycle = list(np.arange(max(DUS)) + 1)
-
-TIT = 600  # Time Interval between Trains of acoustic pulses)
-SSW = 160  # Signal Security Window (Window size with signal)
-
-clbmap = km3db.CLBMap(detid)
-
-check = True
-while check:
-
-    minrun = None
-    while minrun is None:
-        try:
-            table = sds.runs(detid=detid)
-            minrun = table["RUN"][len(table["RUN"]) - 1]
-            ind, = np.where((table["RUN"] == minrun))
-            mintime1 = table['UNIXSTARTTIME'][ind]
-            mintime = mintime1.values
-            maxrun = table["RUN"][len(table["RUN"]) - 1]
-            now = time.time()
-            now = now - TIT
-            if (now - mintime / 1000) < TIT:
-                minrun = table["RUN"][len(table["RUN"]) - 1] - 1
-            print(now)
-        except:
-            pass
-        
-    N_Pulses_Indicator = [
-    ]  # Matrix indicating how many pulses each piezo reveals
-    for du in DUS_cycle:
-        N_Pulses_Indicator_DU = [
-        ]  # Array indicating for each DU how many pulses each piezo reveals.
-        for dom in DOMS:
-            UTB_MIN = []
-            QF_MAX = []
-
-            n = -1            
-            for ab in ACOUSTIC_BEACONS:
-                n = n + 1
-                try:
-                    domID = clbmap.omkeys[(du, dom)].dom_id
-                    
-                    AcBe = sds.toashort(detid=detid,
-                        minrun=minrun,
-                        domid=domID,
-                        maxrun=maxrun)      
-                
-                    ACOUSTIC_BEACONS_TEMP = np.unique(AcBe["EMITTERID"]).tolist()
-                    if np.size(ACOUSTIC_BEACONS_TEMP) < 3:
-                        while np.size(ACOUSTIC_BEACONS_TEMP) < 3:
-                            ACOUSTIC_BEACONS_TEMP.append(0)
-                    ACOUSTIC_BEACONS_TEMP_2 = np.sort(np.abs(ACOUSTIC_BEACONS_TEMP))
-                    m = np.where(np.abs(ACOUSTIC_BEACONS_TEMP) == ACOUSTIC_BEACONS_TEMP_2[n])[0][0]
-                    ab = ACOUSTIC_BEACONS_TEMP[m]
-                    print(ab)
-                    
-                except (KeyError, AttributeError, TypeError):
-                    N_Pulses_Indicator_DU.append(-1.5)
-                    continue
-                
-                try:
-                    toas_all = sds.toashort(detid=detid,
-                                            minrun=minrun,
-                                            maxrun=maxrun,
-                                            domid=domID,
-                                            emitterid=ab)
-                    QF_abdom = toas_all["QUALITYFACTOR"]
-                    UTB_abdom = toas_all["UNIXTIMEBASE"]
-                    TOAS_abdom = toas_all["TOA_S"]
-                    UTB_abdom = UTB_abdom.values
-                    up = np.where(UTB_abdom > (now - TIT))
-                    down = np.where(UTB_abdom < (now))
-                    intr = np.intersect1d(up, down)
-                    UTB_abdom = UTB_abdom[intr]
-                    QF_abdom = QF_abdom[intr]
-                    QF_abdom = QF_abdom.values
-                    QFlist = QF_abdom.tolist()
-                    QFlist.sort(reverse=True)
-                    QF_max = max(QF_abdom)
-                    QF_max_index = np.where(QF_abdom == QF_max)
-                    UTB_signal_min = UTB_abdom[QF_max_index[0][0]] - SSW / 2
-                    UTB_signal_max = UTB_abdom[QF_max_index[0][0]] + SSW / 2
-                    temp1 = np.where(UTB_abdom > (UTB_signal_min))
-                    temp2 = np.where(UTB_abdom < (UTB_signal_max))
-                    inter = np.intersect1d(temp1, temp2)
-                    inter = inter.tolist()
-                    signal_index = inter
-
-                    # Define the signal index if the the pings are splitted in two parts inside the window
-
-                    if UTB_signal_min < (now - TIT):
-                        temp1 = np.where(UTB_abdom > (now - TIT))
-                        temp2 = np.where(UTB_abdom < (UTB_signal_max))
-                        inter1 = np.intersect1d(temp1, temp2)
-                        inter1 = inter1.tolist()
-                        temp11 = np.where(UTB_abdom < (now))
-                        temp22 = np.where(UTB_abdom > (now - SSW / 2))
-                        inter2 = np.intersect1d(temp11, temp22)
-                        inter2 = inter2.tolist()
-                        inter = np.union1d(inter1, inter2)
-                        inter = inter.tolist()
-                        signal_index = inter
-                        signal_index = np.array(signal_index)
-                        signal_index = signal_index.astype(int)
-                        signal_index = signal_index.tolist()
-
-                    if UTB_signal_max > now:
-                        temp1 = np.where(UTB_abdom < (now))
-                        temp2 = np.where(UTB_abdom > (UTB_signal_min))
-                        inter1 = np.intersect1d(temp1, temp2)
-                        inter1 = inter1.tolist()
-                        temp11 = np.where(UTB_abdom > ((now - TIT)))
-                        temp22 = np.where(UTB_abdom < ((now - TIT) + SSW / 2))
-                        inter2 = np.intersect1d(temp11, temp22)
-                        inter2 = inter2.tolist()
-                        inter = np.union1d(inter1, inter2)
-                        inter = inter.tolist()
-                        signal_index = inter
-                        signal_index = np.array(signal_index)
-                        signal_index = signal_index.astype(int)
-                        signal_index = signal_index.tolist()
-
-                    QF_abdom_index = np.where(QF_abdom)
-                    all_data_index = QF_abdom_index[0].tolist()
-                    noise_index = diff(all_data_index, signal_index)
-                    SIGNAL = QF_abdom[signal_index]
-                    UTB_SIGNAL = UTB_abdom[signal_index]
-                    TOA_SIGNAL = TOAS_abdom[signal_index]
-                    UNIX_TOA_SIGNAL = UTB_abdom[signal_index] + TOAS_abdom[signal_index]
-                    if len(noise_index) != 0:
-                        NOISE = QF_abdom[noise_index]
-                        NOISElist = NOISE.tolist()
-                        NOISElist.sort(reverse=True)
-                        NOISE = NOISE.tolist()
-                        NOISE.sort(reverse=True)
-                        noise_threshold = max(
-                            NOISE)  # To be sure not to take signal
-
-                    # First filter: 22 greatest
-
-                    Security_Number = len(SIGNAL)  # To be sure to take all the pulses
-
-                    SIGNAL = SIGNAL.tolist()
-                    SIGNAL_OLD = np.array(SIGNAL)
-                    SIGNAL.sort(reverse=True)
-                    QF_first = SIGNAL[0:Security_Number]
-
-                    # Second filter: delete duplicates (Delete if Unixtimebase + ToA is the same)
-
-                    QF_second = QF_first
-
-                    R = []
-                    for r in np.arange(len(QF_first)):
-                        R.append(np.where(SIGNAL_OLD == QF_first[r])[0][0])
-                    UTB_first = np.array(UTB_SIGNAL.tolist())[R]
-                    TOA_first = np.array(TOA_SIGNAL.tolist())[R]
-
-                    UNIX_TOA = UTB_first + TOA_first
-                    UNIX_TOA = UNIX_TOA.tolist()
-
-                    UNIX_TOA_index = []
-                    for x in set(UNIX_TOA):
-                        if UNIX_TOA.count(x) > 1:
-                            UNIX_TOA_index.append(duplicates(UNIX_TOA, x))
-
-                    ind_del = []
-                    for i in range(len(UNIX_TOA_index)):
-                        ind_del.append(UNIX_TOA_index[i][0])
-
-                    for ide in sorted(ind_del, reverse=True):
-                        del QF_second[ide]
-
-                    QF_second.sort(reverse=True)
-
-                    # Third filter: If there are more than 11 elements I will eliminate the worst
-
-                    if len(QF_second) > 11:
-                        QF_second = np.array(QF_second)
-                        QF_third = [
-                            k for k in QF_second
-                            if (np.where(QF_second == k)[0][0] < 11)
-                        ]
-                    else:
-                        QF_third = QF_second
-
-                    # Fourth filter: I remove the data if it is below the maximum noise
-                    if len(noise_index) != 0:
-                        QF_fourth = [
-                            k for k in QF_third
-                            if k > (noise_threshold + (10 * np.std(NOISE)))
-                        ]
-                    else:
-                        QF_fourth = QF_third
-
-                    # Fifth filter: Check if the clicks are interspersed in the right way
-
-                    QF_fifth = QF_fourth
-                    Q = []
-                    for q in np.arange(len(QF_fifth)):
-                        Q.append(np.where(SIGNAL_OLD == QF_fifth[q])[0][0])
-                    UTB_fourth = np.array(UTB_SIGNAL.tolist())[Q]
-                    UTB_fourth_l = UTB_fourth.tolist()
-                    D = []
-                    for g in np.arange(len(UTB_fourth_l)):
-                        if ((np.mod((UTB_fourth_l[g] - UTB_fourth_l[0]), 5) > 2
-                             and np.mod(
-                                 (UTB_fourth_l[g] - UTB_fourth_l[0]), 5) < 4)
-                                or
-                            (np.mod(
-                                (UTB_fourth_l[g] - UTB_fourth_l[0]), 5) > 5)
-                            ):
-                            D.append(g)
-                    for d in sorted(D, reverse=True):
-                        del QF_fifth[d]
-
-                    # Sixth filter:
-                    if len(noise_index) != 0:
-                        QF_sixth = [
-                            k for k in QF_fifth
-                            if (2*abs(k - max(QF_fifth)) < abs(k - noise_threshold))
-                        ]
-                    else:
-                        QF_sixth = QF_fifth
-
-                    QF_OK = QF_sixth
-
-                    P = []
-                    for p in np.arange(len(QF_OK)):
-                        P.append(np.where(SIGNAL_OLD == QF_OK[p])[0][0])
-                    UTB_OK = np.array(UTB_SIGNAL.tolist())[P]
-                    UTB_OK_l = UTB_OK.tolist()
+    A single query for the whole detector is tried first. If that is not
+    possible, the DOMs are queried concurrently.
 
-                    UTB_MIN.append(min(UTB_OK_l))
+    Returns
+    -------
+    (dict(dom_id: DataFrame), set(dom_ids which could not be queried))
 
-                    max_QF = max(QF_OK)
+    """
+    try:
+        toas = sds.toashort(detid=detid, minrun=minrun, maxrun=maxrun)
+    except DB_ERRORS + (KeyError, TypeError, ValueError) as e:
+        print("Unable to retrieve the TOAs of the whole detector: {}".format(e))
+    else:
+        if toas is not None and "DOMID" in toas:
+            toas_per_dom = {
+                dom_id: dom_toas.reset_index(drop=True)
+                for dom_id, dom_toas in toas.groupby("DOMID")
+            }
+            return {d: toas_per_dom[d]
+                    for d in dom_ids if d in toas_per_dom}, set()
 
-                    QF_MAX.append(max_QF)
+    print("Querying the TOAs of {} DOMs with {} threads".format(
+        len(dom_ids), n_workers))
 
-                    NUM = len(QF_OK)  # Number of pulses
-                    print(NUM)
+    failure = object()
 
-                    if (NUM > 7):
-                        N_Pulses_Indicator_DU.append(1.5)
-                    elif (NUM < 8 and NUM > 3):
-                        N_Pulses_Indicator_DU.append(0.5)
-                    elif (NUM < 4 and NUM > 0):
-                        N_Pulses_Indicator_DU.append(-0.5)
-                    elif (NUM == 0):
-                        N_Pulses_Indicator_DU.append(-1.5)
-
-                except (
-                        TypeError, ValueError, http.client.RemoteDisconnected, ssl.SSLError
-                ):  # TypeError if no data found for a certain piezo, ValueError if there are zero data for a certain piezo
-                    N_Pulses_Indicator_DU.append(-1.5)
-                except (
-                        http.client.RemoteDisconnected, ssl.SSLError
-                ):  # Bad connection to the DB
-                    N_Pulses_Indicator_DU.append(-2.5)                    
+    def query(dom_id):
+        try:
+            return sds.toashort(detid=detid,
+                                minrun=minrun,
+                                maxrun=maxrun,
+                                domid=dom_id)
+        except DB_ERRORS as e:
+            print("Unable to retrieve the TOAs of DOM {}: {}".format(
+                dom_id, e))
+            return failure
+
+    toas_per_dom = {}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for dom_id, toas in zip(dom_ids, executor.map(query, dom_ids)):
+            if toas is failure:
+                failed.add(dom_id)
+            elif toas is not None:
+                toas_per_dom[dom_id] = toas
+    return toas_per_dom, failed
 
-            # To avoid to take wrong beacon signals
 
-            dim = np.size(QF_MAX)
-            pulse_inter = 5.04872989654541
+TIT = 600  # Time Interval between Trains of acoustic pulses)
+SSW = 160  # Signal Security Window (Window size with signal)
+PULSE_INTERVAL = 5.04872989654541
 
-            for i in range(dim - 1):
+N_DOMS = 18
+N_BEACONS = 3
+DOMS = range(N_DOMS + 1)
 
-                if (np.mod((UTB_MIN[i] - UTB_MIN[i + 1]), pulse_inter) < 10**-3
-                        or np.mod(
-                            (UTB_MIN[i] - UTB_MIN[i + 1]), pulse_inter) > 5):
-                    if QF_MAX[i] <= QF_MAX[i + 1]:
-                        N_Pulses_Indicator_DU[3 * dom + i] = -1.5
+NO_DB_CONNECTION = -1
+
+
+def _same_train(utb_a, utb_b):
+    """Check if two pings belong to the same train of pulses"""
+    offset = np.mod(utb_a - utb_b, PULSE_INTERVAL)
+    return offset < 10**-3 or offset > 5
+
+
+def count_pings(du_toas, dom_ids, db_failures, now):
+    """Count the pings of each beacon detected by the DOMs of a DU.
+
+    Parameters
+    ----------
+    du_toas: pd.DataFrame or None
+        The TOAs of the DU.
+    dom_ids: list(int or None)
+        The DOM ID of each floor, ``None`` if there is no DOM.
+    db_failures: set(int)
+        The DOM IDs for which the DB could not be queried.
+    now: float
+        The end of the analysed time window.
+
+    Returns
+    -------
+    np.array(int8) [floors, beacons]
+        The number of pings, ``NO_DB_CONNECTION`` if the TOAs of the DOM
+        could not be retrieved.
+
+    """
+    counts = np.zeros((len(dom_ids), N_BEACONS), dtype=np.int8)
+    pings = {}
+    if du_toas is not None:
+        pings = select_pings(du_toas, now, TIT, SSW)
+    emitters = {}
+    for dom_id, emitter_id in pings:
+        emitters.setdefault(dom_id, []).append(emitter_id)
+
+    for floor, dom_id in enumerate(dom_ids):
+        if dom_id is None:
+            continue
+        if dom_id in db_failures:
+            counts[floor] = NO_DB_CONNECTION
+            continue
+        if dom_id not in emitters:
+            continue
+
+        # The beacons are identified by the absolute values of the emitter IDs
+        beacons = sorted(emitters[dom_id])
+        beacons += [0] * (N_BEACONS - len(beacons))
+        abs_beacons = np.abs(beacons)
+        sorted_abs_beacons = np.sort(abs_beacons)
+
+        utb_min = []
+        qf_max = []
+        for n in range(N_BEACONS):
+            emitter_id = beacons[np.where(
+                abs_beacons == sorted_abs_beacons[n])[0][0]]
+            n_pings, utb, qf = pings.get((dom_id, emitter_id), (0, None, None))
+            if n_pings == 0:
+                continue
+            utb_min.append(utb)
+            qf_max.append(qf)
+            counts[floor, n] = min(n_pings, np.iinfo(np.int8).max)
+
+        # To avoid to take wrong beacon signals
+        dim = len(qf_max)
+        for i in range(dim - 1):
+            if _same_train(utb_min[i], utb_min[i + 1]):
+                if qf_max[i] <= qf_max[i + 1]:
+                    counts[floor, i] = 0
+                else:
+                    counts[floor, i + 1] = 0
+            if i == 0 and dim == 3:
+                if _same_train(utb_min[i], utb_min[i + 2]):
+                    if qf_max[i] <= qf_max[i + 2]:
+                        counts[floor, i] = 0
                     else:
-                        N_Pulses_Indicator_DU[3 * dom + i + 1] = -1.5
-                if i == 0 and dim == 3:
-                    if (np.mod(
-                        (UTB_MIN[i] -
-                         UTB_MIN[i + 2]), pulse_inter) < 10**-3 or np.mod(
-                             (UTB_MIN[i] - UTB_MIN[i + 2]), pulse_inter) > 5):
-                        if QF_MAX[i] <= QF_MAX[i + 2]:
-                            N_Pulses_Indicator_DU[3 * dom + i] = -1.5
-                        else:
-                            N_Pulses_Indicator_DU[3 * dom + i + 2] = -1.5
-                        
-
-        N_Pulses_Indicator.append(N_Pulses_Indicator_DU)
+                        counts[floor, i + 2] = 0
+    return counts
+
+
+def _count_pings(args):
+    return count_pings(*args)
+
+
+class PingCountStore:
+    """Time-indexed ping counts (DU x floor x beacon) in a binary file.
+
+    Every cycle is appended as a record of the UNIX time (float64) and the
+    int8 ping counts. The shape of the count matrices is part of the file
+    name, so that a changed detector starts a new file.
+
+    """
+    def __init__(self, path, det_id, shape):
+        self.shape = tuple(shape)
+        self.filename = os.path.join(
+            path, "acoustics_ping_counts_{}_{}.bin".format(
+                det_id, 'x'.join(str(n) for n in self.shape)))
+        self.dtype = np.dtype([('time', '<f8'), ('counts', 'i1', self.shape)])
+
+    def append(self, timestamp, counts):
+        record = np.zeros(1, dtype=self.dtype)
+        record['time'] = timestamp
+        record['counts'] = counts
+        with open(self.filename, 'ab') as fobj:
+            # Drop an incomplete record of an interrupted write
+            fobj.truncate(fobj.tell() - fobj.tell() % self.dtype.itemsize)
+            record.tofile(fobj)
+
+    def _records(self):
+        if not os.path.exists(self.filename):
+            return np.zeros(0, dtype=self.dtype)
+        n_records = os.path.getsize(self.filename) // self.dtype.itemsize
+        if n_records == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.filename,
+                         dtype=self.dtype,
+                         mode='r',
+                         shape=(n_records, ))
+
+    def query(self, start=None, end=None):
+        """Return the times and counts of the cycles in [start, end)"""
+        records = self._records()
+        times = records['time']
+        lower = 0 if start is None else np.searchsorted(times, start)
+        upper = len(times) if end is None else np.searchsorted(times, end)
+        return (np.array(times[lower:upper]),
+                np.array(records['counts'][lower:upper]))
+
+    def latest(self):
+        """Return the time and counts of the last cycle"""
+        records = self._records()
+        if len(records) == 0:
+            return None
+        return float(records['time'][-1]), np.array(records['counts'][-1])
+
+
+def ping_indicator(counts):
+    """Map the ping counts to the categories of the monitoring plot"""
+    indicator = np.full(counts.shape, -1.5)
+    indicator[counts > 0] = -0.5
+    indicator[counts > 3] = 0.5
+    indicator[counts > 7] = 1.5
+    indicator[counts == NO_DB_CONNECTION] = -2.5
+    return indicator
+
+
+def plot_ping_counts(counts, dus, timestamp, filename):
+    """Plot the ping counts of all DUs, floors and beacons"""
+    indicator = ping_indicator(counts)
 
     fig, ax = plt.subplots(figsize=(9, 7))
 
-    duab = []
-    DUs = []
-    for du in DUS_cycle:
-        duabdu = []
-        duab1 = (du - 0.2) * np.ones(N_DOMS + 1)
-        duab2 = (du) * np.ones(N_DOMS + 1)
-        duab3 = (du + 0.2) * np.ones(N_DOMS + 1)
-        duabdu.append(duab1)
-        duabdu.append(duab2)
-        duabdu.append(duab3)
-        duab.append(duabdu)
-        DUs.append(np.array(N_Pulses_Indicator[du - 1]))
-
-    iAB1 = []
-    iAB2 = []
-    iAB3 = []
-    for i in DOMS:
-        iAB1.append(3 * i)
-        iAB2.append(3 * i + 1)
-        iAB3.append(3 * i + 2)
-
     colorsList = [(0.6, 0, 1), (0, 0, 0), (1, 0.3, 0), (1, 1, 0), (0.2, 0.9, 0)]
     CustomCmap = matplotlib.colors.ListedColormap(colorsList)
     bounds = [-3, -2, -1, 0, 1, 2]
     norma = colors.BoundaryNorm(bounds, CustomCmap.N)
-    for du in DUS:
-        color = ax.scatter(duab[du - 1][0],
-                           DOMS,
-                           s=20,
-                           c=DUs[du - 1][iAB1],
-                           norm=norma,
-                           marker='s',
-                           cmap=CustomCmap)
-        color = ax.scatter(duab[du - 1][1],
-                           DOMS,
-                           s=20,
-                           c=DUs[du - 1][iAB2],
-                           norm=norma,
-                           marker='s',
-                           cmap=CustomCmap)
-        color = ax.scatter(duab[du - 1][2],
-                           DOMS,
-                           s=20,
-                           c=DUs[du - 1][iAB3],
-                           norm=norma,
-                           marker='s',
-                           cmap=CustomCmap)
+    for du in dus:
+        for beacon, offset in enumerate((-0.2, 0, 0.2)):
+            color = ax.scatter((du + offset) * np.ones(N_DOMS + 1),
+                               DOMS,
+                               s=20,
+                               c=indicator[du - 1, :, beacon],
+                               norm=norma,
+                               marker='s',
+                               cmap=CustomCmap)
 
     cbar = plt.colorbar(color)
     cbar.ax.get_yaxis().set_ticks([])
@@ -400,28 +303,176 @@ while check:
         cbar.ax.text(4, (1.5 * j + 1) / 8.0, lab, ha='center', va='center')
     cbar.ax.get_yaxis().labelpad = 18
 
-    ax.set_xticks(np.arange(1, max(DUS) + 1, step=1))
+    ax.set_xticks(np.arange(1, max(dus) + 1, step=1))
     ax.set_yticks(np.arange(0, 19, step=1))
     ax.grid(color='k', linestyle='-', linewidth=0.2)
     ax.set_xlabel('DUs', fontsize=18)
     ax.set_ylabel('Floors', fontsize=18)
-    ts = now
-    DATE = datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+    DATE = datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
     ax.set_title(
         r' %.16s Detection of the pings emitted by autonomous beacons' % DATE,
         fontsize=10)
 
-    my_path = os.path.abspath(directory)
-    my_file = 'Online_Acoustic_Monitoring.png'
-
-    fig.savefig(os.path.join(my_path, my_file))
+    fig.savefig(filename)
     plt.close('all')
-    
-    print(time.time())
 
-    check = False
-    check_time = time.time() - now - TIT
-    print(check_time)
 
-    time.sleep(abs(TIT - check_time))
-    check = True
+class AcousticMonitor(kp.Module):
+    """Checks the detection of the acoustic beacon pings on every DOM.
+
+    Every ``TIT`` seconds, the new TOAs are added to the local TOA store and
+    the pings of the last ``TIT`` seconds are counted, with the DUs spread
+    over a process pool. The ping counts are appended to the
+    ``PingCountStore`` and the monitoring plot is rendered from it.
+
+    """
+    def configure(self):
+        self.det_id = self.require('det_id')
+        self.plots_path = self.require('plots_path')
+        self.sds = self.require('sds')
+        data_path = self.get('data_path', default='/data')
+        self.n_threads = self.get('n_threads', default=8)
+        n_processes = self.get('n_processes', default=4)
+        self.retention = self.get('retention', default=24) * 60 * 60
+        self.offline_time = self.get('offline_time', default=None)
+
+        self.dus = kp.hardware.Detector(det_id=self.det_id).dus
+        clbmap = km3db.CLBMap(self.det_id)
+        self.dom_ids = [[
+            clbmap.omkeys[(du, dom)].dom_id
+            if (du, dom) in clbmap.omkeys else None for dom in DOMS
+        ] for du in range(1, max(self.dus) + 1)]
+
+        self.pool = None
+        if n_processes > 0:
+            self.pool = Pool(n_processes)
+
+        self.toa_store = TOAStore(
+            os.path.join(data_path, "acoustics_toas.sqlite3"))
+        self.ping_counts = PingCountStore(
+            data_path, self.det_id,
+            (len(self.dom_ids), N_DOMS + 1, N_BEACONS))
+
+    def process(self, blob):
+        cycle_start = time.time()
+        if self.offline_time is not None:
+            now = self.offline_time
+            minrun, maxrun = self.toa_store.run_range(now - TIT, now)
+            if minrun is None:
+                self.log.error("No TOAs in the local store before %s", now)
+                raise StopIteration
+            counts = self.count_pings(now, minrun, maxrun, set())
+            plot_ping_counts(counts, self.dus, now, self._plot_filename())
+            raise StopIteration
+
+        now, minrun, maxrun = self._run_range()
+        db_failures = self.update_toa_store(now, minrun, maxrun)
+        counts = self.count_pings(now, minrun, maxrun, db_failures)
+        self.ping_counts.append(now, counts)
+        self.create_plot()
+
+        cycle_time = time.time() - cycle_start
+        self.cprint("Acoustic monitoring cycle took {:.1f}s".format(
+            cycle_time))
+        time.sleep(max(0, TIT - cycle_time))
+        return blob
+
+    def _run_range(self):
+        """Determine the end of the time window and the runs covering it"""
+        while True:
+            try:
+                table = self.sds.runs(detid=self.det_id)
+                maxrun = table["RUN"][len(table["RUN"]) - 1]
+                mintime = table['UNIXSTARTTIME'][len(table["RUN"]) - 1]
+            except (KeyError, TypeError) + DB_ERRORS as e:
+                self.log.error("Unable to retrieve the run table: %s", e)
+                time.sleep(10)
+                continue
+            now = time.time() - TIT
+            minrun = maxrun
+            if (now - mintime / 1000) < TIT:
+                minrun = maxrun - 1
+            return now, minrun, maxrun
+
+    def update_toa_store(self, now, minrun, maxrun):
+        """Add the new TOAs to the store, returns the DOMs which failed"""
+        dom_ids = [d for du_dom_ids in self.dom_ids for d in du_dom_ids
+                   if d is not None]
+        db_failures = set()
+        # Only the runs which have not ended when they were fetched before
+        for run in range(minrun, maxrun + 1):
+            if self.toa_store.is_complete(run):
+                continue
+            start = time.time()
+            toas, failed = fetch_toas(self.sds, self.det_id, run, run,
+                                      dom_ids, self.n_threads)
+            n_new = 0
+            if toas:
+                n_new = self.toa_store.add(run, pd.concat(toas.values()))
+            self.cprint("Added {} new TOAs of run {} in {:.1f}s".format(
+                n_new, run, time.time() - start))
+            db_failures |= failed
+            if run < maxrun and not failed:
+                self.toa_store.set_complete(run)
+        self.toa_store.prune(now - TIT - self.retention)
+        return db_failures
+
+    def count_pings(self, now, minrun, maxrun, db_failures):
+        """Count the pings of all DUs, floors and beacons"""
+        toas = self.toa_store.toas(minrun, maxrun)
+        tasks = []
+        for du_dom_ids in self.dom_ids:
+            du_toas = [toas[d] for d in du_dom_ids if d in toas]
+            tasks.append((pd.concat(du_toas) if du_toas else None,
+                          du_dom_ids, db_failures, now))
+        if self.pool is None:
+            return np.array([_count_pings(task) for task in tasks])
+        return np.array(self.pool.map(_count_pings, tasks))
+
+    def _plot_filename(self):
+        return os.path.join(os.path.abspath(self.plots_path),
+                            'Online_Acoustic_Monitoring.png')
+
+    def create_plot(self):
+        latest = self.ping_counts.latest()
+        if latest is None:
+            return
+        timestamp, counts = latest
+        plot_ping_counts(counts, self.dus, timestamp, self._plot_filename())
+
+    def finish(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def main():
+    args = docopt(__doc__)
+
+    try:
+        detid = int(args['-d'])
+    except ValueError:
+        detid = (args['-d'])
+    if type(detid)==int:
+        detid = km3db.tools.todetoid(detid)
+
+    if args['-r'] is not None:
+        sds = RecordedStreamDS(args['-r'])
+    else:
+        sds = km3db.StreamDS(container="pd")
+
+    pipe = kp.Pipeline()
+    pipe.attach(AcousticMonitor,
+                det_id=detid,
+                sds=sds,
+                plots_path=args['-o'],
+                data_path=args['-s'],
+                n_threads=int(args['-w']),
+                n_processes=int(args['-n']),
+                retention=float(args['-k']),
+                offline_time=None if args['-t'] is None else float(args['-t']))
+    pipe.drain()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,10 +18,9 @@ Options:
 """
 from __future__ import division
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from collections import deque, defaultdict
-from functools import partial
-import io
+import json
 import os
 import time
 import threading
@@ -38,11 +37,335 @@ register_matplotlib_converters()
 
 import km3db
 import km3pipe as kp
-from km3pipe.io.daq import TMCHData
-from km3modules.ahrs import fit_ahrs, get_latest_ahrs_calibration
+from km3modules.ahrs import get_latest_ahrs_calibration
+from ligier_fanout import LigierFanoutPump
+from tmch import decode_tmch
 import km3pipe.style
 km3pipe.style.use('km3pipe')
 
+AHRS_PARAMETERS = ('yaw', 'pitch', 'roll')
+
+log = kp.logger.get_logger("AHRScalibration")
+
+
+def fit_ahrs_batch(A, H, Aoff, Arot, Hoff, Hrot):
+    """Calculate yaw, pitch and roll for many frames at once.
+
+    Vectorised version of ``km3modules.ahrs.fit_ahrs``, every frame comes
+    with its own calibration set.
+
+    Parameters
+    ----------
+    A, H: np.array [N, 3]
+        Acceleration and magnetic field vectors.
+    Aoff, Hoff: np.array [N, 3]
+        Acceleration and magnetic field vector offsets.
+    Arot, Hrot: np.array [N, 3, 3]
+        Acceleration and magnetic field vector rotation matrices.
+
+    Returns
+    -------
+    yaw, pitch, roll: np.array [N] in degrees
+
+    """
+    Acal = np.einsum('ni,nij->nj', A - Aoff, Arot)
+    Hcal = np.einsum('ni,nij->nj', H - Hoff, Hrot)
+
+    # invert axis for DOM upside down
+    Acal[:, 1:] = -Acal[:, 1:]
+    Hcal[:, 1:] = -Hcal[:, 1:]
+
+    roll = np.arctan2(-Acal[:, 1], -Acal[:, 2])
+    pitch = np.arctan2(Acal[:, 0], np.sqrt(Acal[:, 1]**2 + Acal[:, 2]**2))
+    sin_roll, cos_roll = np.sin(roll), np.cos(roll)
+    sin_pitch, cos_pitch = np.sin(pitch), np.cos(pitch)
+    yaw = np.arctan2(
+        Hcal[:, 2] * sin_roll - Hcal[:, 1] * cos_roll,
+        Hcal[:, 0] * cos_pitch + Hcal[:, 1] * sin_pitch * sin_roll +
+        Hcal[:, 2] * sin_pitch * cos_roll)
+
+    yaw = np.degrees(yaw)
+    yaw[yaw < 0] += 360
+    return yaw, np.degrees(pitch), np.degrees(roll)
+
+
+class AHRSCalibrationCache:
+    """Cache of the latest AHRS calibrations per CLB UPI with a TTL.
+
+    Calibrations are retrieved from the DB in background threads. An
+    expired calibration is still returned while it is being refreshed, a
+    missing one is counted as a miss and ``None`` is returned.
+
+    """
+    def __init__(self, ttl=60 * 60, max_version=4, n_threads=4):
+        self.ttl = ttl
+        self.max_version = max_version
+        self.hits = 0
+        self.misses = 0
+        self._calibrations = {}  # upi -> (calib, time of retrieval)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+
+    def warm_up(self, upis):
+        """Retrieve the calibrations of the given CLBs in the background"""
+        for upi in upis:
+            self._request(upi)
+
+    def get(self, upi):
+        with self._lock:
+            entry = self._calibrations.get(upi)
+        if entry is None:
+            self.misses += 1
+            self._request(upi)
+            return None
+        self.hits += 1
+        calib, retrieved = entry
+        if time.time() - retrieved > self.ttl:
+            self._request(upi)
+        return calib
+
+    def _request(self, upi):
+        with self._lock:
+            if upi in self._pending:
+                return
+            self._pending.add(upi)
+        self._executor.submit(self._retrieve, upi)
+
+    def _retrieve(self, upi):
+        try:
+            calib = get_latest_ahrs_calibration(upi,
+                                                max_version=self.max_version)
+        except Exception as e:
+            log.error("Unable to retrieve the AHRS calibration of CLB "
+                      "UPI '%s': %s", upi, e)
+            with self._lock:
+                self._pending.discard(upi)
+            return
+        if calib is None:
+            log.warning("No calibration found for CLB UPI '%s'", upi)
+        with self._lock:
+            self._calibrations[upi] = (calib, time.time())
+            self._pending.discard(upi)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def downsample(times, values, start, end, n_bins, circular=False):
+    """Reduce a time series to the mean, min and max in equal time bins.
+
+    Parameters
+    ----------
+    times: np.array [N]
+        Sorted UNIX times.
+    values: np.array [N, M]
+    start, end: float
+        The time range.
+    n_bins: int
+    circular: bool
+        The values are angles in degrees (0..360) and the circular mean is
+        calculated.
+
+    Returns
+    -------
+    (bin_times [K], mean [K, M], min [K, M], max [K, M]) of the K bins which
+    contain data.
+
+    """
+    selected = (times >= start) & (times < end)
+    times = times[selected]
+    values = values[selected]
+    bins = ((times - start) / (end - start) * n_bins).astype(int)
+    if len(bins) == 0:
+        empty = np.zeros((0, values.shape[1]))
+        return np.zeros(0), empty, empty, empty
+    first = np.flatnonzero(np.diff(bins, prepend=-1))
+    valid = ~np.isnan(values)
+    counts = np.add.reduceat(valid, first)
+    if circular:
+        radians = np.radians(np.where(valid, values, 0))
+        sin = np.add.reduceat(np.where(valid, np.sin(radians), 0), first)
+        cos = np.add.reduceat(np.where(valid, np.cos(radians), 0), first)
+        mean = np.where(counts > 0,
+                        np.mod(np.degrees(np.arctan2(sin, cos)), 360),
+                        np.nan)
+    else:
+        with np.errstate(invalid='ignore'):
+            mean = np.add.reduceat(np.where(valid, values, 0), first) / counts
+    bin_times = start + (bins[first] + 0.5) * (end - start) / n_bins
+    return (bin_times, mean, np.fmin.reduceat(values, first),
+            np.fmax.reduceat(values, first))
+
+
+class AHRSHistory:
+    """Ring buffer of the AHRS parameters of the floors of a DU.
+
+    Every time bin of ``interval`` seconds is stored as one row with the
+    start time of the bin (float64) and the mean yaw, pitch and roll
+    (float32) of each floor, NaN for floors without data. All batches of
+    frames within a bin are merged into its row. If a ``path`` is given, the
+    buffers are memory-mapped files in that directory, so the history
+    survives a restart.
+
+    Parameters
+    ----------
+    n_floors: int
+    n_rows: int
+        Number of time bins to keep.
+    interval: float
+        The length of a time bin in seconds.
+    path: str or None
+        Directory to persist the history.
+
+    """
+    def __init__(self, n_floors, n_rows, interval, path=None):
+        self.n_floors = n_floors
+        self.n_rows = n_rows
+        self.interval = interval
+        meta = dict(n_floors=n_floors, n_rows=n_rows, interval=interval)
+        if path is None:
+            self.times = np.full(n_rows, np.nan)
+            self.values = {
+                p: np.full((n_rows, n_floors), np.nan, dtype=np.float32)
+                for p in AHRS_PARAMETERS
+            }
+        elif self._load(path, meta):
+            log.warning("Restored the AHRS history from %s", path)
+        else:
+            self._create(path, meta)
+        self._reset_bin()
+        self.head = 0  # the row of the current bin
+        self.current_bin = None
+        if not np.all(np.isnan(self.times)):
+            self.head = int(np.nanargmax(self.times))
+            self.current_bin = int(self.times[self.head] // interval)
+            self._seed_bin()
+
+    def _reset_bin(self):
+        """Clear the sums of the current bin"""
+        self.counts = np.zeros(self.n_floors)
+        self.sums = {p: np.zeros(self.n_floors) for p in ('pitch', 'roll')}
+        self.sin = np.zeros(self.n_floors)
+        self.cos = np.zeros(self.n_floors)
+
+    def _seed_bin(self):
+        """Continue the restored latest bin, its means count as one frame"""
+        has_data = ~np.isnan(self.values['pitch'][self.head])
+        self.counts[has_data] = 1
+        for param in self.sums:
+            self.sums[param][has_data] = self.values[param][self.head][
+                has_data]
+        radians = np.radians(self.values['yaw'][self.head][has_data])
+        self.sin[has_data] = np.sin(radians)
+        self.cos[has_data] = np.cos(radians)
+
+    def _filenames(self, path):
+        return [os.path.join(path, "meta.json"),
+                os.path.join(path, "times.npy")] + \
+            [os.path.join(path, p + ".npy") for p in AHRS_PARAMETERS]
+
+    def _load(self, path, meta):
+        """Attach to the persisted history if it matches the configuration"""
+        meta_file, times_file, *values_files = self._filenames(path)
+        if not os.path.exists(meta_file):
+            return False
+        try:
+            with open(meta_file) as fobj:
+                if json.load(fobj) != meta:
+                    log.warning("AHRS history configuration changed, "
+                                "discarding the data in %s", path)
+                    return False
+            self.times = np.lib.format.open_memmap(times_file, mode='r+')
+            self.values = {
+                p: np.lib.format.open_memmap(f, mode='r+')
+                for p, f in zip(AHRS_PARAMETERS, values_files)
+            }
+        except (OSError, ValueError) as e:
+            log.error("Could not load the AHRS history: %s", e)
+            return False
+        return True
+
+    def _create(self, path, meta):
+        os.makedirs(path, exist_ok=True)
+        meta_file, times_file, *values_files = self._filenames(path)
+        self.times = np.lib.format.open_memmap(times_file,
+                                               mode='w+',
+                                               dtype=np.float64,
+                                               shape=(self.n_rows, ))
+        self.times[:] = np.nan
+        self.values = {}
+        for p, f in zip(AHRS_PARAMETERS, values_files):
+            self.values[p] = np.lib.format.open_memmap(
+                f,
+                mode='w+',
+                dtype=np.float32,
+                shape=(self.n_rows, self.n_floors))
+            self.values[p][:] = np.nan
+        with open(meta_file, 'w') as fobj:
+            json.dump(meta, fobj)
+
+    def add(self, timestamp, floors, yaw, pitch, roll):
+        """Add a batch of frames to the row of its time bin
+
+        Batches which are older than the current bin are merged into it.
+
+        Parameters
+        ----------
+        timestamp: float
+        floors: array(int)
+            The floor (starting at 1) of each frame.
+        yaw, pitch, roll: array(float)
+
+        """
+        time_bin = int(timestamp // self.interval)
+        if self.current_bin is None:
+            self.current_bin = time_bin
+        elif time_bin > self.current_bin:
+            self.head = (self.head + 1) % self.n_rows
+            self.current_bin = time_bin
+            self._reset_bin()
+
+        idx = floors - 1
+        self.counts += np.bincount(idx, minlength=self.n_floors)
+        for param, values in (('pitch', pitch), ('roll', roll)):
+            self.sums[param] += np.bincount(idx,
+                                            weights=values,
+                                            minlength=self.n_floors)
+        radians = np.radians(yaw)
+        self.sin += np.bincount(idx,
+                                weights=np.sin(radians),
+                                minlength=self.n_floors)
+        self.cos += np.bincount(idx,
+                                weights=np.cos(radians),
+                                minlength=self.n_floors)
+
+        has_data = self.counts > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for param in self.sums:
+                self.values[param][self.head] = np.where(
+                    has_data, self.sums[param] / self.counts, np.nan)
+        self.values['yaw'][self.head] = np.where(
+            has_data,
+            np.mod(np.degrees(np.arctan2(self.sin, self.cos)), 360), np.nan)
+        self.times[self.head] = self.current_bin * self.interval
+
+    def view(self):
+        """The times and values in chronological order (copies)"""
+        oldest = (self.head + 1) % self.n_rows
+        order = np.r_[oldest:self.n_rows, 0:oldest]
+        times = self.times[order]
+        valid = ~np.isnan(times)
+        return times[valid], {
+            p: self.values[p][order][valid]
+            for p in AHRS_PARAMETERS
+        }
+
+    def flush(self):
+        for array in [self.times] + list(self.values.values()):
+            if isinstance(array, np.memmap):
+                array.flush()
+
 
 class CalibrateAHRS(kp.Module):
     def configure(self):
@@ -54,59 +377,97 @@ class CalibrateAHRS(kp.Module):
         self.dus = set()
 
         self.clbmap = km3db.CLBMap(det_oid=det_oid)
+        self.n_floors = max(clb.floor for clb in self.clbmap.upis.values())
 
         self.cuckoo = kp.time.Cuckoo(60, self.create_plot)
         self.cuckoo_log = kp.time.Cuckoo(10, self.cprint)
 
-        self.data = {}
-        self.queue_size = 100000
-
         self.lock = threading.Lock()
-        self.index = 0
+        self.batch_size = self.get('batch_size', default=1000)
+        self.batch_interval = self.get('batch_interval', default=5)  # s
+
+        self.history = {}
+        self.history_path = self.get('history_path',
+                                     default='/data/ahrs_history')
+        self.history_size = int(self.time_range * 60 * 60 /
+                                self.batch_interval)
+        self.payloads = []
+        self.batch_start = time.time()
+
+        self.calibrations = AHRSCalibrationCache(
+            ttl=self.get('calibration_ttl', default=60 * 60))
+        self.calibrations.warm_up(clb.upi for clb in self.clbmap.upis.values()
+                                  if clb.floor != 0)
+        self.cuckoo_stats = kp.time.Cuckoo(300, self._print_cache_stats)
 
     def _register_du(self, du):
-        """Create data cache for DU"""
-        self.data[du] = {}
-        for ahrs_param in ('yaw', 'pitch', 'roll'):
-            self.data[du][ahrs_param] = defaultdict(
-                partial(deque, maxlen=self.queue_size))
-        self.data[du]['times'] = defaultdict(
-            partial(deque, maxlen=self.queue_size))
+        """Create the AHRS history of a DU"""
+        path = None
+        if self.history_path is not None:
+            path = os.path.join(self.history_path, "du{}".format(du))
+        self.history[du] = AHRSHistory(self.n_floors, self.history_size,
+                                       self.batch_interval, path)
         self.dus.add(du)
 
+    def _print_cache_stats(self):
+        self.cprint("AHRS calibration cache hits: {}, misses: {}".format(
+            self.calibrations.hits, self.calibrations.misses))
+
     def process(self, blob):
-        self.index += 1
-        if self.index % 29 != 0:
-            return blob
-        now = datetime.utcnow()
-        tmch_data = TMCHData(io.BytesIO(blob['CHData']))
-        dom_id = tmch_data.dom_id
-        clb = self.clbmap.dom_ids[dom_id]
-        if clb.floor == 0:
-            self.log.info("Skipping base CLB")
-            return blob
-
-        yaw = tmch_data.yaw
-        calib = get_latest_ahrs_calibration(clb.upi, max_version=4)
+        if not self.payloads:
+            self.batch_start = time.time()
+        self.payloads.append(blob['CHData'])
+        if len(self.payloads) >= self.batch_size or \
+                time.time() - self.batch_start > self.batch_interval:
+            self.process_payloads()
+        return blob
 
-        if calib is None:
-            self.log.warning("No calibration found for CLB UPI '%s'", clb.upi)
-            return blob
+    def process_payloads(self):
+        """Decode the collected frames and fit the AHRS data in one go"""
+        tmch_data = decode_tmch(self.payloads)
+        self.payloads = []
+        frames = []
+        clbs = []
+        calibs = []
+        for i, dom_id in enumerate(tmch_data.dom_id):
+            clb = self.clbmap.dom_ids[int(dom_id)]
+            if clb.floor == 0:
+                self.log.debug("Skipping base CLB")
+                continue
+
+            calib = self.calibrations.get(clb.upi)
+            if calib is None:
+                continue
+
+            frames.append(i)
+            clbs.append(clb)
+            calibs.append(calib)
+
+        if not frames:
+            return
 
-        du = clb.du
-        if du not in self.dus:
-            self._register_du(du)
-        cyaw, cpitch, croll = fit_ahrs(tmch_data.A, tmch_data.H, *calib)
+        Aoff, Arot, Hoff, Hrot = (np.array(p, dtype=np.float64)
+                                  for p in zip(*calibs))
+        yaw, pitch, roll = fit_ahrs_batch(tmch_data.A[frames],
+                                          tmch_data.H[frames], Aoff, Arot,
+                                          Hoff, Hrot)
         self.cuckoo_log("DU{}-DOM{} (random pick): calibrated yaw={}".format(
-            clb.du, clb.floor, cyaw))
+            clbs[0].du, clbs[0].floor, yaw[0]))
+
+        timestamp = float(np.max(tmch_data.utc_seconds[frames]))
+        dus = np.array([clb.du for clb in clbs])
+        floors = np.array([clb.floor for clb in clbs])
         with self.lock:
-            self.data[du]['yaw'][clb.floor].append(cyaw)
-            self.data[du]['pitch'][clb.floor].append(cpitch)
-            self.data[du]['roll'][clb.floor].append(croll)
-            self.data[du]['times'][clb.floor].append(now)
+            for du in np.unique(dus):
+                if du not in self.dus:
+                    self._register_du(du)
+                selected = dus == du
+                self.history[du].add(timestamp, floors[selected],
+                                     yaw[selected], pitch[selected],
+                                     roll[selected])
 
         self.cuckoo.msg()
-        return blob
+        self.cuckoo_stats()
 
     def create_plot(self):
         self.cprint(self.__class__.__name__ + ": updating plot.")
@@ -114,26 +475,45 @@ class CalibrateAHRS(kp.Module):
             xfmt = md.DateFormatter('%Y-%m-%d %H:%M')
         else:
             xfmt = md.DateFormatter('%H:%M')
-        xlim = (datetime.utcfromtimestamp(time.time() -
-                                          self.time_range * 60 * 60),
-                datetime.utcnow())
-        for du in self.dus:
-            data = self.data[du]
-            for ahrs_param in data.keys():
+        end = time.time()
+        start = end - self.time_range * 60 * 60
+        xlim = (datetime.utcfromtimestamp(start),
+                datetime.utcfromtimestamp(end))
+        for du in sorted(self.dus):
+            with self.lock:
+                times, values = self.history[du].view()
+                self.history[du].flush()
+            for ahrs_param in AHRS_PARAMETERS:
                 fig, ax = plt.subplots(figsize=(16, 6))
+                n_bins = int(fig.get_figwidth() * fig.dpi)
+                bin_times, mean, lower, upper = downsample(
+                    times,
+                    values[ahrs_param],
+                    start,
+                    end,
+                    n_bins,
+                    circular=ahrs_param == 'yaw')
+                dates = [datetime.utcfromtimestamp(t) for t in bin_times]
                 sns.set_palette("husl", 18)
                 ax.set_title("AHRS {} Calibration on DU{}\n{}".format(
                     ahrs_param, du, datetime.utcnow()))
                 ax.set_xlabel("UTC time")
                 ax.xaxis.set_major_formatter(xfmt)
                 ax.set_ylabel(ahrs_param)
-                with self.lock:
-                    for floor in sorted(data[ahrs_param].keys()):
-                        ax.plot(data['times'][floor],
-                                data[ahrs_param][floor],
-                                marker='.',
-                                linestyle='none',
-                                label="Floor {}".format(floor))
+                for floor in range(mean.shape[1]):
+                    if np.all(np.isnan(mean[:, floor])):
+                        continue
+                    line, = ax.plot(dates,
+                                    mean[:, floor],
+                                    marker='.',
+                                    linestyle='none',
+                                    label="Floor {}".format(floor + 1))
+                    ax.fill_between(dates,
+                                    lower[:, floor],
+                                    upper[:, floor],
+                                    color=line.get_color(),
+                                    alpha=0.2,
+                                    linewidth=0)
                 ax.set_xlim(xlim)
                 lgd = plt.legend(bbox_to_anchor=(1.005, 1),
                                  loc=2,
@@ -146,6 +526,9 @@ class CalibrateAHRS(kp.Module):
                             bbox_inches='tight')
                 plt.close('all')
 
+    def finish(self):
+        self.calibrations.shutdown()
+
 
 def main():
     from docopt import docopt
@@ -157,7 +540,7 @@ def main():
     ligier_port = int(args['-p'])
 
     pipe = kp.Pipeline()
-    pipe.attach(kp.io.ch.CHPump,
+    pipe.attach(LigierFanoutPump,
                 host=ligier_ip,
                 port=ligier_port,
                 tags='IO_MONIT',
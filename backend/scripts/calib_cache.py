@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: calib_cache.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Cache for the detector calibrations, keyed by run.
+
+The calibrations are retrieved from the database in background threads and
+stored as DETX files, so that neither a run change nor a restart blocks the
+processing while the database is queried or unreachable.
+
+"""
+from collections import OrderedDict
+import os
+import threading
+import time
+from urllib.error import URLError
+
+import km3pipe as kp
+
+log = kp.logger.get_logger("calib_cache")
+
+
+class CalibrationCache:
+    """Non-blocking access to the calibrations of a detector.
+
+    ``get(run)`` returns immediately. If the calibration of the requested run
+    is not available yet, it is retrieved in the background (from the disk
+    cache or the database) and the last good calibration is returned in the
+    meantime. While a run is calibrated, the calibration of the next run is
+    prefetched, retried every ``retry_interval`` until it is available.
+    Failed prefetches do not delay the request of the run once it starts.
+    Prefetched calibrations are kept in memory only and are refreshed from
+    the database when their run starts.
+
+    Parameters
+    ----------
+    det_id: int
+        The detector ID.
+    path: str
+        The directory of the DETX files.
+    retry_interval: int
+        Seconds to wait before retrying a failed database request.
+    max_entries: int
+        The number of calibrations kept in memory.
+
+    """
+    def __init__(self,
+                 det_id,
+                 path="/data/calibration",
+                 retry_interval=60,
+                 max_entries=5):
+        self.det_id = det_id
+        self.path = path
+        self.retry_interval = retry_interval
+        self.max_entries = max_entries
+        self._calibrations = OrderedDict()  # run -> (calib, prefetched)
+        self._pending = set()
+        self._failed = {}  # run -> time of the last failed request
+        self._failed_prefetches = {}  # run -> time of the last failed prefetch
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._last_good = self._load_latest()
+
+    def get(self, run):
+        """Return ``(run, calibration)`` or ``None`` if nothing is available.
+
+        The returned run differs from the requested one if the calibration
+        of the requested run is still being retrieved.
+
+        """
+        with self._lock:
+            entry = self._calibrations.get(run)
+            if entry is not None:
+                self._calibrations.move_to_end(run)
+            last_good = self._last_good
+            prefetch = run + 1 not in self._calibrations
+        if entry is None:
+            self._request(run)
+            return last_good
+        calib, prefetched = entry
+        if prefetched:
+            self._request(run)
+        elif prefetch:
+            self._request(run + 1, prefetch=True)
+        return run, calib
+
+    def _filename(self, run):
+        return os.path.join(self.path,
+                            "{:08d}_{:08d}.detx".format(self.det_id, run))
+
+    def _load(self, run):
+        try:
+            return kp.calib.Calibration(filename=self._filename(run))
+        except (OSError, ValueError, IndexError) as e:
+            log.error("Unable to read the cached calibration of run %d: %s",
+                      run, e)
+            return None
+
+    def _load_latest(self):
+        """Load the cached calibration with the highest run number"""
+        prefix = "{:08d}_".format(self.det_id)
+        runs = []
+        for filename in os.listdir(self.path):
+            if filename.startswith(prefix) and filename.endswith(".detx"):
+                try:
+                    runs.append(int(filename[len(prefix):-len(".detx")]))
+                except ValueError:
+                    continue
+        for run in sorted(runs, reverse=True):
+            calib = self._load(run)
+            if calib is not None:
+                log.info("Using the cached calibration of run %d", run)
+                return run, calib
+        return None
+
+    def _save(self, run, calib):
+        filename = self._filename(run)
+        try:
+            calib.detector.write(filename + ".tmp")
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            log.error("Unable to cache the calibration of run %d: %s", run, e)
+
+    def _request(self, run, prefetch=False):
+        """Retrieve a calibration in a background thread"""
+        failed = self._failed_prefetches if prefetch else self._failed
+        with self._lock:
+            if run in self._pending:
+                return
+            if time.time() - failed.get(run, 0) < self.retry_interval:
+                return
+            self._pending.add(run)
+        threading.Thread(target=self._fetch, args=(run, prefetch),
+                         daemon=True).start()
+
+    def _fetch(self, run, prefetch):
+        failed = self._failed_prefetches if prefetch else self._failed
+        calib = None
+        try:
+            calib = self._retrieve(run, prefetch)
+        except Exception:
+            log.exception("Unexpected error while retrieving the calibration "
+                          "of run %d, retrying in %ds", run,
+                          self.retry_interval)
+        finally:
+            with self._lock:
+                self._pending.discard(run)
+                if calib is None:
+                    failed[run] = time.time()
+        if calib is None:
+            return
+
+        with self._lock:
+            self._failed.pop(run, None)
+            self._failed_prefetches.pop(run, None)
+            self._calibrations[run] = (calib, prefetch)
+            self._calibrations.move_to_end(run)
+            while len(self._calibrations) > self.max_entries:
+                self._calibrations.popitem(last=False)
+            if not prefetch and (self._last_good is None
+                                 or run >= self._last_good[0]):
+                self._last_good = (run, calib)
+        if not prefetch:
+            log.info("Calibration of run %d is available", run)
+
+    def _retrieve(self, run, prefetch):
+        """Load a calibration from the disk cache or the database"""
+        calib = None
+        persist = False
+        if not prefetch and os.path.exists(self._filename(run)):
+            calib = self._load(run)
+        if calib is None:
+            try:
+                calib = kp.calib.Calibration(det_id=self.det_id, run=run)
+            except IndexError:
+                if not prefetch:
+                    log.error(
+                        "Unusable (probably empty) DETX received from the "
+                        "database for run %d, falling back to the base DETX "
+                        "without any calibration and retrying at run change.",
+                        run)
+                    calib = self._fetch_base(run)
+            except URLError as e:
+                log.error(
+                    "Unable to retrieve the calibration of run %d, no "
+                    "connection to the DB, retrying in %ds...\n%s", run,
+                    self.retry_interval, e)
+            else:
+                persist = not prefetch
+        if persist:
+            self._save(run, calib)
+        return calib
+
+    def _fetch_base(self, run):
+        try:
+            return kp.calib.Calibration(det_id=self.det_id)
+        except URLError as e:
+            log.error("Unable to retrieve the base DETX for run %d: %s", run,
+                      e)
+            return None
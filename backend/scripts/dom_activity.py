@@ -20,18 +20,19 @@ Options:
 """
 from __future__ import division
 
-from collections import deque, defaultdict
-from functools import partial
 from io import BytesIO
 import os
 import time
 
+import numpy as np
 import matplotlib
 matplotlib.use("Agg")
 
 import km3pipe as kp
 import km3pipe.style
 from km3modules.plot import plot_dom_parameters
+from ligier_fanout import LigierFanoutPump
+from summaryslice import decode_summaryslice, DOMRows
 
 VERSION = "1.0"
 
@@ -45,26 +46,23 @@ class DOMActivityPlotter(kp.Module):
         self.plots_path = self.require('plots_path')
         det_id = self.require('det_id')
         self.detector = kp.hardware.Detector(det_id=det_id)
-        self.index = 0
-        self.last_activity = defaultdict(partial(deque, maxlen=4000))
+        self.dom_rows = DOMRows(self.detector)
+        self.last_activity = np.zeros(len(self.dom_rows))  # 0: never seen
         self.cuckoo = kp.time.Cuckoo(60, self.create_plot)
 
         self.log.warning("Starting DOM Activity monitor")
 
     def process(self, blob):
-        self.index += 1
-        if self.index % 30:
+        try:
+            summaryslice = decode_summaryslice(blob['CHData'])
+        except ValueError as e:
+            self.log.error("Skipping corrupt summary slice: %s", e)
             return blob
 
-        if 'RawSummaryslice' in blob:
-            summaryslice = blob['RawSummaryslice']
-            timestamp = summaryslice.header.time_stamp
+        rows = self.dom_rows.rows(summaryslice.dom_ids)
+        self.last_activity[rows[rows >= 0]] = summaryslice.utc_seconds
 
-            for dom_id, _ in summaryslice.summary_frames.items():
-                du, dom, _ = self.detector.doms[dom_id]
-                self.last_activity[(du, dom)] = timestamp
-
-            self.cuckoo.msg()
+        self.cuckoo.msg()
 
         return blob
 
@@ -73,13 +71,10 @@ class DOMActivityPlotter(kp.Module):
         filename = os.path.join(self.plots_path, 'dom_activity.png')
         # now = kp.time.tai_timestamp()
         now = time.time()
-        delta_ts = {}
-        inactive_doms = {}
-        for key, timestamp in self.last_activity.items():
-            delta_t = now - timestamp
-            delta_ts[key] = delta_t
-            if delta_t > 300:
-                inactive_doms[key] = delta_t
+        seen = self.last_activity > 0
+        delta_t = now - self.last_activity
+        delta_ts = self.dom_rows.to_dict(delta_t, seen)
+        inactive_doms = self.dom_rows.to_dict(delta_t, seen & (delta_t > 300))
         if inactive_doms:
             msg = "WARNING: the following DOM(s) has been inactive:\n"
             for key, delta_t in inactive_doms.items():
@@ -108,13 +103,12 @@ def main():
 
     pipe = kp.Pipeline()
     pipe.attach(
-        kp.io.ch.CHPump,
+        LigierFanoutPump,
         host=ligier_ip,
         port=ligier_port,
         tags='IO_SUM',
         timeout=60 * 60 * 24 * 7,
         max_queue=2000)
-    pipe.attach(kp.io.daq.DAQProcessor)
     pipe.attach(DOMActivityPlotter, det_id=det_id, plots_path=plots_path)
     pipe.drain()
 
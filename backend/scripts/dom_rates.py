@@ -15,6 +15,7 @@ Options:
     -p LIGIER_PORT  The port of the ligier [default: 5553].
     -d DET_ID       Detector ID [default: 29].
     -o PLOT_DIR     The directory to save the plot [default: /plots].
+    -s DATA_DIR     The directory of the rate history [default: /data].
     -h --help       Show this screen.
 
 """
@@ -30,6 +31,9 @@ matplotlib.use("Agg")
 import km3pipe as kp
 import km3pipe.style
 from km3modules.plot import plot_dom_parameters
+from ligier_fanout import LigierFanoutPump
+from rate_history import RateHistoryWriter
+from summaryslice import decode_summaryslice, DOMRows
 
 VERSION = "1.0"
 km3pipe.style.use('km3pipe')
@@ -45,35 +49,52 @@ class DOMRates(kp.Module):
         self.highest_rate = self.get("highest_rate", default=400)
 
         self.detector = kp.hardware.Detector(det_id=det_id)
-        self.index = 0
+        self.dom_rows = DOMRows(self.detector)
         self.k40_2fold = {}
         self.rates = {}
+        self.rate_sum = np.zeros(len(self.dom_rows))
+        self.n_samples = np.zeros(len(self.dom_rows), dtype=np.int64)
         self.cuckoo = kp.time.Cuckoo(60, self.create_plot)
         self.n_slices = 0
 
         self.log.warning("Starting DOM rates monitor")
 
     def process(self, blob):
-        """Store the rates from summary slices"""
-        self.index += 1
-        if self.index % 30:
-            return blob
-
-        if 'RawSummaryslice' in blob:
-            summaryslice = blob['RawSummaryslice']
-            self.rates = {}  # TODO: review this hack
-            for dom_id, rates in summaryslice.summary_frames.items():
-                du, dom, _ = self.detector.doms[dom_id]
-                self.rates[(du, dom)] = np.sum(rates) / 1000
-
-            self.cuckoo.msg()
+        """Accumulate the DOM rates of every summary slice"""
+        try:
+            summaryslice = decode_summaryslice(blob['CHData'])
+        except ValueError as e:
+            self.log.error("Skipping corrupt summary slice: %s", e)
+            return
+        blob['Summaryslice'] = summaryslice
+
+        rows = self.dom_rows.rows(summaryslice.dom_ids)
+        known = rows >= 0
+        self.rate_sum += np.bincount(
+            rows[known],
+            weights=summaryslice.pmt_rates[known].sum(axis=1),
+            minlength=len(self.dom_rows))
+        self.n_samples += np.bincount(rows[known],
+                                      minlength=len(self.dom_rows))
+        self.n_slices += 1
+
+        self.cuckoo.msg()
 
         return blob
 
     def create_plot(self):
-        """Creates the actual plot"""
+        """Creates the actual plot with the mean rates since the last one"""
         self.cprint(self.__class__.__name__ + ": updating plot.")
 
+        seen = self.n_samples > 0
+        mean_rates = np.zeros(len(self.dom_rows))
+        mean_rates[seen] = self.rate_sum[seen] / self.n_samples[seen] / 1000
+        self.rates = self.dom_rows.to_dict(mean_rates, seen)
+        self.cprint("Mean rates of {} summary slices".format(self.n_slices))
+        self.rate_sum[:] = 0
+        self.n_samples[:] = 0
+        self.n_slices = 0
+
         filename = os.path.join(self.plots_path, 'dom_rates.png')
         plot_dom_parameters(
             self.rates,
@@ -96,19 +117,20 @@ def main():
 
     det_id = int(args['-d'])
     plots_path = args['-o']
+    data_path = args['-s']
     ligier_ip = args['-l']
     ligier_port = int(args['-p'])
 
     pipe = kp.Pipeline()
     pipe.attach(
-        kp.io.ch.CHPump,
+        LigierFanoutPump,
         host=ligier_ip,
         port=ligier_port,
         tags='IO_SUM',
         timeout=60 * 60 * 24 * 7,
         max_queue=2000)
-    pipe.attach(kp.io.daq.DAQProcessor)
     pipe.attach(DOMRates, det_id=det_id, plots_path=plots_path)
+    pipe.attach(RateHistoryWriter, det_id=det_id, data_path=data_path)
     pipe.drain()
 
 
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: ligier_fanout.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Subscribes once to the monitoring ligier and fans out the frames to the
+local monitoring processes via a shared memory ring buffer.
+
+The monitoring scripts attach the ``LigierFanoutPump`` instead of the
+``kp.io.ch.CHPump``. It accepts the same parameters and reads directly from
+the ligier until the fan-out ring buffer is available.
+
+Usage:
+    ligier_fanout.py [options]
+    ligier_fanout.py (-h | --help)
+
+Options:
+    -l LIGIER_IP    The IP of the ligier [default: 127.0.0.1].
+    -p LIGIER_PORT  The port of the ligier [default: 5553].
+    -t TAGS         The tags to subscribe [default: IO_EVT,IO_SUM,IO_MONIT,IO_TSSN].
+    -n RING_NAME    The name of the shared memory block [default: km3mon_ligier].
+    -s RING_SIZE    The size of the ring buffer in MB [default: 256].
+    -h --help       Show this screen.
+
+"""
+from multiprocessing import shared_memory, resource_tracker
+import os
+import socket
+import struct
+import time
+
+import km3pipe as kp
+
+VERSION = "1.0"
+RING_NAME = "km3mon_ligier"
+RECONNECT_INTERVAL = 10
+
+log = kp.logger.get_logger("ligier_fanout")
+
+
+class RingBufferOverrun(Exception):
+    """Raised when the writer has overwritten the frames of a reader"""
+
+
+class SharedRingBuffer:
+    """A single writer, multiple reader ring buffer in shared memory.
+
+    The header holds the subscribed tags, so that readers can check whether
+    their tags are served. Every frame is stored as a 16 byte record header
+    (payload length and the ControlHost tag) followed by the payload, padded
+    to 16 bytes. Positions are monotonically increasing byte offsets. The
+    writer reserves the space of a frame before writing it and commits it
+    afterwards, which allows the readers to detect when they have been
+    lapped while copying.
+
+    Parameters
+    ----------
+    name: str
+        The name of the shared memory block.
+    size: int or None
+        Size of the data region in bytes. If given, a new block is created,
+        otherwise an existing one is attached.
+    tags: list(str)
+        The tags written by the writer (only needed when creating).
+
+    """
+    # magic, instance, capacity, reserved and committed position
+    _header = struct.Struct("<QQQQQ")
+    _tags_offset = 64
+    _header_size = 512
+    _record = struct.Struct("<I4x8s")  # payload length, padding, tag
+    _magic = 0x6B6D336D6F6E0001
+    _wrap_marker = 0xFFFFFFFF
+    _alignment = 16
+
+    def __init__(self, name=RING_NAME, size=None, tags=()):
+        self.name = name
+        if size is None:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # Attaching registers the block at the resource tracker, which
+            # would unlink it when the reader exits (bpo-39959).
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            magic, self.instance, self.capacity, _, _ = \
+                self._header.unpack_from(self._shm.buf)
+            if magic != self._magic:
+                self._shm.close()
+                raise ValueError(
+                    "'{}' is not a fan-out ring buffer".format(name))
+            tags = bytes(self._shm.buf[self._tags_offset:self._header_size])
+            self.tags = set(tags.rstrip(b'\x00').decode().split(','))
+        else:
+            self.capacity = size - size % self._alignment
+            try:
+                self._shm = shared_memory.SharedMemory(
+                    name=name,
+                    create=True,
+                    size=self.capacity + self._header_size)
+            except FileExistsError:
+                log.warning("Removing stale ring buffer '%s'", name)
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                self._shm = shared_memory.SharedMemory(
+                    name=name,
+                    create=True,
+                    size=self.capacity + self._header_size)
+            self.instance = struct.unpack("<Q", os.urandom(8))[0]
+            self.tags = set(tags)
+            struct.pack_into(
+                "{}s".format(self._header_size - self._tags_offset),
+                self._shm.buf, self._tags_offset, ','.join(tags).encode())
+            self._header.pack_into(self._shm.buf, 0, self._magic,
+                                   self.instance, self.capacity, 0, 0)
+        self._buf = self._shm.buf[self._header_size:self._header_size +
+                                  self.capacity]
+
+    @property
+    def reserved(self):
+        return struct.unpack_from("<Q", self._shm.buf, 24)[0]
+
+    @property
+    def head(self):
+        """The position of the next frame to be committed"""
+        return struct.unpack_from("<Q", self._shm.buf, 32)[0]
+
+    def _record_size(self, length):
+        size = self._record.size + length
+        return size + (-size) % self._alignment
+
+    def put(self, tag, data):
+        """Write a frame (writer process only)"""
+        record_size = self._record_size(len(data))
+        if record_size > self.capacity:
+            raise ValueError("Frame of {} bytes does not fit into the ring "
+                             "buffer".format(len(data)))
+        position = self.head
+        offset = position % self.capacity
+        skip = 0
+        if offset + record_size > self.capacity:
+            skip = self.capacity - offset
+        struct.pack_into("<Q", self._shm.buf, 24,
+                         position + skip + record_size)
+        if skip:
+            self._record.pack_into(self._buf, offset, self._wrap_marker, b'')
+            position += skip
+            offset = 0
+        self._record.pack_into(self._buf, offset, len(data), tag.encode())
+        start = offset + self._record.size
+        self._buf[start:start + len(data)] = data
+        struct.pack_into("<Q", self._shm.buf, 32, position + record_size)
+
+    def read(self, position):
+        """Read the frame at a given position.
+
+        Returns
+        -------
+        (tag, data, next_position) or None if no new frame is available.
+
+        Raises
+        ------
+        RingBufferOverrun if the frame has already been overwritten.
+
+        """
+        while True:
+            if position >= self.head:
+                return None
+            if self.reserved - position > self.capacity:
+                raise RingBufferOverrun
+            offset = position % self.capacity
+            length, tag = self._record.unpack_from(self._buf, offset)
+            if length == self._wrap_marker:
+                position += self.capacity - offset
+                continue
+            start = offset + self._record.size
+            data = bytes(self._buf[start:start + length])
+            if self.reserved - position > self.capacity:
+                raise RingBufferOverrun
+            return (tag.rstrip(b'\x00').decode(), data,
+                    position + self._record_size(length))
+
+    def close(self):
+        self._buf.release()
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+def attach_ring_buffer(name=RING_NAME, timeout=0):
+    """Attach to an existing ring buffer, retrying until timeout [s]"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return SharedRingBuffer(name)
+        except (FileNotFoundError, ValueError):
+            if time.time() > deadline:
+                return None
+            time.sleep(1)
+
+
+class LigierFanoutPump(kp.Module):
+    """Drop-in replacement of the ``CHPump`` reading from ``ligier_fanout.py``.
+
+    Takes the same parameters as the ``CHPump``. If the ring buffer is not
+    available within ``attach_timeout`` seconds or it does not provide all
+    the requested tags, the frames are read from a direct ligier connection
+    instead. Attaching is retried every ``RECONNECT_INTERVAL`` seconds and
+    the direct connection is closed as soon as the ring buffer is available.
+
+    """
+    def configure(self):
+        self.host = self.get("host", default="127.0.0.1")
+        self.port = self.get("port", default=5553)
+        self.tags = self.get("tags", default="MSG")
+        self.timeout = self.get("timeout", default=60 * 60 * 24)
+        self.ring_name = self.get("ring_name", default=RING_NAME)
+        attach_timeout = self.get("attach_timeout", default=15)
+        self.poll_interval = self.get("poll_interval", default=0.002)
+
+        self._tags = set(t.strip() for t in self.tags.split(','))
+        self.n_frames = 0
+        self.n_overruns = 0
+        self.print_stats = kp.time.Cuckoo(60, self._print_stats)
+
+        self.client = None
+        self.last_attach = time.time()
+        self.ring = None
+        if not self._attach(attach_timeout):
+            self.log.error(
+                "The ligier fan-out ring buffer '%s' is not available, "
+                "reading directly from the ligier at %s:%s until it is",
+                self.ring_name, self.host, self.port)
+            self.client = connect(self.host, self.port, self._tags)
+
+    def _attach(self, timeout=0):
+        """Attach to the ring buffer, returns False if it is not usable"""
+        ring = attach_ring_buffer(self.ring_name, timeout)
+        if ring is None:
+            return False
+        if not self._tags <= ring.tags:
+            self.log.warning("The ligier fan-out does not provide %s",
+                             ','.join(self._tags - ring.tags))
+            ring.close()
+            return False
+        self.ring = ring
+        self.position = ring.head
+        self.cprint("Attached to the ligier fan-out ring buffer '{}' "
+                    "({} MB)".format(self.ring_name,
+                                     ring.capacity // 1024**2))
+        return True
+
+    def _attach_if_available(self):
+        """Switch from the direct ligier connection to the ring buffer"""
+        now = time.time()
+        if now - self.last_attach < RECONNECT_INTERVAL:
+            return
+        self.last_attach = now
+        if self._attach():
+            self.log.warning("Ligier fan-out is available, closing the "
+                             "direct ligier connection.")
+            self.client._disconnect()
+            self.client = None
+
+    def _print_stats(self):
+        self.cprint("Frames received: {}, ring buffer overruns: {}".format(
+            self.n_frames, self.n_overruns))
+        if self.client is not None:
+            self.log.error(
+                "Not attached to the ligier fan-out ring buffer '%s', "
+                "reading directly from the ligier at %s:%s", self.ring_name,
+                self.host, self.port)
+
+    def _reattach_if_restarted(self):
+        """Follow a restarted fan-out daemon which created a new block"""
+        ring = attach_ring_buffer(self.ring_name)
+        if ring is None or ring.instance == self.ring.instance:
+            if ring is not None:
+                ring.close()
+            return
+        self.log.warning("Ligier fan-out has been restarted, reattaching.")
+        self.ring.close()
+        self.ring = ring
+        self.position = ring.head
+
+    def _next_frame(self):
+        idle_since = time.time()
+        last_check = idle_since
+        while True:
+            try:
+                frame = self.ring.read(self.position)
+            except RingBufferOverrun:
+                self.n_overruns += 1
+                self.log.error("Too slow, the ring buffer overran the "
+                               "reader. Skipping to the latest frame.")
+                self.position = self.ring.head
+                continue
+            if frame is not None:
+                tag, data, self.position = frame
+                if tag in self._tags:
+                    return tag, data
+                continue
+            now = time.time()
+            if now - idle_since > self.timeout:
+                self.log.warning(
+                    "Ligier fan-out timeout ({}s) reached".format(
+                        self.timeout))
+                raise StopIteration("Ligier fan-out timeout reached.")
+            if now - last_check > RECONNECT_INTERVAL:
+                self._reattach_if_restarted()
+                last_check = now
+            time.sleep(self.poll_interval)
+
+    def _next_direct_frame(self):
+        while True:
+            try:
+                prefix, data = self.client.get_message()
+            except (ConnectionResetError, BrokenPipeError, socket.error,
+                    struct.error) as e:
+                self.log.error("Lost connection to the ligier: %s", e)
+                self.client._disconnect()
+                time.sleep(RECONNECT_INTERVAL)
+                self.client = connect(self.host, self.port, self._tags)
+                continue
+            return prefix, data
+
+    def process(self, blob):
+        if self.client is not None:
+            self._attach_if_available()
+        if self.client is not None:
+            prefix, data = self._next_direct_frame()
+        else:
+            tag, data = self._next_frame()
+            prefix = kp.controlhost.Prefix(tag, len(data))
+        self.n_frames += 1
+        self.print_stats()
+        blob["CHPrefix"] = prefix
+        blob["CHData"] = data
+        blob["CHOverruns"] = self.n_overruns
+        return blob
+
+    def finish(self):
+        if self.client is not None:
+            self.client._disconnect()
+        if self.ring is not None:
+            self.ring.close()
+
+
+def connect(ligier_ip, ligier_port, tags):
+    """Connect to the ligier, retrying until it succeeds"""
+    while True:
+        try:
+            client = kp.controlhost.Client(ligier_ip, port=ligier_port)
+            client._connect()
+            for tag in tags:
+                client.subscribe(tag, mode='any')
+        except (ConnectionRefusedError, socket.error) as e:
+            log.error("Unable to connect to the ligier: %s", e)
+            time.sleep(RECONNECT_INTERVAL)
+        else:
+            return client
+
+
+def main():
+    from docopt import docopt
+    args = docopt(__doc__, version=VERSION)
+
+    ligier_ip = args['-l']
+    ligier_port = int(args['-p'])
+    tags = [t.strip() for t in args['-t'].split(',')]
+    ring_name = args['-n']
+    ring_size = int(args['-s']) * 1024**2
+
+    ring = SharedRingBuffer(ring_name, size=ring_size, tags=tags)
+    log.warning("Fanning out %s from %s:%s via '%s' (%d MB)", ','.join(tags),
+                ligier_ip, ligier_port, ring_name, ring_size // 1024**2)
+
+    n_frames = 0
+    print_stats = kp.time.Cuckoo(
+        60, lambda: print("Frames fanned out: {}".format(n_frames)))
+    client = connect(ligier_ip, ligier_port, tags)
+    try:
+        while True:
+            try:
+                prefix, data = client.get_message()
+            except (ConnectionResetError, BrokenPipeError, socket.error,
+                    struct.error) as e:
+                log.error("Lost connection to the ligier: %s", e)
+                client._disconnect()
+                time.sleep(RECONNECT_INTERVAL)
+                client = connect(ligier_ip, ligier_port, tags)
+                continue
+            try:
+                ring.put(str(prefix.tag), data)
+            except ValueError as e:
+                log.error("Skipping frame: %s", e)
+                continue
+            n_frames += 1
+            print_stats()
+    finally:
+        client._disconnect()
+        ring.close()
+        ring.unlink()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ Options:
 from __future__ import division
 
 from datetime import datetime
-from collections import deque, defaultdict
+from collections import defaultdict
 import os
 import shutil
 import time
@@ -40,6 +40,7 @@ from km3pipe.hardware import Detector
 from km3pipe.io import CHPump
 from km3pipe.io.daq import (DAQProcessor, DAQPreamble, DAQSummaryslice,
                             DAQEvent)
+from ligier_fanout import LigierFanoutPump
 import km3pipe.style
 km3pipe.style.use('km3pipe')
 
@@ -63,19 +64,63 @@ class TriggerMap(Module):
 
         self.dus = sorted(self.det.dus)
         self.n_rows = self.det.n_doms
+        self._init_lookup()
 
         self.run = True
-        self.hits = deque(maxlen=self.max_events)
-        self.triggered_hits = deque(maxlen=self.max_events)
+        # every event is written twice (at head and head + max_events), so
+        # the latest events are always a contiguous slice
+        self.hits = np.zeros((self.n_rows, 2 * self.max_events),
+                             dtype=np.uint32)
+        self.triggered_hits = np.zeros_like(self.hits)
+        self.head = 0
         self.runchanges = defaultdict(int)
         self.current_run_id = 0
         self.n_events = 0
+        self.n_snapshots = 0
+        self.snapshot_time = 0
+        self.render_time = 0
+        self.max_lock_wait = 0
+        self.n_overruns = 0
 
         self.thread = threading.Thread(target=self.plot).start()
 
+    def _init_lookup(self):
+        """Create the sorted DOM ID -> matrix row lookup arrays"""
+        self.dom_ids = np.array(sorted(self.det.doms), dtype=np.int64)
+        self.dom_rows = np.empty(len(self.dom_ids), dtype=np.int64)
+        for i, dom_id in enumerate(self.dom_ids):
+            du, floor, _ = self.det.doms[dom_id]
+            self.dom_rows[i] = self.dus.index(du) * 18 + floor - 1
+
+    def _rows(self, dom_ids):
+        """Map DOM IDs to matrix rows, -1 for unknown DOM IDs"""
+        idx = np.searchsorted(self.dom_ids, dom_ids)
+        idx[idx == len(self.dom_ids)] = 0
+        return np.where(self.dom_ids[idx] == dom_ids, self.dom_rows[idx], -1)
+
     def process(self, blob):
         event_hits = blob['Hits']
+        # only provided by the LigierFanoutPump
+        self.n_overruns = blob.get('CHOverruns', 0)
+
+        rows = self._rows(np.asarray(event_hits.dom_id, dtype=np.int64))
+        valid = rows >= 0
+        if not np.all(valid):
+            fname = "IO_EVT_{}.dat".format(round(time.time(), 3))
+            with open(fname, "bw") as fobj:
+                fobj.write(blob["CHData"])
+            self.log.error(
+                "Invalid DOM ID: %s. Raw event data dump written to %s",
+                event_hits.dom_id[~valid][0], fname)
+        triggered = event_hits.triggered.astype('bool') & valid
+        hits = np.bincount(rows[valid], minlength=self.n_rows)
+        triggered_hits = np.bincount(rows[triggered], minlength=self.n_rows)
+
+        start = time.time()
         with lock:
+            lock_wait = time.time() - start
+            if lock_wait > self.max_lock_wait:
+                self.max_lock_wait = lock_wait
             run_id = blob['EventInfo'].run_id[0]
             if run_id > self.current_run_id:
                 self.cprint(f"New run: {run_id}")
@@ -90,52 +135,62 @@ class TriggerMap(Module):
 
             self.n_events += 1
 
-            hits = np.zeros(self.n_rows)
-            for dom_id in event_hits.dom_id:
-                if dom_id not in self.det.doms:
-                    fname = "IO_EVT_{}.dat".format(round(time.time(), 3))
-                    with open(fname, "bw") as fobj:
-                        fobj.write(blob["CHData"])
-                    self.log.error(
-                        "Invalid DOM ID: %s. Raw event data dump written to %s",
-                        dom_id, fname
-                    )
-                    break
-                du, floor, _ = self.det.doms[dom_id]
-                du_idx = self.dus.index(du)
-                hits[du_idx * 18 + floor - 1] += 1
-            self.hits.append(hits)
-            triggered_hits = np.zeros(self.n_rows)
-            for dom_id in event_hits.dom_id[event_hits.triggered.astype(
-                    'bool')]:
-                if dom_id not in self.det.doms:
-                    # we already check above
-                    break
-                du, floor, _ = self.det.doms[dom_id]
-                du_idx = self.dus.index(du)
-                triggered_hits[du_idx * 18 + floor - 1] += 1
-            self.triggered_hits.append(triggered_hits)
+            for column in (self.head, self.head + self.max_events):
+                self.hits[:, column] = hits
+                self.triggered_hits[:, column] = triggered_hits
+            self.head = (self.head + 1) % self.max_events
 
         return blob
 
     def plot(self):
         while self.run:
-            with lock:
-                self.create_plots()
+            self.create_plots()
             time.sleep(50)
 
+    def snapshot(self):
+        """Copy everything needed for the plots while holding the lock"""
+        start = time.time()
+        with lock:
+            snapshot = {
+                'hits': self._latest(self.hits).copy(),
+                'triggered_hits': self._latest(self.triggered_hits).copy(),
+                'runchanges': dict(self.runchanges),
+                'n_events': self.n_events,
+                'max_lock_wait': self.max_lock_wait,
+            }
+            self.max_lock_wait = 0
+        self.snapshot_time = time.time() - start
+        self.n_snapshots += 1
+        return snapshot
+
+    def _latest(self, buffer):
+        """View of the latest events in a buffer (oldest first)"""
+        n_events = min(self.n_events, self.max_events)
+        end = self.head + self.max_events
+        return buffer[:, end - n_events:end]
+
     def create_plots(self):
         self.cprint("Updating plots")
-        if len(self.hits) > 0:
-            self.create_plot(self.hits, "Hits on DOMs", 'hitmap')
-        if len(self.triggered_hits) > 0:
-            self.create_plot(self.triggered_hits, "Trigger Map", 'triggermap')
+        snapshot = self.snapshot()
+        start = time.time()
+        if snapshot['n_events'] > 0:
+            self.create_plot(snapshot['hits'], "Hits on DOMs", 'hitmap',
+                             snapshot)
+            self.create_plot(snapshot['triggered_hits'], "Trigger Map",
+                             'triggermap', snapshot)
+        self.render_time = time.time() - start
+        self.cprint(
+            "Snapshots: {}, last snapshot took {:.1f}ms, rendering {:.1f}s, "
+            "max. time an event waited for the lock: {:.1f}ms, "
+            "ring buffer overruns: {}".format(
+                self.n_snapshots, self.snapshot_time * 1000,
+                self.render_time, snapshot['max_lock_wait'] * 1000,
+                self.n_overruns))
 
-    def create_plot(self, hits, title, filename):
+    def create_plot(self, hit_matrix, title, filename, snapshot):
         fig, ax = plt.subplots(figsize=(16, 8))
         ax.grid(True)
         ax.set_axisbelow(True)
-        hit_matrix = np.array([np.array(x) for x in hits]).transpose()
         im = ax.matshow(
             hit_matrix,
             interpolation='nearest',
@@ -162,12 +217,12 @@ class TriggerMap(Module):
         cb = fig.colorbar(im, pad=0.05)
         cb.set_label("number of hits")
 
-        for run, n_events_since_runchange in self.runchanges.items():
+        for run, n_events_since_runchange in snapshot['runchanges'].items():
             if n_events_since_runchange >= self.max_events:
                 continue
             self.log.info("Annotating run {} ({} events passed)".format(
                 run, n_events_since_runchange))
-            x_pos = min(self.n_events,
+            x_pos = min(snapshot['n_events'],
                         self.max_events) - n_events_since_runchange
             plt.text(
                 x_pos,
@@ -211,7 +266,7 @@ def main():
 
     pipe = kp.Pipeline()
     pipe.attach(
-        kp.io.ch.CHPump,
+        LigierFanoutPump,
         host=ligier_ip,
         port=ligier_port,
         tags='IO_EVT',
@@ -5,39 +5,57 @@
 # vim: ts=4 sw=4 et
 import sys
 import re
+import gzip
+import json
+from collections import defaultdict
+from multiprocessing import Pool
 import numpy as np
 import matplotlib
 # Force matplotlib to not use any Xwindows backend.
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
-import datetime
 from datetime import datetime as dt
 from datetime import timezone as tz
 import time
 
-class Message:   
-    regexp = re.compile('(\w+.\w+)\s+\[(\w+)\]:\s+(.*)\s+(\d+\.\d+\.\d+\.\d+)\s+(\w+\/*\w+)\s+(\w+)\s+(.*)')
-
-    def __init__(self, msg):
-        self.matches = self.regexp.match(msg)
-        self.fields  = self.regexp.split(msg)
-    
-    def is_error(self):
-        return self.matches!=None and self.fields[6]=='ERROR'
-    def is_warning(self):
-        return self.matches!=None and self.fields[6]=='WARNING'
-    def get_process(self):
-        if (self.matches!=None):
-            return self.fields[2]
+LOG_DIR = '/logs/'
+LOG_FILE = 'MSG.log'
+STATE_FILE = 'log_analyser_state.json'
+POLL_INTERVAL = 5      # seconds between reading the new lines of the log
+PLOT_INTERVAL = 300    # seconds between updating the plot of the current log
+N_PROCESSES = 4        # for the log files which have not been analysed yet
+
+# groups: log file, process, ..., IP, ..., level, message
+LINE_PATTERN = re.compile(r'(\w+.\w+)\s+\[(\w+)\]:\s+(.*)\s+(\d+\.\d+\.\d+\.\d+)\s+(\w+\/*\w+)\s+(\w+)\s+(.*)')
+
+
+class LogStatistics:
+    """Error and warning counters per process"""
+
+    def __init__(self, errors=None, warnings=None):
+        self.errors   = defaultdict(int, errors   or {})
+        self.warnings = defaultdict(int, warnings or {})
+
+    def add_line(self, line):
+        match = LINE_PATTERN.match(line)
+        if match is None:
+            return
+        process, level = match.group(2, 6)
+        # both counters have the same keys, as required by the plot
+        self.errors  [process] += level == 'ERROR'
+        self.warnings[process] += level == 'WARNING'
+
+    def to_dict(self):
+        return dict(errors=dict(self.errors), warnings=dict(self.warnings))
 
 def plot_log_statistics(errors,warnings,title,output):
     err_keys = [k for k in sorted(errors  .keys() , key=str.casefold)]
     war_keys = [k for k in sorted(warnings.keys() , key=str.casefold)]
 
     if (err_keys != war_keys):
-        sys.exit("plot_log_statistics ERROR: Dictionaries with different keys") 
-        
+        sys.exit("plot_log_statistics ERROR: Dictionaries with different keys")
+
     x_labels = [str(k) for k in err_keys]
     x        = np.arange(len(x_labels))
     y_e      = [errors  [k] for k in err_keys ]
@@ -45,7 +63,7 @@ def plot_log_statistics(errors,warnings,title,output):
 
     fig = plt.figure()
     ax  = fig.add_subplot(111)
-    
+
     bar_width = 0.25
     err_plt   = ax.bar(            x, y_e, bar_width, color = 'r')
     war_plt   = ax.bar(x + bar_width, y_w, bar_width, color = 'b')
@@ -59,57 +77,171 @@ def plot_log_statistics(errors,warnings,title,output):
     ax.grid(True)
 
     plt.title(title)
-    plt.savefig(output)
+    plt.savefig(output + '.tmp.png')
     plt.close('all')
-    
-def seconds_to_UTC_midnight():    
-
-    tomorrow = dt.now(tz.utc) + datetime.timedelta(days=1)
-    midnight = dt(year=tomorrow.year, month=tomorrow.month, 
-                                 day=tomorrow.day, hour=0, minute=0, second=0, tzinfo=tz.utc)    
-    return (midnight - dt.now(tz.utc)).seconds
+    os.replace(output + '.tmp.png', output)
 
 def process_log_file(log_file,out_file):
 
-    warnings = {}
-    errors   = {}
+    stats = LogStatistics()
+
+    if log_file.endswith('.gz'):
+        f = gzip.open(log_file, 'rt', errors='replace')
+    else:
+        f = open(log_file, 'r', errors='replace')
+    with f:
+        for line in f:
+            stats.add_line(line)
+
+    print(f"{os.path.basename(log_file)}: Warnings: {dict(stats.warnings)}")
+    print(f"{os.path.basename(log_file)}: Errors: {dict(stats.errors)}")
+
+    title = os.path.basename(log_file)
+    plot_log_statistics(stats.errors,stats.warnings,title,out_file)
+
+
+class LogTailer:
+    """Follows the current log file and keeps running statistics.
+
+    The byte offset, the date and the statistics of the current log file are
+    persisted, so that a restart continues where it stopped. When the log
+    file is rotated by msg_dumper.py (renamed to MSG_<date>.log), the rest of
+    the old file is read and the plot of that day is created.
+
+    """
+
+    def __init__(self, log_dir):
+        self.log_dir    = log_dir
+        self.log_file   = os.path.join(log_dir, LOG_FILE)
+        self.state_file = os.path.join(log_dir, STATE_FILE)
+        self.f          = None
+        self.inode      = None
+        self.offset     = 0
+        self.date       = utc_date()
+        self.stats      = LogStatistics()
+        self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as fobj:
+                state = json.load(fobj)
+        except (OSError, ValueError):
+            return
+        self.inode  = state['inode']
+        self.offset = state['offset']
+        self.date   = state['date']
+        self.stats  = LogStatistics(state['errors'], state['warnings'])
+        print(f"Continuing {self.log_file} of {self.date} at byte {self.offset}")
+
+    def _save_state(self):
+        state = dict(inode=self.inode, offset=self.offset, date=self.date,
+                     **self.stats.to_dict())
+        with open(self.state_file + '.tmp', 'w') as fobj:
+            json.dump(state, fobj)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def _open(self):
+        try:
+            f = open(self.log_file, 'rb')
+        except FileNotFoundError:
+            return
+        inode = os.fstat(f.fileno()).st_ino
+        if inode == self.inode and self.date != utc_date():
+            # the state is from a previous day: the log file has been
+            # rotated in the meantime and its inode reused by the new one,
+            # or it has not been rotated at all. Either way, the file is
+            # counted from the start for the current day.
+            print(f"Discarding the state of {self.date}, counting "
+                  f"{self.log_file} from the start")
+            self.stats  = LogStatistics()
+            self.date   = utc_date()
+            self.offset = 0
+        if inode == self.inode and os.fstat(f.fileno()).st_size < self.offset:
+            self.offset = 0
+        if inode != self.inode:
+            # a new file, the persisted state belongs to a rotated one
+            if self.inode is not None:
+                self._finish_day()
+            self.inode  = inode
+            self.offset = 0
+        f.seek(self.offset)
+        self.f = f
+
+    def _read(self):
+        """Count the complete lines which have been appended"""
+        data = self.f.read()
+        end  = data.rfind(b'\n') + 1
+        for line in data[:end].decode(errors='replace').splitlines():
+            self.stats.add_line(line)
+        self.offset += end
+        self.f.seek(self.offset)
+
+    def _finish_day(self):
+        """Plot the statistics of the rotated log file and start a new day"""
+        basename = os.path.join(self.log_dir, 'MSG_' + self.date)
+        print(f"Finished {basename}.log: Warnings: {dict(self.stats.warnings)}")
+        print(f"Finished {basename}.log: Errors: {dict(self.stats.errors)}")
+        if not os.path.exists(basename + '.png'):
+            plot_log_statistics(self.stats.errors, self.stats.warnings,
+                                os.path.basename(basename) + '.log',
+                                basename + '.png')
+        self.stats = LogStatistics()
+        self.date  = utc_date()
+
+    def poll(self):
+        if self.f is None:
+            self._open()
+            if self.f is None:
+                return
+        self._read()
+        try:
+            rotated = os.stat(self.log_file).st_ino != self.inode
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self._read()
+            self.f.close()
+            self.f = None
+            self._open()
+            if self.f is not None:
+                self._read()
+        self._save_state()
+
+    def plot(self):
+        plot_log_statistics(self.stats.errors, self.stats.warnings,
+                            f"{LOG_FILE} ({self.date}, until {dt.now(tz.utc):%H:%M} UTC)",
+                            os.path.join(self.log_dir, 'MSG.png'))
+
+
+def utc_date():
+    return dt.now(tz.utc).strftime("%Y-%m-%d")
+
+def process_backlog(log_dir):
+    """Analyse the archived log files without a plot in parallel"""
+    regexp = r'^MSG_(.+)\.log(\.gz)?$'
+    jobs   = []
+    for file in sorted(os.listdir(log_dir)):
+        png_file = log_dir + file.split('.')[0] + '.png'
+        if (re.match(regexp,file) and (not os.path.exists(png_file))):
+            print ('processing ', log_dir + file)
+            jobs.append((log_dir + file, png_file))
+    if jobs:
+        with Pool(N_PROCESSES) as pool:
+            pool.starmap(process_log_file, jobs)
 
-    f = open(log_file, 'r')
-    for line in f.readlines():
-        msg = Message(line)
-        if (msg.matches!=None):
-            errors  [msg.get_process()] = errors  .get(msg.get_process(), 0) + 1 if msg.is_error()   else  errors  .get(msg.get_process(), 0)
-            warnings[msg.get_process()] = warnings.get(msg.get_process(), 0) + 1 if msg.is_warning() else  warnings.get(msg.get_process(), 0)
+def main():
 
-    print(f"Warnings: {warnings}")
-    print(f"Errors: {errors}")
-        
-    title = os.path.basename(f.name)        
-    plot_log_statistics(errors,warnings,title,out_file)
+    process_backlog(LOG_DIR)
 
-def main():
+    tailer    = LogTailer(LOG_DIR)
+    last_plot = 0
+    while True:
+        tailer.poll()
+        if time.time() - last_plot > PLOT_INTERVAL:
+            tailer.plot()
+            last_plot = time.time()
+        time.sleep(POLL_INTERVAL)
 
-    log_dir = '/logs/'
-    regexp  = '^MSG_(.+)\.log'
 
-    for file in os.listdir(log_dir):
-        if (re.match(regexp,file) and (not os.path.exists(log_dir + os.path.splitext(file)[0] + '.png'))):
-            print ('processing ', log_dir + file)
-            process_log_file(log_dir + file, log_dir + os.path.splitext(file)[0] + '.png')
-            
-    while True: 
-        basename = log_dir+'MSG_' + (dt.now(tz.utc) - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-        log_file = basename + '.log'
-        out_file = basename + '.png'
-        
-        if not os.path.exists(log_file):
-            time.sleep(60)
-            continue
-
-        print ('processing ', log_file)
-        process_log_file(log_file,out_file)
-        time.sleep(seconds_to_UTC_midnight() + 60)
-
-        
 if __name__ == '__main__':
     main()
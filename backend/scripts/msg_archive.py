@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: msg_archive.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Searches the MSG archive which is written by msg_dumper.py.
+
+The messages are stored in an SQLite database (in WAL mode, so that it can
+be queried while the dumper is writing), indexed by time, level, source
+and process.
+
+Usage:
+    msg_archive.py [options]
+    msg_archive.py (-h | --help)
+
+Options:
+    -f FILENAME     The archive [default: /logs/MSG.sqlite3].
+    -s START        Start time (UTC), e.g. "2021-05-05 12:00".
+    -e END          End time (UTC).
+    -c SOURCE       The source class, e.g. DataFilter.
+    -p PROCESS      The process.
+    -v LEVEL        The level, e.g. ERROR.
+    -t TEXT         Only messages containing this text.
+    -n LIMIT        Maximum number of messages [default: 1000].
+    -h --help       Show this screen.
+
+"""
+from collections import namedtuple
+import datetime
+import re
+import sqlite3
+
+MESSAGE_PATTERN = re.compile(
+    r'(.*?)\s*(\d+\.\d+\.\d+\.\d+)\s+(\w+/*\w+)\s+(\w+)\s+(.*)', re.DOTALL)
+
+Message = namedtuple(
+    "Message", ["time", "source", "process", "ip", "level", "text"])
+
+
+def parse_message(timestamp, source, data):
+    """Split a MSG into its fields.
+
+    Messages which do not follow the "... IP PROCESS LEVEL TEXT" format are
+    kept as a whole in ``text``.
+
+    """
+    match = MESSAGE_PATTERN.match(data)
+    if match is None:
+        return Message(timestamp, source, None, None, None, data)
+    _, ip, process, level, text = match.groups()
+    return Message(timestamp, source, process, ip, level, text)
+
+
+class MSGArchive:
+    """Append-only SQLite archive of the MSG stream.
+
+    Parameters
+    ----------
+    filename: str
+        The SQLite file, created if it does not exist.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS messages (
+                time REAL, source TEXT, process TEXT, ip TEXT, level TEXT,
+                text TEXT);
+            CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+            CREATE INDEX IF NOT EXISTS messages_level
+                ON messages (level, time);
+            CREATE INDEX IF NOT EXISTS messages_source
+                ON messages (source, time);
+            CREATE INDEX IF NOT EXISTS messages_process
+                ON messages (process, time);
+        """)
+
+    def add(self, messages):
+        """Add a list of ``Message``s in a single transaction"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO messages (time, source, process, ip, level, text)"
+                " VALUES (?, ?, ?, ?, ?, ?)", messages)
+
+    def query(self,
+              start=None,
+              end=None,
+              source=None,
+              process=None,
+              level=None,
+              text=None,
+              limit=1000):
+        """The messages matching all the given criteria, in time order.
+
+        Parameters
+        ----------
+        start, end: float or None
+            UNIX times, the messages in [start, end) are returned.
+        source, process, level: str or None
+        text: str or None
+            A substring of the message text.
+        limit: int or None
+
+        Returns
+        -------
+        list(Message)
+
+        """
+        conditions = []
+        params = []
+        for condition, value in (("time>=?", start), ("time<?", end),
+                                 ("source=?", source), ("process=?", process),
+                                 ("level=?", level),
+                                 ("instr(text, ?)>0", text)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        sql = "SELECT time, source, process, ip, level, text FROM messages"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY time"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return [
+            Message(*row) for row in self.connection.execute(sql, params)
+        ]
+
+    def prune(self, before, batch_size=10000):
+        """Remove the messages older than a given UNIX time.
+
+        The messages are deleted in batches of ``batch_size``, each in its
+        own transaction, so that a concurrent writer is only blocked briefly.
+        Returns the number of removed messages.
+
+        """
+        n_pruned = 0
+        while True:
+            with self.connection:
+                n_deleted = self.connection.execute(
+                    "DELETE FROM messages WHERE rowid IN (SELECT rowid FROM "
+                    "messages WHERE time<? LIMIT ?)",
+                    (before, batch_size)).rowcount
+            n_pruned += n_deleted
+            if n_deleted < batch_size:
+                return n_pruned
+
+    def close(self):
+        self.connection.close()
+
+
+def utc_timestamp(date_string):
+    """Convert a UTC date string to a UNIX time"""
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            date = datetime.datetime.strptime(date_string, fmt)
+        except ValueError:
+            continue
+        return date.replace(tzinfo=datetime.timezone.utc).timestamp()
+    raise ValueError("Invalid date: {}".format(date_string))
+
+
+def main():
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    archive = MSGArchive(args['-f'])
+    messages = archive.query(
+        start=utc_timestamp(args['-s']) if args['-s'] else None,
+        end=utc_timestamp(args['-e']) if args['-e'] else None,
+        source=args['-c'],
+        process=args['-p'],
+        level=args['-v'],
+        text=args['-t'],
+        limit=int(args['-n']))
+    for message in messages:
+        date = datetime.datetime.utcfromtimestamp(message.time)
+        print("{} [{}] {} {} {}: {}".format(date, message.source,
+                                             message.ip, message.process,
+                                             message.level, message.text))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,15 +15,23 @@ Options:
     -p LIGIER_PORT  The port of the ligier [default: 5553].
     -o LOG_DIR      Directory to dump the messages [default: logs].
     -x PREFIX       Prefix for the log files [default: MSG].
+    -z --gzip       Compress the log files of the previous days.
+    -k KEEP_DAYS    Days to keep in the MSG archive, 0 to disable the
+                    archive [default: 31].
     -h --help       Show this screen.
 
 """
 import datetime
+import gzip
 import os
-from shutil import copyfile
+import shutil
+import sqlite3
+import threading
+import time
 
 from km3pipe import Pipeline, Module
 from km3pipe.io import CHPump
+from msg_archive import MSGArchive, parse_message
 
 
 def current_date_str(fmt="%Y-%m-%d"):
@@ -31,25 +39,161 @@ def current_date_str(fmt="%Y-%m-%d"):
     return datetime.datetime.utcnow().strftime(fmt)
 
 
+def next_utc_midnight():
+    """Return the UNIX time of the next UTC midnight"""
+    return (time.time() // 86400 + 1) * 86400
+
+
+def compress(filepath):
+    """Replace a file by its gzipped version"""
+    with open(filepath, 'rb') as fin, gzip.open(filepath + '.gz.tmp',
+                                                 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+    os.replace(filepath + '.gz.tmp', filepath + '.gz')
+    os.remove(filepath)
+
+
 class MSGDumper(Module):
+    """Writes the messages to a log file which is rotated at UTC midnight.
+
+    The messages are buffered and written when the buffer exceeds
+    ``flush_size`` bytes or at least every ``flush_interval`` seconds. The
+    lag is the time between receiving a message and writing it to the file.
+
+    If ``keep_days`` is set, the parsed messages are also added to the MSG
+    archive (``<prefix>.sqlite3``, see msg_archive.py).
+
+    """
     def configure(self):
         self.path = os.path.abspath(self.require('path'))
         self.prefix = self.require('prefix')
+        self.compress = self.get('compress', default=False)
+        self.flush_size = self.get('flush_size', default=64 * 1024)
+        self.flush_interval = self.get('flush_interval', default=1)
+        self.stats_interval = self.get('stats_interval', default=60)
+        self.keep_days = self.get('keep_days', default=31)
         self.current_date = current_date_str()
+        self.next_rotation = next_utc_midnight()
         self.filename = self.prefix + ".log"
         self.filepath = os.path.join(self.path, self.filename)
         self.fobj = open(self.filepath, 'a')
+        self.archive = None
+        if self.keep_days:
+            self.archive = MSGArchive(
+                os.path.join(self.path, self.prefix + ".sqlite3"))
+
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_messages = []
+        self.buffer_size = 0
+        self.buffer_received = []  # the time each message was received
+        self.n_messages = 0
+        self.n_flushes = 0
+        self.lag_sum = 0
+        self.lag_max = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self._flush_periodically,
+                                       daemon=True)
+        self.thread.start()
+
+    def _flush(self):
+        """Write the buffered messages, the lock has to be held"""
+        if not self.buffer:
+            return
+        self.fobj.write(''.join(self.buffer))
+        self.fobj.flush()
+        if self.archive is not None:
+            try:
+                self.archive.add(self.buffer_messages)
+            except sqlite3.Error as e:
+                self.log.error("Could not archive %d messages: %s",
+                               len(self.buffer_messages), e)
+        now = time.time()
+        self.lag_sum += len(self.buffer_received) * now - sum(
+            self.buffer_received)
+        self.lag_max = max(self.lag_max, now - self.buffer_received[0])
+        self.n_messages += len(self.buffer)
+        self.n_flushes += 1
+        self.buffer = []
+        self.buffer_messages = []
+        self.buffer_size = 0
+        self.buffer_received = []
+
+    def _rotate(self):
+        """Archive the log file of the previous day, the lock has to be held
 
-    def update_file_descriptor(self):
-        current_date = current_date_str()
-        if self.current_date != current_date:
-            archived_name = "{}_{}.log".format(self.prefix, self.current_date)
-            self.print("Cycling the log file: {} -> {}".format(
-                self.filename, archived_name))
-            copyfile(self.filepath, os.path.join(self.path, archived_name))
-            self.fobj.close()
-            self.fobj = open(self.filepath, 'w')
-            self.current_date = current_date
+        The file is renamed, so that no message is lost and nothing has to be
+        copied.
+
+        """
+        self._flush()
+        self.fobj.close()
+        archived_name = "{}_{}.log".format(self.prefix, self.current_date)
+        archived_path = os.path.join(self.path, archived_name)
+        self.print("Cycling the log file: {} -> {}".format(
+            self.filename, archived_name))
+        os.rename(self.filepath, archived_path)
+        self.fobj = open(self.filepath, 'a')
+        self.current_date = current_date_str()
+        self.next_rotation = next_utc_midnight()
+        if self.compress or self.archive is not None:
+            threading.Thread(target=self._housekeeping,
+                             args=(archived_path, )).start()
+
+    def _housekeeping(self, filepath):
+        """Compress the rotated log file and prune the MSG archive
+
+        Runs in a background thread, so that neither blocks the messages.
+
+        """
+        if self.compress:
+            self._compress(filepath)
+        if self.archive is not None:
+            self._prune_archive()
+
+    def _compress(self, filepath):
+        try:
+            compress(filepath)
+        except OSError as e:
+            self.log.error("Could not compress %s: %s", filepath, e)
+
+    def _prune_archive(self):
+        """Remove the old messages, using a separate database connection"""
+        try:
+            archive = MSGArchive(self.archive.filename)
+            try:
+                n_pruned = archive.prune(time.time() - self.keep_days * 86400)
+            finally:
+                archive.close()
+        except sqlite3.Error as e:
+            self.log.error("Could not prune the MSG archive: %s", e)
+        else:
+            self.print("Removed {} messages from the archive".format(n_pruned))
+
+    def _flush_periodically(self):
+        last_stats = time.time()
+        while self.running:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if time.time() >= self.next_rotation:
+                    self._rotate()
+                self._flush()
+                if time.time() - last_stats >= self.stats_interval:
+                    self._print_stats()
+                    last_stats = time.time()
+
+    def _print_stats(self):
+        """Print the message rate and the lag, the lock has to be held"""
+        if self.n_messages:
+            self.print("{} messages in {} writes, lag: mean {:.3f}s, "
+                       "max {:.3f}s".format(self.n_messages, self.n_flushes,
+                                            self.lag_sum / self.n_messages,
+                                            self.lag_max))
+        self.n_messages = 0
+        self.n_flushes = 0
+        self.lag_sum = 0
+        self.lag_max = 0
 
     def process(self, blob):
         data = blob['CHData'].decode()
@@ -64,14 +208,28 @@ class MSGDumper(Module):
             source = "DataWriter"
 
         entry = "{} [{}]: {}\n".format(self.filename, source, data)
-        self.update_file_descriptor()
-        self.fobj.write(entry)
-        self.fobj.flush()
+        received = time.time()
+        with self.lock:
+            if received >= self.next_rotation:
+                self._rotate()
+            self.buffer.append(entry)
+            self.buffer_messages.append(
+                parse_message(received, source, data))
+            self.buffer_received.append(received)
+            self.buffer_size += len(entry)
+            if self.buffer_size >= self.flush_size:
+                self._flush()
         return blob
 
     def finish(self):
-        if self.fobj is not None:
-            self.fobj.close()
+        self.running = False
+        self.thread.join()
+        with self.lock:
+            self._flush()
+            if self.fobj is not None:
+                self.fobj.close()
+            if self.archive is not None:
+                self.archive.close()
 
 
 def main():
@@ -82,6 +240,8 @@ def main():
     ligier_port = int(args['-p'])
     path = args['-o']
     prefix = args['-x']
+    compress = args['--gzip']
+    keep_days = int(args['-k'])
 
     pipe = Pipeline()
     pipe.attach(CHPump,
@@ -90,7 +250,11 @@ def main():
                 tags='MSG',
                 timeout=7 * 60 * 60 * 24,
                 max_queue=500)
-    pipe.attach(MSGDumper, prefix=prefix, path=path)
+    pipe.attach(MSGDumper,
+                prefix=prefix,
+                path=path,
+                compress=compress,
+                keep_days=keep_days)
     pipe.drain()
 
 
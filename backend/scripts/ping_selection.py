@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: ping_selection.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Selection of the pings of the autonomous acoustic beacons in TOA tables.
+
+The selection looks for the signal window around the ping with the highest
+quality factor and applies the following filters to the TOAs in it:
+
+1. duplicates (same UNIXTIMEBASE + TOA_S) are removed
+2. only the 11 pings with the highest quality factors are kept
+3. pings below the maximum noise + 10 sigma are removed
+4. pings which are not interspersed in the right way are removed
+5. pings closer to the noise threshold than to the strongest ping are removed
+
+"""
+import numpy as np
+
+N_BEST = 11
+
+
+def _first_index(values, queries):
+    """The index of the first occurrence of each query in values"""
+    order = np.argsort(values, kind='stable')
+    return order[np.searchsorted(values[order], queries)]
+
+
+def select_beacon_pings(qf, utb, toa, now, tit, ssw):
+    """Select the pings of a single beacon recorded by a single DOM.
+
+    Parameters
+    ----------
+    qf, utb, toa: np.array
+        The QUALITYFACTOR, UNIXTIMEBASE and TOA_S columns of the TOA table.
+    now: float
+        The end of the time window.
+    tit: float
+        The time interval between the trains of acoustic pulses, which is
+        the length of the time window.
+    ssw: float
+        The size of the signal window.
+
+    Returns
+    -------
+    (n_pings, utb_min, qf_max)
+        The number of selected pings, the earliest UNIXTIMEBASE and highest
+        quality factor of them. ``utb_min`` and ``qf_max`` are ``None`` if
+        no ping is selected.
+
+    """
+    start = now - tit
+    in_window = np.flatnonzero((utb > start) & (utb < now))
+    if len(in_window) == 0:
+        return 0, None, None
+    utb_window = utb[in_window]
+    qf_window = qf[in_window]
+
+    best = utb_window[np.argmax(qf_window)]
+    signal_min = best - ssw / 2
+    signal_max = best + ssw / 2
+    if signal_max > now:
+        signal = ((utb_window < now) & (utb_window > signal_min)) | \
+            ((utb_window > start) & (utb_window < start + ssw / 2))
+    elif signal_min < start:
+        signal = ((utb_window > start) & (utb_window < signal_max)) | \
+            ((utb_window < now) & (utb_window > now - ssw / 2))
+    else:
+        signal = (utb_window > signal_min) & (utb_window < signal_max)
+
+    noise = qf_window[(qf_window != 0) & ~signal]
+    if len(noise):
+        noise_threshold = noise.max()
+
+    signal_index = np.flatnonzero(signal)
+    qf_signal = qf_window[signal_index]
+    utb_signal = utb_window[signal_index]
+    # The TOAs are looked up with the positions inside the time window
+    toa_signal = toa[signal_index]
+
+    # Pings with the same quality factor are represented by the first one
+    qf_sorted = np.sort(qf_signal)[::-1]
+    first = _first_index(qf_signal, qf_sorted)
+    unix_toa = utb_signal[first] + toa_signal[first]
+    _, first_unix_toa, counts = np.unique(unix_toa,
+                                          return_index=True,
+                                          return_counts=True)
+    keep = np.ones(len(qf_sorted), dtype=bool)
+    keep[first_unix_toa[counts > 1]] = False
+    qf_selected = qf_sorted[keep]
+
+    if len(qf_selected) > N_BEST:
+        qf_selected = qf_selected[qf_selected >= qf_selected[N_BEST - 1]]
+
+    if len(noise):
+        qf_selected = qf_selected[qf_selected > noise_threshold +
+                                  10 * np.std(noise)]
+
+    if len(qf_selected):
+        utb_selected = utb_signal[_first_index(qf_signal, qf_selected)]
+        spacing = np.mod(utb_selected - utb_selected[0], 5)
+        qf_selected = qf_selected[~(((spacing > 2) & (spacing < 4))
+                                    | (spacing > 5))]
+
+    if len(noise) and len(qf_selected):
+        qf_selected = qf_selected[
+            2 * np.abs(qf_selected - qf_selected.max()) < np.abs(
+                qf_selected - noise_threshold)]
+
+    if len(qf_selected) == 0:
+        return 0, None, None
+    utb_selected = utb_signal[_first_index(qf_signal, qf_selected)]
+    return len(qf_selected), utb_selected.min(), qf_selected.max()
+
+
+def select_pings(toas, now, tit, ssw):
+    """Select the pings of all DOMs and beacons in a TOA table.
+
+    Parameters
+    ----------
+    toas: pd.DataFrame
+        TOA table (e.g. of a whole DU) with the columns DOMID, EMITTERID,
+        QUALITYFACTOR, UNIXTIMEBASE and TOA_S.
+    now, tit, ssw: float
+        See ``select_beacon_pings``.
+
+    Returns
+    -------
+    dict((dom_id, emitter_id): (n_pings, utb_min, qf_max))
+
+    """
+    pings = {}
+    for key, group in toas.groupby(["DOMID", "EMITTERID"], sort=False):
+        pings[key] = select_beacon_pings(group["QUALITYFACTOR"].values,
+                                         group["UNIXTIMEBASE"].values,
+                                         group["TOA_S"].values, now, tit, ssw)
+    return pings
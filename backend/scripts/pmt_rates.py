@@ -13,17 +13,21 @@ Usage:
 Options:
     -l LIGIER_IP    The IP of the ligier [default: 127.0.0.1].
     -p LIGIER_PORT  The port of the ligier [default: 5553].
-    -u DU           The DU to monitor [default: 1].
+    -u DUS          The DU(s) to monitor, comma separated or "all" [default: 1].
     -d DET_ID       Detector ID [default: 29].
     -i INTERVAL     Time interval for one pixel [default: 10].
+    -x COLUMNS      Number of pixels (time intervals) to show [default: 800].
+    -w WORKERS      Number of worker processes for rendering [default: 0].
     -o PLOT_DIR     The directory to save the plot [default: /plots].
+    -s DATA_DIR     The directory to persist the heatmaps [default: /data].
     -h --help       Show this screen.
 
 """
 from datetime import datetime
-import io
+import hashlib
+import json
 import os
-from collections import defaultdict
+from multiprocessing import Pool
 import threading
 import time
 
@@ -33,7 +37,8 @@ import matplotlib.colors as mcolors
 matplotlib.use('Agg')
 
 import km3pipe as kp
-from km3pipe.io.daq import TMCHData
+from ligier_fanout import LigierFanoutPump
+from tmch import decode_tmch
 import matplotlib.pyplot as plt
 import km3pipe.style as kpst
 kpst.use("km3pipe")
@@ -45,39 +50,289 @@ VERSION = "1.0"
 log = kp.logger.logging.getLogger("PMTrates")
 
 
+def plot_pmt_rates(rates_matrix, hrv_matrix, timestamps, filename, det_id,
+                   du, interval, lowest_rate, highest_rate,
+                   hrv_ratio_threshold):
+    """Create the PMT rates heatmap of a DU
+
+    This is a standalone function so that it can be sent to a worker process.
+    """
+    now = time.time()
+    max_x = rates_matrix.shape[1]
+
+    def xlabel_func(i):
+        timestamp = timestamps[i]
+        if np.isnan(timestamp):
+            timestamp = now - (max_x - i) * interval
+        return datetime.utcfromtimestamp(timestamp).strftime("%H:%M")
+
+    norm = mcolors.Normalize(vmin=lowest_rate, vmax=highest_rate, clip=True)
+    fig, ax = plt.subplots(figsize=(10, 8))
+    ax.imshow(rates_matrix, origin='lower', interpolation='none', norm=norm)
+    ax.imshow(hrv_matrix, origin='lower', interpolation='none', cmap="bwr_r")
+    ax.set_title(
+        "Mean PMT Rates for DetID-{} DU-{} "
+        "- colours from {:.1f}kHz to {:.1f}kHz (HRV ratio threshold {})\n"
+        "PMTs ordered from top to bottom - {}".format(
+            det_id, du, lowest_rate / 1000, highest_rate / 1000,
+            hrv_ratio_threshold, datetime.utcnow()))
+    ax.set_xlabel("UTC time [{}s/px]".format(interval))
+    plt.yticks([i * 31 for i in range(18)],
+               ["Floor {}".format(f) for f in range(1, 19)])
+    xtics_int = range(0, max_x, int(max_x / 10))
+    plt.xticks([i for i in xtics_int],
+               [xlabel_func(i) for i in xtics_int])
+    fig.tight_layout()
+    plt.savefig(filename)
+    plt.close('all')
+
+
+class RateHeatmaps:
+    """Circular buffer of the PMT rate and HRV heatmaps of several DUs.
+
+    The rates are summed up per PMT until the next column is added. Every
+    column is stored twice, at ``head`` and ``head + n_columns``, so that the
+    chronologically ordered heatmap is a contiguous slice of the buffer and
+    can be passed to ``imshow`` without copying. The wall-clock time of each
+    column is kept alongside.
+
+    If a ``path`` is given, the buffers are memory-mapped files in that
+    directory which are updated in place, so the heatmaps survive a restart.
+    The intervals missed in the meantime are filled with empty columns.
+
+    Parameters
+    ----------
+    dus: list(int)
+    n_rows: int
+        Number of PMTs per DU.
+    n_columns: int
+        Number of time intervals to keep.
+    interval: float
+        The length of a time interval in seconds.
+    path: str or None
+        Directory to persist the heatmaps.
+
+    """
+    def __init__(self, dus, n_rows, n_columns, interval, path=None):
+        self.n_columns = n_columns
+        self.interval = interval
+        n_dus = len(dus)
+        # columns first, so that adding a column touches contiguous memory
+        shape = (2 * n_columns, n_dus, n_rows)
+        meta = dict(dus=list(dus),
+                    n_rows=n_rows,
+                    n_columns=n_columns,
+                    interval=interval)
+        if path is None:
+            self.rates = np.full(shape, np.nan, dtype=np.float32)
+            self.hrv = np.full(shape, np.nan, dtype=np.float32)
+            self.timestamps = np.full(2 * n_columns, np.nan)
+        elif self._load(path, meta):
+            log.warning("Restored PMT rate heatmaps from %s", path)
+        else:
+            self._create(path, meta, shape)
+        self.head = self._find_head()
+        self.rate_sum = np.zeros((n_dus, n_rows))
+        self.hrv_sum = np.zeros((n_dus, n_rows))
+        self.counts = np.zeros((n_dus, n_rows))
+        self.fill_gap(time.time())
+
+    def _filenames(self, path):
+        return [
+            os.path.join(path, name)
+            for name in ("meta.json", "rates.npy", "hrv.npy", "timestamps.npy")
+        ]
+
+    def _load(self, path, meta):
+        """Attach to the persisted heatmaps if they match the configuration"""
+        meta_file, rates_file, hrv_file, timestamps_file = self._filenames(
+            path)
+        if not os.path.exists(meta_file):
+            return False
+        try:
+            with open(meta_file) as fobj:
+                if json.load(fobj) != meta:
+                    log.warning("PMT rate heatmap configuration changed, "
+                                "discarding the data in %s", path)
+                    return False
+            self.rates = np.lib.format.open_memmap(rates_file, mode='r+')
+            self.hrv = np.lib.format.open_memmap(hrv_file, mode='r+')
+            self.timestamps = np.lib.format.open_memmap(timestamps_file,
+                                                        mode='r+')
+        except (OSError, ValueError) as e:
+            log.error("Could not load the PMT rate heatmaps: %s", e)
+            return False
+        return True
+
+    def _create(self, path, meta, shape):
+        os.makedirs(path, exist_ok=True)
+        meta_file, rates_file, hrv_file, timestamps_file = self._filenames(
+            path)
+        self.rates = np.lib.format.open_memmap(rates_file,
+                                               mode='w+',
+                                               dtype=np.float32,
+                                               shape=shape)
+        self.rates[:] = np.nan
+        self.hrv = np.lib.format.open_memmap(hrv_file,
+                                             mode='w+',
+                                             dtype=np.float32,
+                                             shape=shape)
+        self.hrv[:] = np.nan
+        self.timestamps = np.lib.format.open_memmap(timestamps_file,
+                                                    mode='w+',
+                                                    dtype=np.float64,
+                                                    shape=(shape[0], ))
+        self.timestamps[:] = np.nan
+        with open(meta_file, 'w') as fobj:
+            json.dump(meta, fobj)
+
+    def _find_head(self):
+        """The column after the latest one"""
+        timestamps = self.timestamps[:self.n_columns]
+        if np.all(np.isnan(timestamps)):
+            return 0
+        return (int(np.nanargmax(timestamps)) + 1) % self.n_columns
+
+    def _write_column(self, rates, hrv, timestamp):
+        for column in (self.head, self.head + self.n_columns):
+            self.rates[column] = rates
+            self.hrv[column] = hrv
+            self.timestamps[column] = timestamp
+        self.head = (self.head + 1) % self.n_columns
+
+    def fill_gap(self, now):
+        """Add empty columns for the intervals without data until now"""
+        latest = self.timestamps[(self.head - 1) % self.n_columns]
+        if np.isnan(latest):
+            return
+        n_missing = int((now - latest) // self.interval) - 1
+        if n_missing <= 0:
+            return
+        log.warning("Filling a gap of %d intervals in the PMT rate heatmaps",
+                    n_missing)
+        first = max(1, n_missing - self.n_columns + 1)
+        for i in range(first, n_missing + 1):
+            self._write_column(np.nan, np.nan, latest + i * self.interval)
+        self.flush()
+
+    def accumulate(self, rows, rates, hrv):
+        """Add PMT rates and HRV flags to the current interval
+
+        Parameters
+        ----------
+        rows: array(int)
+            Flat indices into an (n_dus, n_rows) array.
+        rates: array(float)
+        hrv: array(bool)
+
+        """
+        size = self.rate_sum.size
+        shape = self.rate_sum.shape
+        self.rate_sum += np.bincount(rows, weights=rates,
+                                     minlength=size).reshape(shape)
+        self.hrv_sum += np.bincount(rows, weights=hrv,
+                                    minlength=size).reshape(shape)
+        self.counts += np.bincount(rows, minlength=size).reshape(shape)
+
+    def add_column(self, hrv_ratio_threshold, timestamp=None):
+        """Close the current interval and write the means as a new column"""
+        if timestamp is None:
+            timestamp = time.time()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_rates = self.rate_sum / self.counts
+            hrv_ratio = self.hrv_sum / self.counts
+        hrv = np.where(hrv_ratio > hrv_ratio_threshold, 1.0, np.nan)
+        self._write_column(mean_rates, hrv, timestamp)
+        self.rate_sum[:] = 0
+        self.hrv_sum[:] = 0
+        self.counts[:] = 0
+        self.flush()
+
+    def flush(self):
+        for array in (self.rates, self.hrv, self.timestamps):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def view(self, du_idx):
+        """The ordered rates and HRV heatmaps of a DU and the column times
+
+        The oldest column comes first.
+        """
+        columns = slice(self.head, self.head + self.n_columns)
+        return (self.rates[columns, du_idx].T, self.hrv[columns, du_idx].T,
+                self.timestamps[columns])
+
+
+def heatmaps_dirname(dus):
+    """The directory of the heatmaps of a DU selection
+
+    Each DU selection has its own directory, so that several ``pmt_rates.py``
+    instances (e.g. one per DU) do not overwrite each other's files. Long
+    selections are abbreviated by a hash.
+
+    """
+    name = "pmt_rates_du" + "-".join(str(du) for du in dus)
+    if len(name) > 64:
+        name = "pmt_rates_" + hashlib.sha1(name.encode()).hexdigest()[:16]
+    return name
+
+
 class PMTRates(kp.Module):
+    """Creates PMT rate heatmaps for one or more DUs.
+
+    Each IO_MONIT packet is decoded once and sorted into the rate matrix of
+    its DU, so a single instance can monitor the whole detector.
+
+    """
     def configure(self):
         self.detector = self.require("detector")
-        self.du = self.require("du")
+        self.dus = self.require("dus")
         self.interval = self.get("interval", default=10)
         self.plot_path = self.get("plot_path", default="plots")
-        self.filename = self.get("filename",
-                                 default=f"pmt_rates_du{self.du}.png")
+        self.filename = self.get("filename", default="pmt_rates_du{du}.png")
         self.lowest_rate = self.get("lowest_rate", default=5000)
         self.highest_rate = self.get("highest_rate", default=15000)
         self.hrv_ratio_threshold = self.get("hrv_ratio_threshold",
                                             default=0.95)
-        self.max_x = 800
+        self.n_workers = self.get("n_workers", default=0)
+        self.batch_size = self.get("batch_size", default=1000)
+        self.max_x = self.get("max_x", default=800)
+        self.n_rows = 18 * 31
         self.index = 0
-        self.rates = defaultdict(list)
-        self.rates_matrix = np.full((18 * 31, self.max_x), np.nan)
-        self.hrv = defaultdict(list)
-        self.hrv_matrix = np.full((18 * 31, self.max_x), np.nan)
+        self.data_path = self.get("data_path", default=None)
+        self.heatmaps = RateHeatmaps(
+            self.dus, self.n_rows, self.max_x, self.interval,
+            None if self.data_path is None else os.path.join(
+                self.data_path, heatmaps_dirname(self.dus)))
+        self._init_lookup()
+        self.payloads = []
+        self.pool = Pool(self.n_workers) if self.n_workers > 0 else None
         self.lock = threading.Lock()
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = True
         self.thread.start()
 
+    def _init_lookup(self):
+        """Create the DOM ID -> (DU index, first matrix row) lookup arrays"""
+        self.dom_ids = np.array(sorted(self.detector.doms), dtype=np.uint32)
+        self.dom_du_idx = np.full(len(self.dom_ids), -1, dtype=np.int64)
+        self.dom_y_base = np.zeros(len(self.dom_ids), dtype=np.int64)
+        for i, dom_id in enumerate(self.dom_ids):
+            du, floor, _ = self.detector.doms[dom_id]
+            if du in self.dus:
+                self.dom_du_idx[i] = self.dus.index(du)
+                self.dom_y_base[i] = (floor - 1) * 31
+        self.pmt_offsets = np.array(kp.hardware.ORDERED_PMT_IDS[:31])
+
     def run(self):
         interval = self.interval
         while True:
             time.sleep(interval)
             now = datetime.now()
-            self.add_column()
-            self.update_plot()
             with self.lock:
-                self.rates = defaultdict(list)
-                self.hrv = defaultdict(list)
+                self.decode_payloads()
+                self.heatmaps.add_column(self.hrv_ratio_threshold)
+            self.update_plots()
             delta_t = (datetime.now() - now).total_seconds()
             remaining_t = self.interval - delta_t
             log.info("Delta t: {} -> waiting for {}s".format(
@@ -89,98 +344,66 @@ class PMTRates(kp.Module):
             else:
                 interval = remaining_t
 
-    def add_column(self):
-        m_rates = np.roll(self.rates_matrix, -1, 1)
-        m_hrv = np.roll(self.hrv_matrix, -1, 1)
-        y_range = 18 * 31
-        mean_rates = np.full(y_range, np.nan)
-        hrv = np.full(y_range, np.nan)
-        for i in range(y_range):
-            if i in self.rates:
-                mean_rates[i] = np.mean(self.rates[i])
-            if i in self.hrv:
-                if np.mean(self.hrv[i]) > self.hrv_ratio_threshold:
-                    hrv[i] = 1.0
-
-        m_rates[:, self.max_x - 1] = mean_rates
-        self.rates_matrix = m_rates
-        m_hrv[:, self.max_x - 1] = hrv
-        self.hrv_matrix = m_hrv
-
-    def update_plot(self):
-        filename = os.path.join(self.plot_path, self.filename)
-        self.log.debug("Updating plot at {}".format(filename))
-        now = time.time()
-        max_x = self.max_x
-        interval = self.interval
-
-        def xlabel_func(timestamp):
-            return datetime.utcfromtimestamp(timestamp).strftime("%H:%M")
-
-        norm = mcolors.Normalize(vmin=self.lowest_rate,
-                                 vmax=self.highest_rate,
-                                 clip=True)
-        fig, ax = plt.subplots(figsize=(10, 8))
-        ax.imshow(self.rates_matrix,
-                  origin='lower',
-                  interpolation='none',
-                  norm=norm)
-        ax.imshow(self.hrv_matrix,
-                  origin='lower',
-                  interpolation='none',
-                  cmap="bwr_r")
-        ax.set_title(
-            "Mean PMT Rates for DetID-{} DU-{} "
-            "- colours from {:.1f}kHz to {:.1f}kHz (HRV ratio threshold {})\n"
-            "PMTs ordered from top to bottom - {}".format(
-                self.detector.det_id, self.du, self.lowest_rate / 1000,
-                self.highest_rate / 1000, self.hrv_ratio_threshold,
-                datetime.utcnow()))
-        ax.set_xlabel("UTC time [{}s/px]".format(interval))
-        plt.yticks([i * 31 for i in range(18)],
-                   ["Floor {}".format(f) for f in range(1, 19)])
-        xtics_int = range(0, max_x, int(max_x / 10))
-        plt.xticks(
-            [i for i in xtics_int],
-            [xlabel_func(now - (max_x - i) * interval) for i in xtics_int])
-        fig.tight_layout()
-        plt.savefig(filename)
-        plt.close('all')
-
-    def process(self, blob):
-        try:
-            tmch_data = TMCHData(io.BytesIO(blob['CHData']))
-        except ValueError:
-            self.log.error("Could not parse binary data. Ignoring...")
-            return blob
-
-        dom_id = tmch_data.dom_id
-
-        if dom_id not in self.detector.doms:
-            # it might be the "base CLB"
-            self.log.debug(f"DOM ID {dom_id} not in detector definition!")
-            return blob
+    def update_plots(self):
+        jobs = []
+        for du_idx, du in enumerate(self.dus):
+            filename = os.path.join(self.plot_path,
+                                    self.filename.format(du=du))
+            self.log.debug("Updating plot at {}".format(filename))
+            rates, hrv, timestamps = self.heatmaps.view(du_idx)
+            jobs.append((rates, hrv, timestamps, filename,
+                         self.detector.det_id, du, self.interval,
+                         self.lowest_rate, self.highest_rate,
+                         self.hrv_ratio_threshold))
+        if self.pool is None:
+            for job in jobs:
+                plot_pmt_rates(*job)
+        else:
+            self.pool.starmap(plot_pmt_rates, jobs)
 
-        du, floor, _ = self.detector.doms[dom_id]
+    def decode_payloads(self):
+        """Decode the collected packets and add them to the accumulators"""
+        payloads = self.payloads
+        self.payloads = []
+        tmch_data = decode_tmch(payloads)
+        n_invalid = len(payloads) - len(tmch_data.dom_id)
+        if n_invalid:
+            self.log.error(
+                "Could not parse {} binary data. Ignoring...".format(
+                    n_invalid))
 
-        if du != self.du:
-            return blob
+        idx = np.searchsorted(self.dom_ids, tmch_data.dom_id)
+        idx[idx == len(self.dom_ids)] = 0
+        # unknown DOM IDs might be the "base CLB"
+        known = self.dom_ids[idx] == tmch_data.dom_id
+        du_idx = np.where(known, self.dom_du_idx[idx], -1)
+        selected = du_idx >= 0
+        if not np.any(selected):
+            return
 
-        y_base = (floor - 1) * 31
+        if np.random.rand() > 0.9:
+            i = np.flatnonzero(selected)[0]
+            self.cprint(f"Rates for DOM ID {tmch_data.dom_id[i]}: "
+                        f"{tmch_data.pmt_rates[i]}")
 
-        if np.random.rand() > 0.99:
-            self.cprint(f"Rates for DOM ID {dom_id} DU {du}: {tmch_data.pmt_rates}")
-
-        hrv_flags = reversed("{0:b}".format(tmch_data.hrvbmp).zfill(32))
-        for channel_id, (rate, hrv_flag) in enumerate(
-                zip(tmch_data.pmt_rates, hrv_flags)):
-            idx = y_base + kp.hardware.ORDERED_PMT_IDS[channel_id]
-            with self.lock:
-                self.rates[idx].append(rate)
-                self.hrv[idx].append(int(hrv_flag))
+        rows = (du_idx[selected] * self.n_rows +
+                self.dom_y_base[idx[selected]])[:, np.newaxis] \
+            + self.pmt_offsets
+        self.heatmaps.accumulate(rows.ravel(),
+                                 tmch_data.pmt_rates[selected].ravel(),
+                                 tmch_data.hrv[selected].ravel())
 
+    def process(self, blob):
+        with self.lock:
+            self.payloads.append(blob['CHData'])
+            if len(self.payloads) >= self.batch_size:
+                self.decode_payloads()
         return blob
 
+    def finish(self):
+        if self.pool is not None:
+            self.pool.close()
+
 
 def main():
     from docopt import docopt
@@ -188,15 +411,22 @@ def main():
 
     det_id = int(args['-d'])
     plot_path = args['-o']
+    data_path = args['-s']
     ligier_ip = args['-l']
     ligier_port = int(args['-p'])
-    du = int(args['-u'])
     interval = int(args['-i'])
+    max_x = int(args['-x'])
+    n_workers = int(args['-w'])
 
     detector = kp.hardware.Detector(det_id=det_id)
 
+    if args['-u'] == 'all':
+        dus = sorted(detector.dus)
+    else:
+        dus = [int(du) for du in args['-u'].split(',')]
+
     pipe = kp.Pipeline(timeit=True)
-    pipe.attach(kp.io.ch.CHPump,
+    pipe.attach(LigierFanoutPump,
                 host=ligier_ip,
                 port=ligier_port,
                 tags='IO_MONIT',
@@ -204,9 +434,12 @@ def main():
                 max_queue=2000)
     pipe.attach(PMTRates,
                 detector=detector,
-                du=du,
+                dus=dus,
                 interval=interval,
-                plot_path=plot_path)
+                max_x=max_x,
+                n_workers=n_workers,
+                plot_path=plot_path,
+                data_path=data_path)
     pipe.drain()
 
 
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: rate_history.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+History of the summary slice rates of all DOMs (and optionally PMTs).
+
+The mean rates are stored in time bins of fixed width, one row per bin, in
+memory-mapped ``.npy`` files which cover one partition (a day by default)
+each::
+
+    meta.json                       bin width and partition length
+    <start>_dom_ids.npy             the DOM IDs of the columns
+    <start>_dom_rates.npy           float16 [n_bins, n_doms], in kHz
+    <start>_pmt_rates.npy           uint16 [n_bins, n_doms, 31], in units
+                                    of PMT_RATE_UNIT Hz (optional)
+
+where ``<start>`` is the UNIX time of the beginning of the partition.
+Bins without data are NaN (DOM rates) or PMT_RATE_MISSING (PMT rates).
+
+The files can be read by other processes with ``RateHistory.query`` while
+``RateHistoryWriter`` appends to them.
+
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import km3pipe as kp
+from summaryslice import decode_summaryslice, DOMRows
+
+log = kp.logger.get_logger("rate_history")
+
+N_PMTS = 31
+PMT_RATE_UNIT = 50  # Hz
+PMT_RATE_MISSING = np.iinfo(np.uint16).max
+
+
+def _columns(partition_dom_ids, dom_ids):
+    """The columns of the DOM IDs in a partition, -1 for missing DOMs"""
+    columns = np.full(len(dom_ids), -1)
+    if len(partition_dom_ids) == 0:
+        return columns
+    order = np.argsort(partition_dom_ids)
+    sorted_dom_ids = partition_dom_ids[order]
+    idx = np.searchsorted(sorted_dom_ids, dom_ids)
+    idx[idx == len(sorted_dom_ids)] = 0
+    found = sorted_dom_ids[idx] == dom_ids
+    columns[found] = order[idx[found]]
+    return columns
+
+
+class RateHistory:
+    """Time-partitioned store of the summary slice rates.
+
+    Parameters
+    ----------
+    path: str
+        The directory of the store, created if it does not exist.
+    bin_width: int
+        The width of a time bin in seconds.
+    partition_length: int
+        The time range of a partition in seconds, a multiple of the bin
+        width.
+
+    If the store already exists, the bin width and partition length are
+    taken from it.
+
+    """
+    def __init__(self, path, bin_width=60, partition_length=86400):
+        self.path = path
+        meta_file = os.path.join(path, "meta.json")
+        if os.path.exists(meta_file):
+            with open(meta_file) as fobj:
+                meta = json.load(fobj)
+            if (meta["bin_width"], meta["partition_length"]) != (
+                    bin_width, partition_length):
+                log.warning(
+                    "Using the bin width (%ds) and partition length (%ds) "
+                    "of the existing rate history in %s", meta["bin_width"],
+                    meta["partition_length"], path)
+        else:
+            if partition_length % bin_width:
+                raise ValueError("The partition length must be a multiple "
+                                 "of the bin width")
+            meta = dict(bin_width=bin_width,
+                        partition_length=partition_length)
+            os.makedirs(path, exist_ok=True)
+            with open(meta_file, 'w') as fobj:
+                json.dump(meta, fobj)
+        self.bin_width = meta["bin_width"]
+        self.partition_length = meta["partition_length"]
+        self.n_bins = self.partition_length // self.bin_width
+        self._partition = None  # (start, dom_ids, dom_rates, pmt_rates)
+
+    def _filename(self, start, name):
+        return os.path.join(self.path, "{:010d}_{}.npy".format(start, name))
+
+    def partitions(self):
+        """The start times of the existing partitions"""
+        starts = []
+        for filename in os.listdir(self.path):
+            if filename.endswith("_dom_rates.npy"):
+                starts.append(int(filename.split("_")[0]))
+        return sorted(starts)
+
+    def _open(self, start, mode='r'):
+        """Open the files of a partition, ``None`` if it does not exist"""
+        try:
+            dom_ids = np.load(self._filename(start, "dom_ids"))
+            dom_rates = np.lib.format.open_memmap(
+                self._filename(start, "dom_rates"), mode=mode)
+        except FileNotFoundError:
+            return None
+        pmt_file = self._filename(start, "pmt_rates")
+        pmt_rates = None
+        if os.path.exists(pmt_file):
+            pmt_rates = np.lib.format.open_memmap(pmt_file, mode=mode)
+        return start, dom_ids, dom_rates, pmt_rates
+
+    def _create(self, start, dom_ids, with_pmts):
+        """Create the files of a partition.
+
+        The files are filled before they are moved into place, so that
+        readers never see uninitialised rates.
+
+        """
+        np.save(self._filename(start, "dom_ids"), dom_ids)
+        arrays = [("dom_rates", np.float16, (len(dom_ids), ), np.nan)]
+        if with_pmts:
+            arrays.append(("pmt_rates", np.uint16, (len(dom_ids), N_PMTS),
+                           PMT_RATE_MISSING))
+        for name, dtype, shape, fill_value in arrays:
+            filename = self._filename(start, name)
+            array = np.lib.format.open_memmap(filename + ".tmp",
+                                              mode='w+',
+                                              dtype=dtype,
+                                              shape=(self.n_bins, ) + shape)
+            array[:] = fill_value
+            array.flush()
+            del array
+            os.replace(filename + ".tmp", filename)
+        log.info("Created the rate history partition %d in %s", start,
+                 self.path)
+        return self._open(start, mode='r+')
+
+    def write(self, timestamp, dom_ids, dom_rates, pmt_rates=None):
+        """Write the rates of the time bin which contains ``timestamp``
+
+        Parameters
+        ----------
+        timestamp: float
+            UNIX time.
+        dom_ids: array(int) [n]
+        dom_rates: array(float) [n]
+            The DOM rates in kHz.
+        pmt_rates: array(float) [n, 31] or None
+            The PMT rates in Hz.
+
+        """
+        start = int(timestamp // self.partition_length *
+                    self.partition_length)
+        if self._partition is None or self._partition[0] != start:
+            self.flush()
+            self._partition = self._open(start, mode='r+')
+            if self._partition is None:
+                self._partition = self._create(start, dom_ids, pmt_rates
+                                               is not None)
+        _, partition_dom_ids, partition_dom_rates, partition_pmt_rates = \
+            self._partition
+
+        row = int(timestamp - start) // self.bin_width
+        columns = _columns(partition_dom_ids, dom_ids)
+        known = columns >= 0
+        partition_dom_rates[row, columns[known]] = dom_rates[known]
+        if pmt_rates is not None and partition_pmt_rates is not None:
+            encoded = np.full(pmt_rates.shape, PMT_RATE_MISSING, np.uint16)
+            valid = ~np.isnan(pmt_rates)
+            encoded[valid] = np.clip(
+                np.round(pmt_rates[valid] / PMT_RATE_UNIT), 0,
+                PMT_RATE_MISSING - 1)
+            partition_pmt_rates[row, columns[known]] = encoded[known]
+
+    def flush(self):
+        if self._partition is None:
+            return
+        for array in self._partition[2:]:
+            if array is not None:
+                array.flush()
+
+    def query(self, start, end, dom_ids=None, pmts=False):
+        """The rates of a time range and a set of DOMs.
+
+        Parameters
+        ----------
+        start, end: float
+            UNIX times, the bins which start in [start, end) are returned.
+        dom_ids: array(int) or None
+            The DOMs to return, all DOMs of the first partition if ``None``.
+        pmts: bool
+            Return the PMT rates instead of the DOM rates.
+
+        Returns
+        -------
+        (timestamps, dom_ids, rates)
+            The start times of the bins [n_bins], the DOM IDs [n_doms] and
+            the rates in kHz [n_bins, n_doms] or in Hz [n_bins, n_doms, 31]
+            (float32, NaN where no data is available).
+
+        """
+        first_bin = int(np.ceil(start / self.bin_width))
+        last_bin = int(np.ceil(end / self.bin_width))
+        timestamps = np.arange(first_bin, last_bin) * self.bin_width
+        bins_per_partition = self.n_bins
+        first_partition = first_bin // bins_per_partition
+        last_partition = (last_bin - 1) // bins_per_partition
+
+        partitions = []
+        for index in range(first_partition, last_partition + 1):
+            partition = self._open(index * self.partition_length)
+            if partition is not None:
+                partitions.append((index, partition))
+        if dom_ids is None:
+            dom_ids = partitions[0][1][1] if partitions else np.array([], int)
+        dom_ids = np.asarray(dom_ids, dtype=np.int64)
+
+        shape = (len(timestamps), len(dom_ids))
+        if pmts:
+            shape += (N_PMTS, )
+        rates = np.full(shape, np.nan, dtype=np.float32)
+        for index, (_, partition_dom_ids, dom_rates,
+                    pmt_rates) in partitions:
+            if pmts and pmt_rates is None:
+                continue
+            offset = index * bins_per_partition
+            lo = max(first_bin, offset)
+            hi = min(last_bin, offset + bins_per_partition)
+            columns = _columns(partition_dom_ids, dom_ids)
+            known = np.flatnonzero(columns >= 0)
+            if pmts:
+                values = pmt_rates[lo - offset:hi - offset][:, columns[known]]
+                decoded = values.astype(np.float32) * PMT_RATE_UNIT
+                decoded[values == PMT_RATE_MISSING] = np.nan
+                rates[lo - first_bin:hi - first_bin, known] = decoded
+            else:
+                rates[lo - first_bin:hi - first_bin,
+                      known] = dom_rates[lo - offset:hi - offset][:, columns[
+                          known]]
+        return timestamps, dom_ids, rates
+
+    def prune(self, before):
+        """Remove the partitions which end before a given UNIX time"""
+        for start in self.partitions():
+            if start + self.partition_length > before:
+                continue
+            if self._partition is not None and self._partition[0] == start:
+                continue
+            for name in ("dom_rates", "pmt_rates", "dom_ids"):
+                try:
+                    os.remove(self._filename(start, name))
+                except FileNotFoundError:
+                    pass
+            log.info("Removed the rate history partition %d", start)
+
+
+class RateHistoryWriter(kp.Module):
+    """Appends the mean summary slice rates to a ``RateHistory``.
+
+    The rates are averaged over the time bins in the pipeline thread, the
+    completed bins are written to the memory-mapped files in a background
+    thread. The ``Summaryslice`` decoded by a preceding module (e.g.
+    ``DOMRates``) is reused, otherwise the ``CHData`` is decoded.
+
+    """
+    def configure(self):
+        det_id = self.require('det_id')
+        data_path = self.get("data_path", default="/data")
+        self.bin_width = self.get("bin_width", default=60)
+        self.with_pmts = self.get("with_pmts", default=False)
+        self.keep_days = self.get("keep_days", default=90)
+        partition_length = self.get("partition_length", default=86400)
+
+        self.history = RateHistory(os.path.join(
+            data_path, "rate_history", "{:08d}".format(det_id)),
+                                   bin_width=self.bin_width,
+                                   partition_length=partition_length)
+        self.bin_width = self.history.bin_width
+        self.dom_rows = DOMRows(kp.hardware.Detector(det_id=det_id))
+        n_doms = len(self.dom_rows)
+        self.current_bin = None
+        self.rate_sum = np.zeros((n_doms, N_PMTS))
+        self.n_samples = np.zeros(n_doms, dtype=np.int64)
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def process(self, blob):
+        summaryslice = blob.get('Summaryslice')
+        if summaryslice is None:
+            try:
+                summaryslice = decode_summaryslice(blob['CHData'])
+            except ValueError as e:
+                self.log.error("Skipping corrupt summary slice: %s", e)
+                return blob
+
+        time_bin = summaryslice.utc_seconds // self.bin_width
+        if time_bin != self.current_bin:
+            self._complete_bin()
+            self.current_bin = time_bin
+
+        rows = self.dom_rows.rows(summaryslice.dom_ids)
+        known = rows >= 0
+        self.rate_sum[rows[known]] += summaryslice.pmt_rates[known]
+        self.n_samples[rows[known]] += 1
+        return blob
+
+    def _complete_bin(self):
+        """Hand the mean rates of the current bin over to the writer"""
+        if self.current_bin is None or not np.any(self.n_samples):
+            return
+        seen = self.n_samples > 0
+        pmt_rates = np.full(self.rate_sum.shape, np.nan)
+        pmt_rates[seen] = self.rate_sum[seen] / self.n_samples[seen, None]
+        self.queue.put((self.current_bin * self.bin_width,
+                        self.dom_rows.dom_ids, pmt_rates.sum(axis=1) / 1000,
+                        pmt_rates if self.with_pmts else None))
+        self.rate_sum[:] = 0
+        self.n_samples[:] = 0
+
+    def run(self):
+        """Write the completed bins (runs in a background thread)"""
+        last_prune = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.history.write(*item)
+                self.history.flush()
+                if self.keep_days and time.time() - last_prune > 3600:
+                    self.history.prune(time.time() -
+                                       self.keep_days * 24 * 60 * 60)
+                    last_prune = time.time()
+            except OSError as e:
+                log.error("Could not write the rate history: %s", e)
+
+    def finish(self):
+        self._complete_bin()
+        self.queue.put(None)
+        self.thread.join()
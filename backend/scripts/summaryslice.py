@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: summaryslice.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Vectorised decoder for IO_SUM (summary slice) packets.
+
+The layout of the packets follows ``km3pipe.io.daq.DAQSummaryslice``. The
+summary frames are decoded with a single ``np.frombuffer`` call and the
+rates are looked up in a table, instead of parsing every frame in Python.
+
+Run this module to check the decoder against a golden payload.
+
+"""
+from collections import namedtuple
+import math
+
+import numpy as np
+
+MINIMAL_RATE_HZ = 2.0e3
+MAXIMAL_RATE_HZ = 2.0e6
+SUMMARYSLICE_VERSION = 6  # written by Jpp v13+
+WR_STATUS_MASK = 0x80000000  # White Rabbit status bit of the UTC seconds
+
+SUMMARYSLICE_HEADER_DTYPE = np.dtype([
+    ('length', '<i4'),
+    ('data_type', '<i4'),
+    ('version', '<i2'),
+    ('det_id', '<i4'),
+    ('run', '<i4'),
+    ('frame_index', '<i4'),
+    ('utc_seconds', '<u4'),
+    ('ticks', '<u4'),
+    ('n_frames', '<i4'),
+])
+
+SUMMARYFRAME_DTYPE = np.dtype([
+    ('dom_id', '<i4'),
+    ('dq_status', '<u4'),
+    ('dom_status', '<u4', (4, )),
+    ('rates', 'u1', (31, )),
+])
+
+# The rate in Hz of each of the 256 values of the compressed PMT rates
+RATE_LOOKUP = MINIMAL_RATE_HZ * np.exp(
+    np.arange(256) * math.log(MAXIMAL_RATE_HZ / MINIMAL_RATE_HZ) / 255)
+RATE_LOOKUP[0] = 0
+
+Summaryslice = namedtuple("Summaryslice", [
+    "det_id", "run", "frame_index", "utc_seconds", "dom_ids", "pmt_rates"
+])
+
+
+def decode_summaryslice(payload):
+    """Decode a raw IO_SUM payload.
+
+    Returns
+    -------
+    Summaryslice
+        The header values, ``dom_ids`` [N] and ``pmt_rates`` [N, 31] in Hz.
+
+    Raises
+    ------
+    ValueError if the payload is too short or of an unsupported version.
+
+    """
+    header = np.frombuffer(payload, dtype=SUMMARYSLICE_HEADER_DTYPE,
+                           count=1)[0]
+    if header['version'] != SUMMARYSLICE_VERSION:
+        raise ValueError("Unsupported summaryslice version ({})".format(
+            header['version']))
+    frames = np.frombuffer(payload,
+                           dtype=SUMMARYFRAME_DTYPE,
+                           count=int(header['n_frames']),
+                           offset=SUMMARYSLICE_HEADER_DTYPE.itemsize)
+    return Summaryslice(
+        det_id=int(header['det_id']),
+        run=int(header['run']),
+        frame_index=int(header['frame_index']),
+        utc_seconds=int(header['utc_seconds']) & ~WR_STATUS_MASK,
+        dom_ids=frames['dom_id'].astype(np.int64),
+        pmt_rates=RATE_LOOKUP[frames['rates']],
+    )
+
+
+class DOMRows:
+    """Lookup table from DOM IDs to the rows of per-DOM arrays.
+
+    The rows are ordered by DU and floor.
+
+    Parameters
+    ----------
+    detector: kp.hardware.Detector
+
+    """
+    def __init__(self, detector):
+        doms = sorted(detector.doms.items(), key=lambda item: item[1][:2])
+        self.dom_ids = np.array([dom_id for dom_id, _ in doms],
+                                dtype=np.int64)
+        self.dus = np.array([du for _, (du, _, _) in doms])
+        self.floors = np.array([floor for _, (_, floor, _) in doms])
+        self._order = np.argsort(self.dom_ids)
+        self._sorted_dom_ids = self.dom_ids[self._order]
+
+    def __len__(self):
+        return len(self.dom_ids)
+
+    def rows(self, dom_ids):
+        """The rows of the given DOM IDs, -1 for unknown DOMs"""
+        idx = np.searchsorted(self._sorted_dom_ids, dom_ids)
+        idx[idx == len(self)] = 0
+        rows = self._order[idx]
+        rows[self._sorted_dom_ids[idx] != dom_ids] = -1
+        return rows
+
+    def to_dict(self, values, mask=None):
+        """Map per-row values to a {(du, floor): value} dict"""
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        return {(int(du), int(floor)): value
+                for du, floor, value in zip(self.dus[mask], self.floors[mask],
+                                            values[mask])}
+
+
+# A summaryslice as written by Jpp v13+ with two DOMs and the White Rabbit
+# bit set: det_id 49, run 12345, frame index 1000, UTC 1600000000 s
+GOLDEN_PAYLOAD = bytes.fromhex(
+    '90000000a10f000006003100000039300000e803000000105edf20bcbe000200'
+    '000037ec2f300000000000000000000000000000000000000000000810182028'
+    '3038404850586068707880889098a0a8b0b8c0c8d0d8e0e8f038ec2f30000000'
+    '0000000000000000000000000000000000ffffffffffffffffffffffffffffff'
+    'ffffffffffffffffffffffffffffffff')
+
+
+def check_decoder():
+    """Decode the golden payload and compare it to the known content"""
+    summaryslice = decode_summaryslice(GOLDEN_PAYLOAD)
+    assert summaryslice.det_id == 49
+    assert summaryslice.run == 12345
+    assert summaryslice.frame_index == 1000
+    assert summaryslice.utc_seconds == 1600000000
+    assert list(summaryslice.dom_ids) == [808447031, 808447032]
+    assert summaryslice.pmt_rates.shape == (2, 31)
+    assert summaryslice.pmt_rates[0, 0] == 0
+    assert np.allclose(summaryslice.pmt_rates[0, 1:],
+                       RATE_LOOKUP[np.arange(8, 31 * 8, 8)])
+    assert np.allclose(summaryslice.pmt_rates[1], MAXIMAL_RATE_HZ)
+    for payload in (GOLDEN_PAYLOAD[:40],
+                    GOLDEN_PAYLOAD[:8] + b'\x05\x00' + GOLDEN_PAYLOAD[10:]):
+        try:
+            decode_summaryslice(payload)
+        except ValueError:
+            continue
+        raise AssertionError("Invalid payload decoded")
+    print("The summaryslice decoder works as expected.")
+
+
+if __name__ == '__main__':
+    check_decoder()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: timeslice.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Header-only reader for the timeslice streams (IO_TSL0, IO_TSL1, IO_TSSN...).
+
+Only the timeslice header and the superframe headers are read, the hits are
+skipped and nothing is copied. The layout follows
+``km3pipe.io.daq.TimesliceParser``.
+
+"""
+import struct
+
+TIMESLICE_VERSION = 1  # written by Jpp v13+
+# length, data type, version, det ID, run, sqnr, UTC seconds, 16ns ticks,
+# n_frames
+TIMESLICE_HEADER = struct.Struct('<iihiiiIIi')
+# the DOM ID, the DOM STATUS 1 word and the number of hits of a superframe
+FRAME_HEADER = struct.Struct('<28xi4xI12xi')
+HIT_SIZE = 6
+
+
+def parse_timeslice(data):
+    """Parse the header and the frame headers of a timeslice
+
+    Returns
+    -------
+    (det_id, run, sqnr, dom_ids, dom_status)
+        ``dom_ids`` and ``dom_status`` (the DOM STATUS 1 words, unsigned)
+        are lists with one entry per frame.
+
+    Raises
+    ------
+    struct.error if the data is truncated.
+    ValueError if the timeslice version is not supported.
+
+    """
+    buffer = memoryview(data)
+    (_, _, version, det_id, run, sqnr, _, _,
+     n_frames) = TIMESLICE_HEADER.unpack_from(buffer)
+    if version != TIMESLICE_VERSION:
+        raise ValueError("Unsupported timeslice version ({})".format(version))
+    offset = TIMESLICE_HEADER.size
+    dom_ids = []
+    dom_status = []
+    for _ in range(n_frames):
+        dom_id, status, n_hits = FRAME_HEADER.unpack_from(buffer, offset)
+        dom_ids.append(dom_id)
+        dom_status.append(status)
+        offset += FRAME_HEADER.size + n_hits * HIT_SIZE
+    if offset > len(buffer):
+        raise struct.error("timeslice truncated ({} of {} bytes)".format(
+            len(buffer), offset))
+    return det_id, run, sqnr, dom_ids, dom_status
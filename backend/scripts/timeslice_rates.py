@@ -22,37 +22,92 @@ from __future__ import division, print_function
 from datetime import datetime
 from collections import defaultdict, deque, OrderedDict
 from itertools import chain
-import sys
-from io import BytesIO
 from os.path import join
-from struct import unpack
+import struct
 import shutil
 import time
 import threading
 
+import numpy as np
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import matplotlib.dates as md
 
 import km3pipe as kp
-from km3pipe.io.daq import DAQPreamble
 import km3pipe.style
+from timeslice import parse_timeslice
 
 VERSION = "1.0"
 km3pipe.style.use('km3pipe')
 
 
+class SequenceGaps:
+    """Bitmap of the received sequence numbers of a stream
+
+    Sequence numbers which have not been received once the stream is
+    ``lag`` numbers ahead are counted as gaps.
+
+    """
+    def __init__(self, size=1 << 16, lag=50):
+        self.size = size
+        self.lag = lag
+        self.bits = np.zeros(size // 8, dtype=np.uint8)
+        self.checked = None  # all sequence numbers below are checked
+        self.latest = None
+        self.n_gaps = 0
+        self.n_late = 0
+
+    def add(self, sqnr):
+        if self.checked is None:
+            self.checked = self.latest = sqnr
+        if sqnr < self.checked:
+            self.n_late += 1
+            return
+        if sqnr >= self.checked + self.size:
+            self._check(sqnr - self.size + 1)
+        self.bits[(sqnr % self.size) >> 3] |= 1 << (sqnr & 7)
+        self.latest = max(self.latest, sqnr)
+
+    def check(self):
+        """Count the gaps up to the lag and return the total"""
+        if self.latest is not None:
+            self._check(self.latest - self.lag)
+        return self.n_gaps
+
+    def _check(self, end):
+        if end <= self.checked:
+            return
+        # nothing beyond the bitmap has been received
+        covered = min(end, self.checked + self.size)
+        self.n_gaps += end - covered
+        positions = np.arange(self.checked, covered) % self.size
+        bytes_, bits = positions >> 3, positions & 7
+        received = (self.bits[bytes_] >> bits) & 1
+        self.n_gaps += len(positions) - int(received.sum())
+        np.bitwise_and.at(self.bits, bytes_, ~(1 << bits).astype(np.uint8))
+        self.checked = end
+
+
 class TimesliceRate(kp.Module):
     def configure(self):
         self.plots_path = self.require('plots_path')
         self.interval = self.get( "interval", default=10)
         self.filename = self.get("filename", default="timeslice_rates")
         self.with_minor_ticks = self.get("with_minor_ticks", default=False)
-        print("Update interval: {}s".format(self.interval))
+        self.log_interval = self.get("log_interval", default=60)
+        self.print("Update interval: {}s".format(self.interval))
         self.timeslice_counts = defaultdict(int)
         self.timeslice_rates = OrderedDict()
 
+        # statistics since the last summary
+        self.n_timeslices = defaultdict(int)
+        self.frame_counts = defaultdict(lambda: defaultdict(int))
+        self.sequence_gaps = {}
+        self.n_corrupt = 0
+        self.log_summary = kp.time.Cuckoo(self.log_interval,
+                                          self._log_summary)
+
         self.styles = {
             "xfmt":
             md.DateFormatter('%Y-%m-%d %H:%M'),
@@ -77,54 +132,87 @@ class TimesliceRate(kp.Module):
             self.timeslice_rates[ts_type] = deque(maxlen=queue_len)
 
         self.run = True
-        self.thread = threading.Thread(target=self.plot).start()
         self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.plot).start()
 
         self.run_changes = []
         self.current_run_id = 0
         self.det_id = 0
 
     def process(self, blob):
-        print("Process")
         ts_type = str(blob['CHPrefix'].tag).split("IO_TS")[1]
-        sys.stdout.write('.')
-        sys.stdout.flush()
+        with self.lock:
+            self.timeslice_counts[ts_type] += 1
 
-        data = blob['CHData']
-        data_io = BytesIO(data)
-        tsl_size, datatype = unpack('<ii', data_io.read(8))
-        det_id, run, sqnr = unpack('<iii', data_io.read(12))
+        try:
+            det_id, run, sqnr, dom_ids, _ = parse_timeslice(
+                blob['CHData'])
+        except (struct.error, ValueError):
+            self.n_corrupt += 1
+            self.log_summary.msg()
+            return blob
 
         self.det_id = det_id
         if run > self.current_run_id:
             self.current_run_id = run
             self._log_run_change()
-        with self.lock:
-            self.timeslice_counts[ts_type] += 1
 
-        print(self.timeslice_counts)
+        if run == self.current_run_id:
+            gaps = self.sequence_gaps.get(ts_type)
+            if gaps is None or gaps[0] != run:
+                gaps = self.sequence_gaps[ts_type] = (run, SequenceGaps())
+            gaps[1].add(sqnr)
+
+        self.n_timeslices[ts_type] += 1
+        frame_counts = self.frame_counts[ts_type]
+        for dom_id in dom_ids:
+            frame_counts[dom_id] += 1
+
+        self.log_summary.msg()
 
         return blob
 
+    def _log_summary(self):
+        """Log the frame statistics since the last summary"""
+        for ts_type in sorted(self.n_timeslices):
+            n_timeslices = self.n_timeslices[ts_type]
+            frame_counts = self.frame_counts[ts_type]
+            n_frames = sum(frame_counts.values())
+            incomplete = sorted((count, dom_id)
+                                for dom_id, count in frame_counts.items()
+                                if count < n_timeslices)
+            n_gaps = 0
+            if ts_type in self.sequence_gaps:
+                n_gaps = self.sequence_gaps[ts_type][1].check()
+            self.print("{}: {} timeslices, {:.1f} frames/timeslice from {} "
+                       "DOMs, {} sequence gaps in run {}".format(
+                           ts_type, n_timeslices, n_frames / n_timeslices,
+                           len(frame_counts), n_gaps, self.current_run_id))
+            if incomplete:
+                examples = ", ".join(
+                    "{} ({}/{})".format(dom_id, count, n_timeslices)
+                    for count, dom_id in incomplete[:5])
+                self.log.warning("%s: %d DOMs with missing frames, e.g. %s",
+                                 ts_type, len(incomplete), examples)
+        if self.n_corrupt:
+            self.log.error("Skipped %d truncated timeslices", self.n_corrupt)
+        self.n_timeslices = defaultdict(int)
+        self.frame_counts = defaultdict(lambda: defaultdict(int))
+        self.n_corrupt = 0
+
     def _log_run_change(self):
         self.print("New run: %s" % self.current_run_id)
         now = datetime.utcnow()
         self.run_changes.append((now, self.current_run_id))
 
     def _get_run_changes_to_plot(self):
-        self.print("Checking run changes out of range")
         overall_rates = self.timeslice_rates['SN']
-        # if not overall_rates:
-        #     self.print("No timeslice rates logged  yet, nothing to remove.")
-        #     return
-        self.print("  all:     {}".format(self.run_changes))
         run_changes_to_plot = []
         min_timestamp = min(overall_rates)[0]
-        self.print("  earliest timestamp to plot: {}".format(min_timestamp))
         for timestamp, run in self.run_changes:
             if timestamp > min_timestamp:
                 run_changes_to_plot.append((timestamp, run))
-        self.print("  to plot: {}".format(run_changes_to_plot))
+        self.log.debug("Run changes to plot: %s", run_changes_to_plot)
         return run_changes_to_plot
 
     def plot(self):
@@ -133,7 +221,7 @@ class TimesliceRate(kp.Module):
             self.create_plot()
 
     def create_plot(self):
-        print('\n' + self.__class__.__name__ + ": updating plot.")
+        self.print(self.__class__.__name__ + ": updating plot.")
 
         timestamp = datetime.utcnow()
 
@@ -159,8 +247,6 @@ class TimesliceRate(kp.Module):
 
         run_changes_to_plot = self._get_run_changes_to_plot()
         if run_changes_to_plot:
-            self.log.critical("No run changes!")
-            self.print("Recorded run changes: {}".format(run_changes_to_plot))
             all_rates = [r for d, r in chain(*self.timeslice_rates.values())]
             if not all_rates:
                 self.log.warning("Empty rates, skipping...")
@@ -207,7 +293,7 @@ class TimesliceRate(kp.Module):
         shutil.move(filename_tmp, filename)
 
         plt.close('all')
-        print("Plot updated at '{}'.".format(filename))
+        self.print("Plot updated at '{}'.".format(filename))
 
     def finish(self):
         self.run = False
@@ -16,20 +16,175 @@ Options:
     -p LIGIER_PORT          The port of the ligier [default: 5553].
     -m LOGGING_LIGIER_IP    The IP of the logging ligier [default: 127.0.0.1].
     -q LOGGING_LIGIER_PORT  The port of the logging ligier [default: 5553].
+    -o PLOT_DIR             The directory to save the plot [default: /plots].
     -h --help               Show this screen.
 
 """
 import datetime
+import os
+import struct
+import time
+
+import numpy as np
+import matplotlib
+import matplotlib.colors as mcolors
+matplotlib.use('Agg')
+
 import km3pipe as kp
+from ligier_fanout import LigierFanoutPump
+from timeslice import parse_timeslice
+import matplotlib.pyplot as plt
+import km3pipe.style as kpst
+kpst.use("km3pipe")
+
+TIME_SYNC_BIT = np.uint32(1 << (32 - 1))  # in the CLB DOM STATUS 1 field
+
+NO_DATA, VALID, INVALID = 0, 1, 2
+
+
+class TimeSyncHistory:
+    """Bitset history of the time sync status of the DOMs.
+
+    Two bits are kept for each DOM and time bin: whether the DOM has sent
+    data and whether its time sync was invalid at least once. The time bins
+    form a ring buffer of ``n_bins`` columns. The rows are the DOMs, ordered
+    by DOM ID, new DOMs are inserted when they show up.
+
+    Parameters
+    ----------
+    n_bins: int
+        Number of time bins to keep.
+    interval: float
+        The length of a time bin in seconds.
+
+    """
+    def __init__(self, n_bins, interval):
+        self.n_bins = n_bins
+        self.interval = interval
+        n_bytes = (n_bins + 7) // 8
+        self.dom_ids = np.zeros(0, dtype=np.int64)
+        self.seen = np.zeros((0, n_bytes), dtype=np.uint8)
+        self.invalid = np.zeros((0, n_bytes), dtype=np.uint8)
+        self.state = np.zeros(0, dtype=np.int8)  # the latest status per DOM
+        self.timestamps = np.full(n_bins, np.nan)
+        self.current_bin = None
+
+    def _rows(self, dom_ids):
+        """The rows of the DOM IDs, new DOMs are added"""
+        new = np.setdiff1d(dom_ids, self.dom_ids)
+        if len(new):
+            positions = np.searchsorted(self.dom_ids, new)
+            self.dom_ids = np.insert(self.dom_ids, positions, new)
+            self.seen = np.insert(self.seen, positions, 0, axis=0)
+            self.invalid = np.insert(self.invalid, positions, 0, axis=0)
+            self.state = np.insert(self.state, positions, NO_DATA)
+        return np.searchsorted(self.dom_ids, dom_ids)
+
+    def _advance(self, time_bin):
+        """Clear the columns of the bins up to ``time_bin``"""
+        if self.current_bin is None:
+            first = time_bin
+        else:
+            first = max(self.current_bin + 1, time_bin - self.n_bins + 1)
+        for i in range(first, time_bin + 1):
+            column = i % self.n_bins
+            mask = np.uint8(~(1 << (column & 7)) & 0xFF)
+            self.seen[:, column >> 3] &= mask
+            self.invalid[:, column >> 3] &= mask
+            self.timestamps[column] = i * self.interval
+        self.current_bin = time_bin
+
+    def add(self, timestamp, dom_ids, valid):
+        """Add the time sync status of the DOMs in a timeslice
+
+        Returns
+        -------
+        (lost, recovered)
+            The DOM IDs which lost and regained their time sync. DOMs which
+            show up with an invalid time sync count as lost.
+
+        """
+        time_bin = int(timestamp // self.interval)
+        if self.current_bin is None or time_bin > self.current_bin:
+            self._advance(time_bin)
+        column = time_bin % self.n_bins
+        bit = np.uint8(1 << (column & 7))
+        rows = self._rows(dom_ids)
+        self.seen[rows, column >> 3] |= bit
+        self.invalid[rows[~valid], column >> 3] |= bit
+
+        state = np.where(valid, VALID, INVALID).astype(np.int8)
+        previous = self.state[rows]
+        self.state[rows] = state
+        lost = dom_ids[(state == INVALID) & (previous != INVALID)]
+        recovered = dom_ids[(state == VALID) & (previous == INVALID)]
+        return lost, recovered
+
+    def matrix(self):
+        """The status matrix [n_doms, n_bins] and the bin start times
+
+        The columns are in chronological order, the values are NO_DATA,
+        VALID or INVALID.
+
+        """
+        seen = np.unpackbits(self.seen, axis=1,
+                             bitorder='little')[:, :self.n_bins]
+        invalid = np.unpackbits(self.invalid, axis=1,
+                                bitorder='little')[:, :self.n_bins]
+        status = seen * VALID + invalid * (INVALID - VALID)
+        if self.current_bin is None:
+            return status, self.timestamps
+        shift = -(self.current_bin + 1) % self.n_bins
+        return np.roll(status, shift, axis=1), np.roll(self.timestamps, shift)
+
+
+def plot_time_sync_history(status, timestamps, dom_ids, interval, filename):
+    """Create the heatmap of the time sync status of all DOMs"""
+    now = time.time()
+    n_bins = status.shape[1]
+
+    def xlabel_func(i):
+        timestamp = timestamps[i]
+        if np.isnan(timestamp):
+            timestamp = now - (n_bins - i) * interval
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime("%H:%M")
+
+    cmap = mcolors.ListedColormap(['black', 'forestgreen', 'red'])
+    fig, ax = plt.subplots(figsize=(10, 8))
+    ax.imshow(status,
+              origin='lower',
+              aspect='auto',
+              interpolation='none',
+              cmap=cmap,
+              vmin=NO_DATA,
+              vmax=INVALID)
+    ax.set_title("Time sync status of {} DOMs (green: valid, red: invalid, "
+                 "black: no data)\n{}".format(len(dom_ids),
+                                              datetime.datetime.utcnow()))
+    ax.set_xlabel("UTC time [{}s/px]".format(interval))
+    ax.set_ylabel("DOM (ordered by DOM ID)")
+    xtics_int = range(0, n_bins, max(1, int(n_bins / 10)))
+    plt.xticks([i for i in xtics_int], [xlabel_func(i) for i in xtics_int])
+    fig.tight_layout()
+    plt.savefig(filename + '.tmp.png')
+    plt.close('all')
+    os.replace(filename + '.tmp.png', filename)
 
 
 class TimeSyncChecker(kp.Module):
     def configure(self):
         logging_ligier = self.require("logging_ligier_ip")
         logging_ligier_port = self.require("logging_ligier_port")
+        self.plots_path = self.require("plots_path")
+        interval = self.get("interval", default=60)
+        n_bins = self.get("n_bins", default=1440)
         self.ch_client = kp.controlhost.Client(logging_ligier,
                                                port=logging_ligier_port)
-        self.alert = kp.time.Cuckoo(interval=10, callback=self._alert)
+        self.history = TimeSyncHistory(n_bins, interval)
+        self.lost = set()
+        self.recovered = set()
+        self.alert = kp.time.Cuckoo(interval=10, callback=self._alert_changes)
+        self.cuckoo = kp.time.Cuckoo(60, self.create_plot)
 
     def _alert(self, msg):
         date = datetime.datetime.utcnow().strftime("%c")
@@ -37,21 +192,49 @@ class TimeSyncChecker(kp.Module):
         print(msg)
         self.ch_client.put_message("MSG", msg)
 
+    def _alert_changes(self):
+        """Report the time sync changes since the last alert"""
+        n_invalid = np.count_nonzero(self.history.state == INVALID)
+        parts = []
+        if self.lost:
+            parts.append("invalid time sync for DOM ID: {}".format(','.join(
+                map(str, sorted(self.lost)))))
+        if self.recovered:
+            parts.append("time sync recovered for DOM ID: {}".format(
+                ','.join(map(str, sorted(self.recovered)))))
+        parts.append("currently invalid: {} of {} DOMs".format(
+            n_invalid, len(self.history.dom_ids)))
+        self.lost = set()
+        self.recovered = set()
+        self._alert(" /// ".join(parts))
+
     def process(self, blob):
-        dom_ids_invalid = []
-        dom_ids_valid = []
-        for dom_id, frameinfo in blob['TimesliceFrameInfos'].items():
-            valid_time_sync = bool(frameinfo.dom_status[0] & (1 << (32 - 1)))
-            if not valid_time_sync:
-                dom_ids_invalid.append(dom_id)
-            else:
-                dom_ids_valid.append(dom_id)
-        if dom_ids_invalid:
-            self.alert("invalid time sync for DOM ID: {} /// valid: {}".format(
-                ','.join(map(str, dom_ids_invalid)),
-                ','.join(map(str, dom_ids_valid))))
+        try:
+            _, _, _, dom_ids, status = parse_timeslice(blob['CHData'])
+        except (struct.error, ValueError) as e:
+            self.log.error("Skipping corrupt timeslice: %s", e)
+            return blob
+        dom_ids = np.array(dom_ids, dtype=np.int64)
+        valid = (np.array(status, dtype=np.uint32) & TIME_SYNC_BIT) != 0
+
+        lost, recovered = self.history.add(time.time(), dom_ids, valid)
+        if len(lost) or len(recovered):
+            self.lost.difference_update(recovered.tolist())
+            self.lost.update(lost.tolist())
+            self.recovered.difference_update(lost.tolist())
+            self.recovered.update(recovered.tolist())
+        if self.lost or self.recovered:
+            self.alert()
+
+        self.cuckoo.msg()
         return blob
 
+    def create_plot(self):
+        status, timestamps = self.history.matrix()
+        filename = os.path.join(self.plots_path, 'timesync.png')
+        plot_time_sync_history(status, timestamps, self.history.dom_ids,
+                               self.history.interval, filename)
+
     def finish(self):
         self.ch_client._disconnect()
 
@@ -64,16 +247,17 @@ def main():
     ligier_port = int(args['-p'])
     logging_ligier_ip = args['-m']
     logging_ligier_port = int(args['-q'])
+    plots_path = args['-o']
 
     pipe = kp.Pipeline()
-    pipe.attach(kp.io.ch.CHPump,
+    pipe.attach(LigierFanoutPump,
                 host=ligier_ip,
                 port=ligier_port,
                 tags="IO_TSSN")
-    pipe.attach(kp.io.daq.TimesliceParser)
     pipe.attach(TimeSyncChecker,
                 logging_ligier_ip=logging_ligier_ip,
-                logging_ligier_port=logging_ligier_port)
+                logging_ligier_port=logging_ligier_port,
+                plots_path=plots_path)
     pipe.drain()
 
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: tmch.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Vectorised decoder for batches of IO_MONIT (TMCH) packets.
+
+The layout of the packets follows ``km3pipe.io.daq.TMCHData``. Only the part
+which is common to all structure versions is decoded.
+
+"""
+from collections import namedtuple
+
+import numpy as np
+
+TMCH_DTYPE = np.dtype([
+    ('data_type', 'S4'),
+    ('run', '>u4'),
+    ('udp_sequence_number', '>u4'),
+    ('utc_seconds', '>u4'),
+    ('nanoseconds', '>u4'),
+    ('dom_id', '>u4'),
+    ('dom_status', '>u4', (4, )),
+    ('pmt_rates', '>u4', (31, )),
+    ('hrvbmp', '>u4'),
+    ('flags', '>u4'),
+    ('yaw', '>f4'),
+    ('pitch', '>f4'),
+    ('roll', '>f4'),
+    ('A', '>f4', (3, )),
+    ('G', '>f4', (3, )),
+    ('H', '>f4', (3, )),
+    ('temp', '>u2'),
+    ('humidity', '>u2'),
+    ('tdc_full', '>u4'),
+    ('aes_full', '>u4'),
+    ('flushc', '>u4'),
+])
+
+TMCHBatch = namedtuple("TMCHBatch", [
+    "dom_id", "utc_seconds", "pmt_rates", "hrv", "yaw", "pitch", "roll", "A",
+    "H"
+])
+
+_CHANNELS = np.arange(31, dtype=np.uint32)
+
+
+def decode_tmch(payloads):
+    """Decode a list of raw IO_MONIT payloads into contiguous arrays.
+
+    Invalid packets (wrong data type or too short) are skipped, the number of
+    returned entries can therefore be smaller than the number of payloads.
+
+    Returns
+    -------
+    TMCHBatch
+        ``dom_id`` [N], ``utc_seconds`` [N], ``pmt_rates`` [N, 31] in Hz,
+        ``hrv`` [N, 31] (bool), ``yaw``, ``pitch``, ``roll`` [N] and the
+        AHRS vectors ``A`` and ``H`` [N, 3].
+
+    """
+    size = TMCH_DTYPE.itemsize
+    buffer = b''.join(p[:size] for p in payloads
+                      if len(p) >= size and p[:4] == b'TMCH')
+    raw = np.frombuffer(buffer, dtype=TMCH_DTYPE)
+    hrvbmp = raw['hrvbmp'].astype(np.uint32)
+    return TMCHBatch(
+        dom_id=raw['dom_id'].astype(np.uint32),
+        utc_seconds=raw['utc_seconds'].astype(np.uint32),
+        pmt_rates=raw['pmt_rates'].astype(np.float64) * 10.0,
+        hrv=((hrvbmp[:, np.newaxis] >> _CHANNELS) & 1).astype(bool),
+        yaw=raw['yaw'].astype(np.float32),
+        pitch=raw['pitch'].astype(np.float32),
+        roll=raw['roll'].astype(np.float32),
+        A=raw['A'].astype(np.float32),
+        H=raw['H'].astype(np.float32),
+    )
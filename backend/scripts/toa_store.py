@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Filename: toa_store.py
+# Author: Tamas Gal <tgal@km3net.de>
+# vim: ts=4 sw=4 et
+"""
+Local SQLite store of the acoustic TOAs (``toashort`` stream).
+
+The TOAs are stored per run in the order they were retrieved from the DB.
+For every run, DOM and emitter, the last UNIXTIMEBASE which has been fetched
+is recorded, so that only newer rows are added when a run is fetched again.
+Runs which have ended are marked as complete and are not fetched again.
+
+"""
+import sqlite3
+
+import pandas as pd
+
+COLUMNS = ["DOMID", "EMITTERID", "QUALITYFACTOR", "UNIXTIMEBASE", "TOA_S"]
+
+
+class TOAStore:
+    """TOA store in an SQLite file.
+
+    Parameters
+    ----------
+    filename: str
+        The SQLite file, created if it does not exist.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS toas (
+                run INT, dom_id INT, emitter_id INT, quality_factor NUMERIC,
+                unixtimebase NUMERIC, toa_s NUMERIC);
+            CREATE INDEX IF NOT EXISTS toas_run
+                ON toas (run, dom_id, emitter_id, unixtimebase);
+            CREATE INDEX IF NOT EXISTS toas_time ON toas (unixtimebase);
+            CREATE TABLE IF NOT EXISTS last_fetched (
+                run INT, dom_id INT, emitter_id INT, unixtimebase NUMERIC,
+                PRIMARY KEY (run, dom_id, emitter_id));
+            CREATE TABLE IF NOT EXISTS complete_runs (run INT PRIMARY KEY);
+        """)
+
+    def is_complete(self, run):
+        return self.connection.execute(
+            "SELECT 1 FROM complete_runs WHERE run=?",
+            (int(run), )).fetchone() is not None
+
+    def set_complete(self, run):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO complete_runs (run) VALUES (?)",
+                (int(run), ))
+
+    def add(self, run, toas):
+        """Add the rows of a run which have not been fetched yet.
+
+        Rows with the last fetched UNIXTIMEBASE are replaced, since more TOAs
+        of that second may have arrived in the meantime.
+
+        Parameters
+        ----------
+        run: int
+        toas: pd.DataFrame
+            The ``toashort`` table of the run (all or some DOMs).
+
+        Returns
+        -------
+        int: The number of added rows.
+
+        """
+        run = int(run)
+        if toas is None or len(toas) == 0:
+            return 0
+        last = pd.read_sql(
+            "SELECT dom_id AS DOMID, emitter_id AS EMITTERID, "
+            "unixtimebase AS LAST FROM last_fetched WHERE run=?",
+            self.connection,
+            params=(run, ))
+        toas = toas[COLUMNS].merge(last,
+                                   how="left",
+                                   on=["DOMID", "EMITTERID"])
+        new = toas[toas.UNIXTIMEBASE >= toas.LAST.fillna(float("-inf"))]
+        latest = new.groupby(["DOMID", "EMITTERID"],
+                             sort=False).UNIXTIMEBASE.max()
+        replaced = new.dropna(subset=["LAST"]).drop_duplicates(
+            ["DOMID", "EMITTERID"])
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM toas WHERE run=? AND dom_id=? AND emitter_id=? "
+                "AND unixtimebase>=?",
+                ((run, int(d), int(e), _value(l)) for d, e, l in zip(
+                    replaced.DOMID, replaced.EMITTERID, replaced.LAST)))
+            self.connection.executemany(
+                "INSERT INTO toas (run, dom_id, emitter_id, quality_factor, "
+                "unixtimebase, toa_s) VALUES (?, ?, ?, ?, ?, ?)",
+                ((run, int(d), int(e), _value(q), _value(u), _value(t))
+                 for d, e, q, u, t in zip(new.DOMID, new.EMITTERID,
+                                          new.QUALITYFACTOR,
+                                          new.UNIXTIMEBASE, new.TOA_S)))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO last_fetched "
+                "(run, dom_id, emitter_id, unixtimebase) VALUES (?, ?, ?, ?)",
+                ((run, int(d), int(e), _value(u))
+                 for (d, e), u in latest.items()))
+        return len(new)
+
+    def toas(self, minrun, maxrun):
+        """The stored TOAs of a run range, split by DOM ID"""
+        toas = pd.read_sql(
+            "SELECT dom_id AS DOMID, emitter_id AS EMITTERID, "
+            "quality_factor AS QUALITYFACTOR, unixtimebase AS UNIXTIMEBASE, "
+            "toa_s AS TOA_S FROM toas WHERE run>=? AND run<=? ORDER BY rowid",
+            self.connection,
+            params=(int(minrun), int(maxrun)))
+        return {
+            dom_id: dom_toas.reset_index(drop=True)
+            for dom_id, dom_toas in toas.groupby("DOMID")
+        }
+
+    def run_range(self, start, end):
+        """The first and last run with TOAs in a time interval"""
+        return self.connection.execute(
+            "SELECT MIN(run), MAX(run) FROM toas "
+            "WHERE unixtimebase>? AND unixtimebase<?",
+            (start, end)).fetchone()
+
+    def prune(self, before):
+        """Remove the TOAs older than a given UNIX time"""
+        with self.connection:
+            n_rows = self.connection.execute(
+                "DELETE FROM toas WHERE unixtimebase<?", (before, )).rowcount
+            self.connection.execute(
+                "DELETE FROM last_fetched WHERE unixtimebase<?", (before, ))
+            self.connection.execute(
+                "DELETE FROM complete_runs WHERE run NOT IN "
+                "(SELECT DISTINCT run FROM last_fetched)")
+        return n_rows
+
+
+def _value(x):
+    """Convert NumPy scalars to int or float for SQLite"""
+    return x.item() if hasattr(x, "item") else x
@@ -42,6 +42,7 @@ from rocketchat_API.rocketchat import RocketChat
 import km3pipe as kp
 from km3pipe.io.daq import DAQPreamble, DAQEvent
 from km3io.tools import is_3dshower, is_3dmuon, is_mxshower
+from ligier_fanout import LigierFanoutPump
 import km3pipe.style
 
 VERSION = "1.0"
@@ -301,7 +302,7 @@ def main():
     ligier_port = int(args['-p'])
 
     pipe = kp.Pipeline()
-    pipe.attach(kp.io.ch.CHPump,
+    pipe.attach(LigierFanoutPump,
                 host=ligier_ip,
                 port=ligier_port,
                 tags='IO_EVT',
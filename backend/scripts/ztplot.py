@@ -25,16 +25,18 @@ from km3modules.communication import ELOGService
 from km3io.tools import is_3dmuon, is_3dshower, is_mxshower
 import km3db
 import km3pipe as kp
+from ligier_fanout import LigierFanoutPump
+from calib_cache import CalibrationCache
 import numpy as np
 import matplotlib.ticker as ticker
 import matplotlib.pyplot as plt
+from collections import deque
 from datetime import datetime
+import heapq
 import os
 import queue
 import shutil
 import threading
-import time
-from urllib.error import URLError
 
 import matplotlib
 # Force matplotlib to not use any Xwindows backend.
@@ -44,6 +46,121 @@ km3pipe.style.use('km3pipe')
 
 lock = threading.Lock()
 
+TRIGGERS = (("MX", is_mxshower), ("3DM", is_3dmuon), ("3DS", is_3dshower))
+
+EVENT_SELECTION_COLUMNS = [
+    "overlays", "n_hits", "n_triggered_hits", "n_dus", "plot_filename",
+    "run_id", "det_id", "frame_index", "trigger_counter", "utc_timestamp",
+    "trigger_mask"
+]
+EVENT_SELECTION_TYPES = [
+    "INT", "INT", "INT", "INT", "TEXT", "INT", "INT", "INT", "INT", "INT",
+    "INT"
+]
+
+
+class TopNSelection:
+    """Streaming selection of the top N events in several categories.
+
+    A category is an event parameter (``overlays``, ``n_hits``,
+    ``n_triggered_hits`` or ``n_dus``), optionally restricted to a trigger
+    type, e.g. ``"n_hits:3DM"``. A min-heap of the N largest values is kept
+    for each category, so an event is checked in constant time.
+
+    """
+    def __init__(self, categories, n=10):
+        self.n = n
+        self.heaps = {}
+        self.categories = {}
+        for category in categories:
+            parameter, _, trigger = category.partition(':')
+            trigger_check = None
+            if trigger:
+                trigger_check = dict(TRIGGERS)[trigger]
+            self.categories[category] = (parameter, trigger_check)
+            self.heaps[category] = []
+
+    def _matches(self, category, trigger_mask):
+        trigger_check = self.categories[category][1]
+        if trigger_check is None:
+            return True
+        return trigger_mask is not None and trigger_check(int(trigger_mask))
+
+    def lower_limit(self, category):
+        heap = self.heaps[category]
+        if len(heap) < self.n:
+            return 0
+        return heap[0]
+
+    def lower_limits(self):
+        return {c: self.lower_limit(c) for c in self.categories}
+
+    def _push(self, category, value):
+        heap = self.heaps[category]
+        if len(heap) < self.n:
+            heapq.heappush(heap, value)
+        else:
+            heapq.heappushpop(heap, value)
+
+    def seed(self, events):
+        """Fill the heaps with already selected events (dicts)"""
+        for event in events:
+            for category, (parameter, _) in self.categories.items():
+                if self._matches(category, event["trigger_mask"]):
+                    self._push(category, event[parameter])
+
+    def update(self, event):
+        """Add an event and return the categories where it made the top N"""
+        categories = []
+        for category, (parameter, _) in self.categories.items():
+            if not self._matches(category, event["trigger_mask"]):
+                continue
+            if event[parameter] > self.lower_limit(category):
+                self._push(category, event[parameter])
+                categories.append(category)
+        return categories
+
+
+class PlotScheduler:
+    """Plot queue holding the Top-N candidates and the latest routine event.
+
+    Candidates are handed out first, in the order of their arrival. A routine
+    event replaces the previous one if it has not been picked up yet.
+
+    """
+    def __init__(self, max_candidates=50):
+        self.max_candidates = max_candidates
+        self.candidates = deque()
+        self.latest = None
+        self.n_superseded = 0
+        self.n_dropped = 0
+        self._condition = threading.Condition()
+
+    def put(self, item, candidate=False):
+        with self._condition:
+            if candidate:
+                if len(self.candidates) >= self.max_candidates:
+                    self.candidates.popleft()
+                    self.n_dropped += 1
+                self.candidates.append(item)
+            else:
+                if self.latest is not None:
+                    self.n_superseded += 1
+                self.latest = item
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """Return the next item to be plotted or raise ``queue.Empty``"""
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self.candidates or self.latest is not None,
+                    timeout):
+                raise queue.Empty
+            if self.candidates:
+                return self.candidates.popleft()
+            item, self.latest = self.latest, None
+            return item
+
 
 class ZTPlot(kp.Module):
     def configure(self):
@@ -58,10 +175,23 @@ class ZTPlot(kp.Module):
         self.run_id = None
         self.t0set = None
         self.calib = None
+        self.calibrations = CalibrationCache(
+            self.det_id,
+            path=self.get('calibration_path', default='/data/calibration'))
         self.max_z = None
         self.last_plot_time = 0
-        self.lower_limits = {}
         self.elog = self.get('elog', default=False)
+        self.selection = TopNSelection(
+            self.get('top_n_categories',
+                     default=["overlays", "n_hits", "n_triggered_hits"]),
+            n=self.get('top_n', default=10))
+        self.selection_batch_size = self.get('selection_batch_size',
+                                             default=10)
+        self.selected_events = []
+        self.plot_interval = self.get('plot_interval', default=60)
+        self.n_rendered = 0
+        self.n_skipped = 0
+        self.print_stats = kp.time.Cuckoo(300, self._print_stats)
 
         self.sds = km3db.StreamDS()
 
@@ -69,60 +199,76 @@ class ZTPlot(kp.Module):
 
     def prepare(self):
         if not self.services["table_exists"](self.event_selection_table):
-            self.services["create_table"](self.event_selection_table, [
-                "overlays", "n_hits", "n_triggered_hits", "n_dus",
-                "plot_filename", "run_id", "det_id", "frame_index",
-                "trigger_counter", "utc_timestamp"
-            ], [
-                "INT", "INT", "INT", "INT", "TEXT", "INT", "INT", "INT", "INT",
-                "INT"
-            ])
+            self.services["create_table"](self.event_selection_table,
+                                          EVENT_SELECTION_COLUMNS,
+                                          EVENT_SELECTION_TYPES)
+        else:
+            columns = [
+                c[1] for c in self.services["query"](
+                    "PRAGMA table_info({})".format(self.event_selection_table))
+            ]
+            if "trigger_mask" not in columns:
+                self.services["query"](
+                    "ALTER TABLE {} ADD COLUMN trigger_mask INT".format(
+                        self.event_selection_table))
 
-        self._update_lower_limits()
+        self._seed_selection()
 
         self.run = True
-        self.max_queue = 300
-        self.queue = queue.Queue()
+        self.queue = PlotScheduler(
+            max_candidates=self.get('max_candidates', default=50))
         self.thread = threading.Thread(target=self.plot, daemon=True)
         self.thread.start()
 
-    def _update_lower_limits(self):
-        """Update the lower limits for the Top-10 candidate selection"""
-        n_candidates = 10
-        for category in ["overlays", "n_hits", "n_triggered_hits"]:
-            lower_limits = self.services["query"](
-                "SELECT {cat} FROM {tab} ORDER BY {cat} DESC LIMIT {limit}".
-                format(cat=category,
-                       tab=self.event_selection_table,
-                       limit=n_candidates))
-            if len(lower_limits) < 10:
-                lower_limit = 0
-            else:
-                lower_limit = lower_limits[-1][0]
-            self.lower_limits[category] = lower_limit
-
-        self.cprint("Current limits for the Top-10: {}".format(
-            self.lower_limits))
-
-    def _update_calibration(self):
-        self.cprint("Updating calibration for run {}".format(self.run_id))
-        try:
-            self.calib = kp.calib.Calibration(det_id=self.det_id,
-                                              run=self.run_id)
-        except IndexError:
-            self.log.error("Unusable (probably empty) DETX received from the database, "
-                           "falling back to the base DETX without any calibration and "
-                           "retrying at run change.")
-            self.calib = kp.calib.Calibration(det_id=self.det_id)
-        except URLError as e:
-            self.log.error(
-                "Unable to update calibration, no connection to the DB, "
-                "retrying in one minute...\n{}".
-                format(e))
-            time.sleep(60)
-            self._update_calibration()
+    def _seed_selection(self):
+        """Initialise the Top-N selection with the recorded events"""
+        parameters = ["overlays", "n_hits", "n_triggered_hits", "n_dus",
+                      "trigger_mask"]
+        rows = self.services["query"]("SELECT {} FROM {}".format(
+            ', '.join(parameters), self.event_selection_table))
+        self.selection.seed(dict(zip(parameters, row)) for row in rows)
+        self.cprint("Current limits for the Top-{}: {}".format(
+            self.selection.n, self.selection.lower_limits()))
+
+    def _record_selected_event(self, row):
+        """Queue a row for the event selection table"""
+        self.selected_events.append(row)
+        if len(self.selected_events) >= self.selection_batch_size:
+            self._write_selected_events()
+
+    def _write_selected_events(self):
+        """Write the queued rows to the event selection table"""
+        if not self.selected_events:
+            return
+        self.log.info("Writing %d selected events",
+                      len(self.selected_events))
+        for row in self.selected_events:
+            self.services["insert_row"](self.event_selection_table,
+                                        EVENT_SELECTION_COLUMNS, row)
+        self.selected_events = []
+
+    def _update_calibration(self, calib_run, calib):
+        if calib_run == self.run_id:
+            self.cprint("Updating calibration for run {}".format(self.run_id))
         else:
-            self.max_z = round(np.max(self.calib.detector.pmts.pos_z) + 10, -1)
+            self.log.warning(
+                "Calibration for run %s not available yet, using the one of "
+                "run %s", self.run_id, calib_run)
+        self.calib = calib
+        self.max_z = round(np.max(self.calib.detector.pmts.pos_z) + 10, -1)
+        self._init_lookup()
+
+    def _init_lookup(self):
+        """Create the sorted DOM ID -> DU lookup arrays for the pre-filter"""
+        doms = self.calib.detector.doms
+        self.dom_ids = np.array(sorted(doms), dtype=np.int64)
+        self.dom_dus = np.array([doms[dom_id][0] for dom_id in self.dom_ids])
+
+    def _dus(self, dom_ids):
+        """The DUs of the given (raw) DOM IDs"""
+        idx = np.searchsorted(self.dom_ids, dom_ids)
+        idx[idx == len(self.dom_ids)] = 0
+        return np.unique(self.dom_dus[idx[self.dom_ids[idx] == dom_ids]])
 
     def process(self, blob):
         if 'Hits' not in blob:
@@ -132,40 +278,76 @@ class ZTPlot(kp.Module):
 
         event_info = blob['EventInfo']
 
-        run_id = event_info.run_id[0]
-        if run_id != self.run_id:
-            self.run_id = run_id
-            self._update_calibration()
+        self.run_id = event_info.run_id[0]
+        calibration = self.calibrations.get(self.run_id)
+        if calibration is None:
+            self.log.debug("No calibration available yet, skipping event.")
+            return blob
+        if calibration[1] is not self.calib:
+            self._update_calibration(*calibration)
 
         hits = blob['Hits']
-        hits = self.calib.apply(hits)
 
-        n_triggered_dus = len(np.unique(hits[hits.triggered == True].du))
-        n_triggered_doms = len(np.unique(hits[hits.triggered == True].dom_id))
+        dom_ids = np.asarray(hits.dom_id, dtype=np.int64)
+        triggered = hits.triggered.astype(bool)
+        triggered_dom_ids = np.unique(dom_ids[triggered])
+        n_triggered_dus = len(self._dus(triggered_dom_ids))
+        n_triggered_doms = len(triggered_dom_ids)
         if n_triggered_dus < self.min_dus or n_triggered_doms < self.min_doms:
             self.log.debug(f"Skipping event with {n_triggered_dus} DUs "
                            f"and {n_triggered_doms} DOMs.")
             return blob
 
-        # print("Event queue size: {0}".format(self.queue.qsize()))
-        if self.queue.qsize() < self.max_queue:
-            raw_data = blob["CHData"]
-            self.queue.put((event_info, hits, raw_data))
-        else:
-            self.cprint("Skipping, queue is full...")
+        categories = self.selection.update({
+            "overlays": event_info.overlays[0],
+            "n_hits": len(hits),
+            "n_triggered_hits": np.count_nonzero(triggered),
+            "n_dus": len(self._dus(np.unique(dom_ids))),
+            "trigger_mask": event_info.trigger_mask[0],
+        })
+
+        if not categories and not self._plot_due(event_info):
+            self.n_skipped += 1
+            return blob
+
+        # The hits are calibrated in the plot thread, so that superseded
+        # events are never calibrated.
+        self.queue.put((event_info, hits, blob["CHData"], categories,
+                        self.calib),
+                       candidate=bool(categories))
 
         return blob
 
+    def _plot_due(self, event_info):
+        """Check whether the routine plot needs to be updated"""
+        utc_timestamp = event_info.utc_seconds[0]
+        return utc_timestamp - self.last_plot_time >= self.plot_interval
+
+    def _print_stats(self):
+        self.cprint("Plots rendered: {}, superseded: {}, skipped: {}, "
+                    "dropped candidates: {}".format(self.n_rendered,
+                                                    self.queue.n_superseded,
+                                                    self.n_skipped,
+                                                    self.queue.n_dropped))
+
     def plot(self):
         while self.run:
             try:
-                event_info, hits, raw_data = self.queue.get(timeout=50)
+                event_info, hits, raw_data, categories, calib = \
+                    self.queue.get(timeout=50)
             except queue.Empty:
+                self._write_selected_events()
+                continue
+            if not categories and not self._plot_due(event_info):
+                self.n_skipped += 1
                 continue
+            hits = calib.apply(hits)
             with lock:
-                self.create_plot(event_info, hits, raw_data)
+                self.create_plot(event_info, hits, raw_data, categories)
+            self.n_rendered += 1
+            self.print_stats()
 
-    def create_plot(self, event_info, hits, raw_data):
+    def create_plot(self, event_info, hits, raw_data, categories):
 
         trigger_mask = event_info.trigger_mask[0]
         det_id = event_info.det_id[0]
@@ -177,15 +359,7 @@ class ZTPlot(kp.Module):
         n_hits = len(hits)
         n_triggered_hits = sum(hits.triggered)
 
-        # Check for new record
-        is_in_top10 = overlays > self.lower_limits[
-            'overlays'] or n_hits > self.lower_limits[
-                'n_hits'] or n_triggered_hits > self.lower_limits[
-                    "n_triggered_hits"]
-
-        if (utc_timestamp - self.last_plot_time) < 60 and not is_in_top10:
-            self.log.debug("Skipping plot...")
-            return
+        is_in_top_n = bool(categories)
 
         self.cprint(self.__class__.__name__ + ": updating plot.")
 
@@ -197,9 +371,7 @@ class ZTPlot(kp.Module):
             & (self.calib.detector.pmts.channel_id == 0)]
 
         trigger_params = ' '.join([
-            trig
-            for trig, trig_check in (("MX", is_mxshower), ("3DM", is_3dmuon),
-                                     ("3DS", is_3dshower))
+            trig for trig, trig_check in TRIGGERS
             if trig_check(int(trigger_mask))
         ])
 
@@ -224,10 +396,11 @@ class ZTPlot(kp.Module):
                      figsize=(16, 16))
         shutil.move(f_tmp, f)
 
-        if is_in_top10:
+        if is_in_top_n:
             self.cprint(
-                "New record! Overlays: {}, hits: {}, triggered hits: {}".
-                format(overlays, n_hits, n_triggered_hits))
+                "New record in {}! Overlays: {}, hits: {}, triggered hits: {}".
+                format(', '.join(categories), overlays, n_hits,
+                       n_triggered_hits))
 
             base_filename = os.path.join(
                 self.plots_path,
@@ -236,25 +409,24 @@ class ZTPlot(kp.Module):
             plot_filename = base_filename + ".png"
             rawdata_filename = base_filename + ".dat"
 
-            self.services["insert_row"](self.event_selection_table, [
-                "overlays", "n_hits", "n_triggered_hits", "n_dus",
-                "plot_filename", "run_id", "det_id", "frame_index",
-                "trigger_counter", "utc_timestamp"
-            ], [
+            self._record_selected_event([
                 overlays, n_hits, n_triggered_hits, n_dus, plot_filename,
-                run_id, det_id, frame_index, trigger_counter, utc_timestamp
+                run_id, det_id, frame_index, trigger_counter, utc_timestamp,
+                trigger_mask
             ])
             shutil.copy(f, plot_filename)
 
             with open(rawdata_filename, "wb") as fobj:
                 fobj.write(raw_data)
 
-            self._update_lower_limits()
+            self.cprint("Current limits for the Top-{}: {}".format(
+                self.selection.n, self.selection.lower_limits()))
             if self.elog:
                 self.services['post_elog'](
                     logbook=self.logbook,
                     subject="New massive event!",
-                    message="A new event has made it into the top 10!",
+                    message="A new event has made it into the top {}!".format(
+                        self.selection.n),
                     message_type="Monitoring",
                     author="Gal T",
                     files=[plot_filename])
@@ -265,6 +437,8 @@ class ZTPlot(kp.Module):
 
     def finish(self):
         self.run = False
+        with lock:
+            self._write_selected_events()
 
 
 def main():
@@ -279,7 +453,7 @@ def main():
     pipe = kp.Pipeline()
     pipe.attach(LocalDBService, thread_safety=False)
     pipe.attach(ELOGService)
-    pipe.attach(kp.io.ch.CHPump,
+    pipe.attach(LigierFanoutPump,
                 host=ligier_ip,
                 port=ligier_port,
                 tags='IO_EVT, IO_SUM',
@@ -17,8 +17,8 @@ LOGS_PATH = "/logs"
 USERNAME = None
 PASSWORD = None
 
-PLOTS = [['dom_activity', 'dom_rates'], 'pmt_rates_du*', ['trigger_rates'],
-         ['ztplot', 'triggermap']]
+PLOTS = [['dom_activity', 'dom_rates'], 'pmt_rates_du*', ['timesync'],
+         ['trigger_rates'], ['ztplot', 'triggermap']]
 
 ACOUSTICS_PLOTS = [['Online_Acoustic_Monitoring']]
 AHRS_PLOTS = ['yaw_calib_du*', 'pitch_calib_du*', 'roll_calib_du*']
@@ -214,7 +214,8 @@ def top10():
 @requires_auth
 def logs():
     files = OrderedDict()
-    filenames = sorted(glob(join(LOGS_PATH, "MSG*.log")),
+    filenames = sorted(glob(join(LOGS_PATH, "MSG*.log")) +
+                       glob(join(LOGS_PATH, "MSG*.log.gz")),
                        reverse=True)
     main_log = filenames.pop(-1)
     for filename in [main_log] + filenames: